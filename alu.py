@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# The arithmetic and logic operations, and lookup tables of their results
+#
+
+from array import array
+from utils import check, clamp, overflows, popcount, count_leading_zeros
+
+def div(x, y):
+    "Integer division, dividing by zero gives 0."
+    if y == 0:
+        return 0
+    return x // y
+
+def mod(x, y):
+    "Modulo, x mod 0 is x (so that x == (x div y) * y + x mod y)."
+    if y == 0:
+        return x
+    return x % y
+
+# x is the operand, y is the register
+binary_operations = {
+    'add': lambda x, y: x + y,
+    'sub': lambda x, y: y - x,
+    'mul': lambda x, y: x * y,
+    'div': div,
+    'mod': mod,
+    'or': lambda x, y: x | y,
+    'and': lambda x, y: x & y,
+    'xor': lambda x, y: x ^ y,
+    'shl': lambda x, y: x << y,
+    'shr': lambda x, y: x >> y,
+}
+
+unary_operations = {
+    'not': lambda x: ~x,
+    'neg': lambda x: clamp(-x),
+    'popcount': popcount,
+    'clz': count_leading_zeros,
+}
+
+###############################################################
+
+# The tables cover the bytes: the registers a, b, c and d hold signed ones,
+# the immediates and the other registers unsigned ones. The unary operations
+# can leave a register outside (~255 is -256), the machine computes those.
+operands = range(-128, 256)
+size = len(operands)
+
+# How the flags are packed in the tables
+zero_bit = 1
+parity_bit = 2
+sign_bit = 4
+overflow_bit = 8
+error_bit = 128 # the operation raises an error (e.g. negative shift)
+
+def pack_flags(result, overflow_p):
+    "Pack the flags set by an operation, given its clamped result."
+    return ((zero_bit if result == 0 else 0) |
+            (parity_bit if bin(result)[2:].count('1') % 2 == 0 else 0) |
+            (sign_bit if result < 0 else 0) |
+            (overflow_bit if overflow_p else 0))
+
+# index(x, y) is x * size + y + origin, without any check of the operands
+origin = -operands[0] * (size + 1)
+
+def index(x, y):
+    "Position of the operands (x, y) in a binary table."
+    return x * size + y + origin
+
+# and x is at x + unary_origin in a unary table
+unary_origin = -operands[0]
+
+def compute_binary_table(fn):
+    """Compute the clamped results and the packed flags of fn for every pair
+    of operands."""
+    results = array('b', bytes(size * size))
+    flags = bytearray(size * size)
+    for x in operands:
+        for y in operands:
+            i = index(x, y)
+            try:
+                result = fn(x, y)
+            except ValueError:
+                flags[i] = error_bit
+                continue
+            results[i] = clamp(result)
+            flags[i] = pack_flags(results[i], overflows(result))
+    return results, flags
+
+def compute_unary_table(fn):
+    """Compute the results of fn for every operand (they're not clamped,
+    ~200 is -201)."""
+    return array('h', [fn(x) for x in operands])
+
+# The tables computed so far, by operation's name
+binary_tables = {}
+unary_tables = {}
+
+def binary_table(name):
+    "Get the tables (results, flags) of a binary operation."
+    tables = binary_tables.get(name)
+    if tables is None:
+        tables = binary_tables[name] = compute_binary_table(binary_operations[name])
+    return tables
+
+def unary_table(name):
+    "Get the table of results of a unary operation."
+    table = unary_tables.get(name)
+    if table is None:
+        table = unary_tables[name] = compute_unary_table(unary_operations[name])
+    return table
+
+def save(path):
+    "Write all the tables to a file."
+    with open(path, 'wb') as file:
+        for name in binary_operations:
+            results, flags = binary_table(name)
+            file.write(results.tobytes())
+            file.write(flags)
+        for name in unary_operations:
+            file.write(unary_table(name).tobytes())
+
+def load(path):
+    "Read the tables written by save()."
+    with open(path, 'rb') as file:
+        for name in binary_operations:
+            results = array('b', file.read(size * size))
+            flags = bytearray(file.read(size * size))
+            binary_tables[name] = (results, flags)
+        for name in unary_operations:
+            table = unary_tables[name] = array('h')
+            table.frombytes(file.read(2 * size))
+
+###############################################################
+
+def test_div():
+    check(div(7, 2) == 3)
+    check(div(-7, 2) == -4)
+    check(div(7, 0) == 0)
+    check(mod(7, 2) == 1)
+    check(mod(7, 0) == 7)
+    check(all(x == div(x, y) * y + mod(x, y)
+              for x in operands for y in [-3, 0, 5]))
+
+def test_tables():
+    results, flags = binary_table('add')
+    check(results[index(100, 100)] == clamp(200))
+    check(flags[index(0, 0)] == zero_bit | parity_bit)
+    check(flags[index(-1, 0)] & sign_bit)
+    check(flags[index(-128, -128)] & overflow_bit)
+
+    results, flags = binary_table('shl')
+    check(flags[index(1, -1)] == error_bit)
+    check(results[index(1, 3)] == 8)
+
+    # unsigned operands are not their signed bytes
+    results, flags = binary_table('mul')
+    check(flags[index(200, 2)] & overflow_bit and not flags[index(-56, 2)] & overflow_bit)
+    results, flags = binary_table('div')
+    check(results[index(200, 7)] == div(200, 7) and results[index(-56, 7)] == div(-56, 7))
+
+    check(unary_table('not')[42 + unary_origin] == -43)
+    check(unary_table('not')[200 + unary_origin] == -201)
+    check(unary_table('neg')[-128 + unary_origin] == -128)
+
+def test_save_load(path):
+    save(path)
+    saved = binary_table('mul')
+    binary_tables.clear()
+    unary_tables.clear()
+    load(path)
+    check(binary_table('mul') == saved)
+    check(unary_table('popcount')[7 + unary_origin] == 3)
+    check(unary_table('not') == array('h', [~x for x in operands]))
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    test_div()
+    test_tables()
+    with tempfile.TemporaryDirectory() as directory:
+        test_save_load(os.path.join(directory, 'alu'))
+    print()
@@ -4,11 +4,11 @@
 
 import sys
 from itertools import chain
-from meta import register_names, flag_names, operations
+from meta import register_names, flag_names, operations, frozen, specification, expand
 from utils import print_dotted_list, params, check, remove_comment
 from utils import complement
 
-def compute_codec():
+def compute_codec(operations=operations):
     """Compute "codec" and "opcodes" (used for [dis]assambly)."""
     codec = [None] * len(operations)
     opcodes = {}
@@ -24,7 +24,22 @@ def compute_codec():
     return codec, opcodes
 
 register_codec = register_names + flag_names
-codec, opcodes = compute_codec()
+if frozen:
+    codec, opcodes = frozen.codec, frozen.opcodes
+else:
+    codec, opcodes = compute_codec()
+
+def test_tables():
+    "tables.py is up to date, run ./meta.py --freeze after changing meta.operations"
+    check(frozen is not None)
+    # meta.operations is the frozen one, expand the specification again
+    expanded = list(chain(*map(expand, specification)))
+    check(frozen.operations == expanded)
+    check((codec, opcodes) == compute_codec(expanded))
+    for opcode, entry in [(0, ('halt', '', 0)), (3, ('getcr', 'r', 1)),
+                          (34, ('addir', 'ir', 2)), (102, ('ret', '', 0)),
+                          (123, ('subjnziri', 'iri', 3)), (130, ('movputcrr', 'rr', 1))]:
+        check(codec[opcode] == entry and opcodes[entry[0]] == opcode)
 
 ###############################################################
 
@@ -58,8 +73,9 @@ def test_assamble_argument():
 
 def assamble_instruction(line):
     [name, *args] = line.split(' ')
-    op = name + ''.join(map(argument_type, args))
-    if args == tuple('rr'):
+    operands = ''.join(map(argument_type, args))
+    op = name + operands
+    if operands == 'rr':
         r1 = assamble_argument(args[0]) 
         r2 = assamble_argument(args[1]) 
         params = [r1 << 4 | r2]
@@ -95,7 +111,8 @@ def islabel(x):
 def isreference(x):
     return isinstance(x, str) and x.startswith(':')
 
-def link(object_code):
+def symbols(object_code):
+    "The symbol table: the address of each label."
     labels = {}
     position = 0
     for i, element in enumerate(object_code):
@@ -105,6 +122,31 @@ def link(object_code):
             labels[element] = position
         else:
             position += 1
+    return labels
+
+def source_map(code):
+    "The line (from 1) of the instruction starting at each address."
+    lines = {}
+    address = 0
+    for number, line in enumerate(code.split('\n'), 1):
+        line = remove_comment(line).strip()
+        if line:
+            size = len([x for x in assamble_line(line) if not islabel(x)])
+            if size:
+                lines[address] = number
+            address += size
+    return lines
+
+def where(labels, address):
+    "Name an address after the closest label before it (label+offset)."
+    before = [(position, name) for (name, position) in labels.items() if position <= address]
+    if not before:
+        return str(address)
+    position, name = max(before)
+    return name if position == address else '{0}+{1}'.format(name, address - position)
+
+def link(object_code):
+    labels = symbols(object_code)
     object_code = list(filter(complement(islabel), object_code))
     for i, element in enumerate(object_code):
         if isreference(element):
@@ -116,6 +158,8 @@ def test_assamble():
     assamble("label:")
     obj = assamble("label: jmp label")
     link(obj)
+    check(symbols(assamble("mov 1\nlabel: jmp label")) == {'label': 2})
+    check(source_map("# one\nmov 1\n\nlabel:\nhalt # two\nend: putc") == {0: 2, 2: 5, 3: 6})
 
     assamble("cmp 13 # Enter")
     assamble("putc 11 # Linefeed")
@@ -136,6 +180,13 @@ def disassamble_arguments(arguments, operands):
         return [register_codec[r1], register_codec[r2]]
     return list(map(disassamble_arg, arguments, operands))
 
+def decode_arguments(arguments, operands):
+    """Decode all the arguments passed to an operations, keeping registers
+    as their index in register_codec."""
+    if operands == 'rr':
+        return [arguments[0] >> 4, arguments[0] & 15]
+    return list(arguments)
+
 def disassamble_insctruction(instr):
     "Decode a whole assambled instruction."
     [opcode, *arguments] = instr
@@ -162,10 +213,12 @@ if __name__ == '__main__':
     test_machinery('neg')
     test_machinery('mov 2')
     test_machinery('mov 2 b')
+    test_machinery('mov b c')
 
     # pprint(codec)
     # pprint(opcodes)
     test_assamble_argument()
+    test_tables()
 
 
 ################# WIP Notes on the density of the code
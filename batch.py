@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+#
+# Run many machines in lockstep, with numpy
+#
+# The machines (lanes) are rows of arrays: a N x 256 matrix for the ram and
+# a column per register and flag. At each step, the running lanes are
+# grouped by the instruction they are about to execute and each group is
+# executed as one vectorized operation.
+#
+
+import numpy as np
+from core import Machine, operation_table, ram_size, flag_offset
+from core import signed_registers, ip_register, sp_register, accumulator
+from core import zero_flag, parity_flag, sign_flag, overflow_flag
+from core import immediate, read, write, longest_instruction
+from assamble import register_names, flag_names, codec, decode_arguments
+from assamble import assamble, link
+from utils import check, copy
+from console import capture
+
+# The status of a lane
+running = 0
+halted = 1
+waiting = 2     # for input, getc was not executed
+error = 3       # the interpreter would have raised an exception
+status_names = ['running', 'halted', 'waiting', 'error']
+
+# The number of bytes following each opcode, and at most
+lengths = np.array([length for (_, _, length) in codec], dtype=np.int64)
+operand_bytes = longest_instruction - 1
+
+# Number of 1s in each byte
+byte_popcount = np.array([bin(x).count('1') for x in range(256)], dtype=np.int64)
+
+def popcount(x):
+    "Count the 1s in the binary representation of |x| (like bin(x).count('1'))."
+    x = np.abs(x)
+    count = np.zeros_like(x)
+    while x.any():
+        count += byte_popcount[x & 0xFF]
+        x = x >> 8
+    return count
+
+def bit_length(x):
+    "The number of bits of x (x >= 0)."
+    length = np.zeros_like(x)
+    while x.any():
+        length += x > 0
+        x = x >> 1
+    return length
+
+def count_leading_zeros(x):
+    "Like utils.count_leading_zeros."
+    # for negative numbers, utils.count_leading_zeros counts the 'b' of '-0b'
+    return np.where(x >= 0, 8 - bit_length(np.abs(x)), 7 - bit_length(np.abs(x)))
+
+def clamp(x):
+    "Like utils.clamp."
+    x = np.where(x < -128, x % 128, x)
+    return np.where(x >= 128, (x % 128) - 128, x)
+
+def overflows(x):
+    return (x < -255) | (x > 254)
+
+def shift_count(y):
+    """Clamp a shift count to a range numpy can shift by, without changing
+    the clamped result nor whether it overflows."""
+    return np.minimum(y, 62)
+
+def div(x, y):
+    "Like alu.div"
+    return np.where(y == 0, 0, x // np.where(y == 0, 1, y))
+
+def mod(x, y):
+    "Like alu.mod"
+    return np.where(y == 0, x, x % np.where(y == 0, 1, y))
+
+binary_operations = {
+    'add': lambda x, y: x + y,
+    'sub': lambda x, y: y - x,
+    'mul': lambda x, y: x * y,
+    'div': div,
+    'mod': mod,
+    'or': lambda x, y: x | y,
+    'and': lambda x, y: x & y,
+    'xor': lambda x, y: x ^ y,
+    'shl': lambda x, y: x << np.minimum(y, 16),
+    'shr': lambda x, y: x >> shift_count(y),
+}
+
+unary_operations = {
+    'not': lambda x: ~x,
+    'neg': lambda x: clamp(-x),
+    'popcount': popcount,
+    'clz': count_leading_zeros,
+}
+
+conditions = {
+    'jo': lambda b, lanes: b.flags[lanes, overflow_flag],
+    'jno': lambda b, lanes: ~b.flags[lanes, overflow_flag],
+    'jpe': lambda b, lanes: b.flags[lanes, parity_flag],
+    'jpo': lambda b, lanes: ~b.flags[lanes, parity_flag],
+    'jz': lambda b, lanes: b.flags[lanes, zero_flag],
+    'jnz': lambda b, lanes: ~b.flags[lanes, zero_flag],
+    'jl': lambda b, lanes: b.flags[lanes, sign_flag],
+    'jle': lambda b, lanes: b.flags[lanes, sign_flag] | b.flags[lanes, zero_flag],
+    'jge': lambda b, lanes: ~b.flags[lanes, sign_flag],
+    'jaz': lambda b, lanes: b.registers[lanes, accumulator] == 0,
+}
+
+class Batch:
+    """Many machines, executed in lockstep.
+
+    ram is a N x 256 matrix of bytes, registers and flags have a column per
+    register and flag (in register_names and flag_names order). Each lane
+    reads its input from inputs[lane] (bytes) and writes its output in
+    outputs[lane] (a list of characters)."""
+
+    def __init__(self, n, binary=()):
+        self.ram = np.zeros((n, ram_size), dtype=np.uint8)
+        self.ram[:, :len(binary)] = binary
+        self.registers = np.zeros((n, len(register_names)), dtype=np.int64)
+        self.flags = np.zeros((n, len(flag_names)), dtype=bool)
+        self.inputs = [b''] * n
+        self.positions = np.zeros(n, dtype=np.int64)
+        self.outputs = [[] for _ in range(n)]
+        self.status = np.zeros(n, dtype=np.int8)
+        self.count = np.zeros(n, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.status)
+
+    def output(self, lane):
+        return ''.join(self.outputs[lane])
+
+    def machine(self, lane):
+        "Make a Machine with the state of a lane."
+        m = Machine()
+        m.ram[:] = self.ram[lane].tobytes()
+        m.registers[:] = map(int, self.registers[lane])
+        m.flags[:] = map(bool, self.flags[lane])
+        return m
+
+    def run(self, max_steps=None):
+        "Run until every lane is stopped, or for at most max_steps steps."
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def step(self):
+        "Execute one instruction on each running lane, return how many ran."
+        lanes = np.flatnonzero(self.status == running)
+        if not len(lanes):
+            return 0
+        ip = self.registers[lanes, ip_register]
+        opcodes = self.ram[lanes, ip % ram_size].astype(np.int64)
+        invalid = opcodes >= len(codec)
+        self.status[lanes[invalid]] = error
+        lanes, ip, opcodes = lanes[~invalid], ip[~invalid], opcodes[~invalid]
+
+        # group the lanes by instruction: opcode and operands
+        length = lengths[opcodes]
+        keys = opcodes << (8 * operand_bytes)
+        for i in range(1, operand_bytes + 1):
+            byte = self.ram[lanes, (ip + i) % ram_size].astype(np.int64)
+            keys |= np.where(length >= i, byte, 0) << (8 * (operand_bytes - i))
+        for key in np.unique(keys):
+            group = keys == key
+            self.execute(int(key), lanes[group], ip[group])
+        return len(lanes)
+
+    def execute(self, key, lanes, ip):
+        "Execute the instruction encoded in key on some lanes."
+        opcode = key >> (8 * operand_bytes)
+        [_, operands, length] = codec[opcode]
+        operation = operation_table[opcode]
+        if operation is None:
+            self.status[lanes] = halted
+            self.count[lanes] += 1
+            return
+        arguments = [(key >> (8 * (operand_bytes - i))) & 0xFF for i in range(1, length + 1)]
+        arguments = decode_arguments(arguments, operands) + operation.defaults
+        modes = operation.modes
+        if operation.name == 'getc':
+            # the interpreter reads before writing the register
+            lanes, ip = self.take_input(lanes, ip)
+        if (len(arguments) != len(modes) or
+            any(mode != immediate and x >= flag_offset + len(flag_names) or
+                mode == write and x >= flag_offset
+                for x, mode in zip(arguments, modes))):
+            self.status[lanes] = error
+            return
+
+        # the instruction pointer is on the last byte while it executes
+        ip = (ip + length) % ram_size if length else ip
+        self.registers[lanes, ip_register] = ip
+        self.count[lanes] += 1
+        ok = self.perform(operation, lanes, arguments)
+        if ok is not None:
+            self.status[lanes[~ok]] = error
+            lanes, ip = lanes[ok], ip[ok]
+
+        after = self.registers[lanes, ip_register]
+        self.registers[lanes, ip_register] = np.where(after == ip, (ip + 1) % ram_size, after)
+
+    def perform(self, operation, lanes, arguments):
+        """Do an operation on some lanes, return which lanes succeeded (None
+        when they all did)."""
+        if operation.parts:
+            # a superinstruction: do its parts, on the lanes still fine
+            ok = np.ones(len(lanes), dtype=bool)
+            for part, indices in operation.parts:
+                fine = np.flatnonzero(ok)
+                part_ok = self.perform(part, lanes[fine], [arguments[i] for i in indices])
+                if part_ok is not None:
+                    ok[fine[~part_ok]] = False
+            return ok
+        values = [self.value(lanes, x) if mode == read else
+                  np.full(len(lanes), x, dtype=np.int64) if mode == immediate else x
+                  for x, mode in zip(arguments, operation.modes)]
+        fn = getattr(self, 'op_' + operation.name, None)
+        if fn is None:
+            return self.arithmetic(operation.name, lanes, *values)
+        return fn(lanes, *values)
+
+    def value(self, lanes, x):
+        "The value of a register (or flag) for some lanes."
+        if x < flag_offset:
+            return self.registers[lanes, x]
+        return self.flags[lanes, x - flag_offset].astype(np.int64)
+
+    def take_input(self, lanes, ip):
+        "Keep the lanes that have some input left, the others wait."
+        left = np.array([self.positions[lane] < len(self.inputs[lane])
+                         for lane in lanes], dtype=bool)
+        self.status[lanes[~left]] = waiting
+        return lanes[left], ip[left]
+
+    def set_register(self, lanes, register, value):
+        self.registers[lanes, register] = value
+
+    def load_register(self, lanes, register, byte):
+        "Set a register to a byte read from ram."
+        byte = byte.astype(np.int64)
+        if register in signed_registers:
+            byte = np.where(byte > 127, byte - 256, byte)
+        self.registers[lanes, register] = byte
+
+    def set_flags(self, lanes, x):
+        self.flags[lanes, zero_flag] = x == 0
+        self.flags[lanes, parity_flag] = popcount(x) % 2 == 0
+        self.flags[lanes, sign_flag] = x < 0
+
+    def arithmetic(self, name, lanes, value, register):
+        "Execute a unary or binary operation."
+        if name in unary_operations:
+            self.set_register(lanes, register, unary_operations[name](value))
+            return
+        y = self.registers[lanes, register]
+        ok = None
+        if name in ['shl', 'shr']:
+            # negative shifts raise an error
+            ok = y >= 0
+            lanes, value, y = lanes[ok], value[ok], y[ok]
+        result = binary_operations[name](value, y)
+        clamped = clamp(result)
+        self.set_flags(lanes, clamped)
+        self.flags[lanes, overflow_flag] = overflows(result)
+        self.set_register(lanes, register, clamped)
+        return ok
+
+    def address(self, address):
+        "Which addresses are valid indices in ram, and the addresses as indices."
+        return (address >= -ram_size) & (address < ram_size), address % ram_size
+
+    def op_getc(self, lanes, register):
+        for lane in lanes:
+            self.registers[lane, register] = self.inputs[lane][self.positions[lane]]
+            self.positions[lane] += 1
+
+    def op_putc(self, lanes, value):
+        ok = value >= 0
+        for lane, x in zip(lanes[ok], value[ok]):
+            self.outputs[lane].append(chr(x))
+        return ok
+
+    def op_store(self, lanes, address, value):
+        ok, address = self.address(address)
+        self.ram[lanes[ok], address[ok]] = value[ok] & 0xFF
+        return ok
+
+    def op_load(self, lanes, address, register):
+        ok, address = self.address(address)
+        self.load_register(lanes[ok], register, self.ram[lanes[ok], address[ok]])
+        return ok
+
+    def op_mov(self, lanes, value, register):
+        self.set_register(lanes, register, value)
+
+    def op_test(self, lanes, x, y):
+        self.set_flags(lanes, x | y)
+
+    def op_cmp(self, lanes, x, y):
+        result = y - x
+        self.set_flags(lanes, clamp(result))
+        self.flags[lanes, overflow_flag] = overflows(result)
+
+    def op_jmp(self, lanes, value):
+        self.registers[lanes, ip_register] = value
+
+    def op_push(self, lanes, value):
+        sp = (self.registers[lanes, sp_register] - 1) % ram_size
+        self.registers[lanes, sp_register] = sp
+        self.ram[lanes, sp] = value & 0xFF
+
+    def op_pop(self, lanes, register):
+        sp = (self.registers[lanes, sp_register] + 1) % ram_size
+        self.registers[lanes, sp_register] = sp
+        self.load_register(lanes, register, self.ram[lanes, (sp - 1) % ram_size])
+
+    def op_call(self, lanes, value):
+        self.op_push(lanes, self.registers[lanes, ip_register])
+        self.op_jmp(lanes, value)
+
+    def op_ret(self, lanes):
+        self.op_pop(lanes, ip_register)
+
+def conditional_jump(name):
+    condition = conditions[name]
+    def op(self, lanes, value):
+        taken = condition(self, lanes)
+        self.registers[lanes[taken], ip_register] = value[taken]
+    return op
+
+for name in conditions:
+    setattr(Batch, 'op_' + name, conditional_jump(name))
+
+def run(binary, n, inputs=None, registers=None, max_steps=None):
+    """Run a binary on n lanes and return the Batch. inputs is a list of
+    bytes, registers a list of {name: value}, one per lane."""
+    batch = Batch(n, binary)
+    for lane in range(n):
+        if inputs is not None:
+            batch.inputs[lane] = inputs[lane]
+        if registers is not None:
+            for name, value in registers[lane].items():
+                batch.registers[lane, register_names.index(name)] = value
+    batch.run(max_steps)
+    return batch
+
+###############################################################
+
+# A program using every kind of superinstruction
+superinstructions = """
+    loop:
+    movputc 'x'
+    pushpop b c
+    mov c a
+    cmpjz 1 last
+    cmpjnz 2 next
+    last:
+    movputc '!' d
+    cmpjge d next
+    movputc b
+    next:
+    subjnz 1 b loop
+    pushpop 7 d
+    pushpop
+    halt
+    """
+
+def run_interpreter(binary, text=b'', registers={}):
+    "Run a binary with the interpreter, return (machine, output)."
+    m = Machine(io=capture(text))
+    copy(binary, m.ram)
+    for name, value in registers.items():
+        m.registers[register_names.index(name)] = value
+    m.run()
+    return m, m.io.file.getvalue()
+
+def check_lane(batch, lane, machine, output):
+    "Check that a lane ended like the interpreter."
+    other = batch.machine(lane)
+    check(batch.status[lane] == halted)
+    check(other.ram == machine.ram)
+    check(other.registers == machine.registers)
+    check(other.flags == machine.flags)
+    check(batch.output(lane) == output)
+
+def test_examples():
+    for name in ['hi', 'call_ret', 'stack']:
+        with open('examples/{0}.asm'.format(name)) as file:
+            binary = link(assamble(file.read()))
+        batch = run(binary, 3)
+        machine, output = run_interpreter(binary)
+        for lane in range(3):
+            check_lane(batch, lane, machine, output)
+
+def test_inputs():
+    with open('examples/echo.asm') as file:
+        binary = link(assamble(file.read()))
+    inputs = [b'q', b'hi\rq', b'abc', b'\r\r\rq']
+    batch = run(binary, len(inputs), inputs)
+    for lane, text in enumerate(inputs):
+        if text.endswith(b'q'):
+            check_lane(batch, lane, *run_interpreter(binary, text))
+        else:
+            # ran out of input
+            check(batch.status[lane] == waiting)
+            check(batch.output(lane) == 'abc')
+
+def test_registers():
+    # different registers, so the lanes diverge
+    binary = link(assamble("""
+    mov b
+    loop:
+    mul 3
+    test a
+    jpe even
+    mov of c
+    mov 7 d
+    div d
+    mod 5 d
+    jmp next
+    even:
+    neg
+    xor 85
+    popcount c
+    clz d
+    next:
+    push a
+    mov b a
+    sub 1
+    mov a b
+    pop a
+    jge loop
+    halt
+    """))
+    registers = [{'b': b} for b in [0, 1, 5, 17, -3, 100, 127]]
+    batch = run(binary, len(registers), registers=registers)
+    for lane, values in enumerate(registers):
+        check_lane(batch, lane, *run_interpreter(binary, registers=values))
+
+def test_superinstructions():
+    binary = link(assamble(superinstructions))
+    registers = [{'b': b} for b in [1, 3, 5, -2]]
+    batch = run(binary, len(registers), registers=registers)
+    for lane, values in enumerate(registers):
+        check_lane(batch, lane, *run_interpreter(binary, registers=values))
+
+def test_errors():
+    # shifting by a negative count raises an error
+    binary = link(assamble("shr 1\nhalt"))
+    batch = run(binary, 2, registers=[{'a': 3}, {'a': -1}])
+    check_lane(batch, 0, *run_interpreter(binary, registers={'a': 3}))
+    check(batch.status[1] == error)
+
+    # like the interpreter, getc waits for input before failing to write a flag
+    binary = link(assamble("getc cf\nhalt"))
+    batch = run(binary, 2, [b'', b'x'])
+    check(list(batch.status) == [waiting, error])
+
+if __name__ == '__main__':
+    test_examples()
+    test_inputs()
+    test_registers()
+    test_errors()
+    test_superinstructions()
+    print()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+#
+# Measure how fast the assambler, the linker and the virtual machine are
+#
+# Each benchmark is run for a few rounds, its speed is reported in
+# operations/second (mean and standard deviation over the rounds). The
+# results can be saved as a JSON baseline, and compared to a baseline: the
+# benchmarks that got slower make the comparison fail.
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import contextlib
+import statistics
+import subprocess
+import compiler
+from core import Machine
+from cover import Coverage
+from assamble import codec, assamble, link, disassamble_insctruction
+from console import Console, Device
+from optimizer import optimize
+from utils import copy
+
+# What to type to the programs that read from the keyboard
+default_input = "hello\rworld\rq"
+
+# The ways to run a machine, they return the number of instructions executed
+engines = {
+    'interpreter': Machine.run,
+    'compiled': compiler.run,
+    'coverage': lambda machine: Coverage().run(machine),
+}
+
+def slurp(path):
+    with open(path, 'r') as file:
+        return file.read()
+
+def load(path):
+    "Assamble and link a source file."
+    return link(assamble(slurp(path)))
+
+class Keyboard:
+    "A device that types text, over and over, and ignores the output."
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def getc(self):
+        char = self.text[self.position % len(self.text)]
+        self.position += 1
+        return ord(char)
+
+    def putc(self, value):
+        pass
+
+    def flush(self):
+        pass
+
+def measure(binary, engine=Machine.run, seconds=0.2, text=default_input):
+    """Run a binary over and over for about some seconds, returning
+    (instructions per run, instructions/second)."""
+    runs = 0
+    count = 0
+    elapsed = 0
+    while elapsed < seconds:
+        machine = Machine(io=Keyboard(text))
+        copy(binary, machine.ram)
+        start = time.perf_counter()
+        count += engine(machine)
+        elapsed += time.perf_counter() - start
+        runs += 1
+    return count // runs, count / elapsed
+
+###############################################################
+
+# The guest programs measured, they loop 10000 times or so
+kernels = {
+    'count': """
+      mov 100 c
+    outer:
+      mov 100 b
+    inner:
+      sub 1 b
+      jnz inner
+      sub 1 c
+      jnz outer
+      halt
+    """,
+    # down is at address 14, ret comes back on the operand of call, which
+    # executes as opcode 14 (add a a, harmless here)
+    'recursion': """
+      mov 100 d
+    loop:
+      mov 20 b
+      call down
+      sub 1 d
+      jnz loop
+      halt
+    down:
+      sub 1 b
+      jz done
+      call down
+    done:
+      ret
+    """,
+    'stack': """
+      mov 100 c
+    outer:
+      mov 10 d
+    loop:
+      push 1
+      push 2
+      push d
+      pop b
+      pop a
+      push b
+      pop b
+      pop a
+      sub 1 d
+      jnz loop
+      sub 1 c
+      jnz outer
+      halt
+    """,
+    # copy the bytes 128-191 to 192-255 (the addresses wrap around)
+    'memcpy': """
+      mov 50 d
+    outer:
+      mov 64 b
+    copy:
+      mov b c
+      add 127 c
+      load c a
+      add 64 c
+      store c a
+      sub 1 b
+      jnz copy
+      sub 1 d
+      jnz outer
+      halt
+    """,
+    'putc': """
+      mov 50 c
+    outer:
+      mov 100 b
+    inner:
+      putc 'x'
+      sub 1 b
+      jnz inner
+      sub 1 c
+      jnz outer
+      halt
+    """,
+}
+
+def generate_source(lines):
+    "Generate a program using every instruction, with labels and jumps."
+    arguments = {'i': '1', 'r': 'b', 'rr': 'b c'}
+    instructions = []
+    for name, operands, _ in codec:
+        if ',' in operands:
+            continue
+        name = name[:-len(operands)] if operands else name
+        if operands == 'rr':
+            instructions.append(' '.join([name, arguments['rr']]))
+        else:
+            instructions.append(' '.join([name] + [arguments[o] for o in operands]))
+    source = []
+    for i in range(lines):
+        if i % 16 == 0:
+            source.append('l{0}:'.format(i))
+            source.append('jnz l{0}'.format(max(0, i - 16)))
+        else:
+            source.append(instructions[i % len(instructions)])
+    return '\n'.join(source)
+
+def every_instruction():
+    "An assambled instruction for each opcode."
+    instructions = []
+    for opcode, (_, operands, length) in enumerate(codec):
+        if operands == 'rr':
+            instructions.append([opcode, 0x12])
+        else:
+            instructions.append([opcode] + [1] * length)
+    return instructions
+
+def bench_assamble(source):
+    lines = source.count('\n') + 1
+    def fn():
+        assamble(source)
+        return lines
+    return fn
+
+def bench_link(obj):
+    def fn():
+        link(obj)
+        return len(obj)
+    return fn
+
+def bench_disassamble():
+    instructions = every_instruction()
+    def fn():
+        for instruction in instructions:
+            disassamble_insctruction(instruction)
+        return len(instructions)
+    return fn
+
+def bench_run(binary, engine, device):
+    "Benchmark running a binary, the operations are the instructions executed."
+    def fn():
+        machine = Machine(io=device())
+        copy(binary, machine.ram)
+        return engine(machine)
+    return fn
+
+def bench_optimized(binary, count, device):
+    """Benchmark running an optimized binary, the operations are the count
+    instructions the program executes as written."""
+    run = bench_run(binary, Machine.run, device)
+    def fn():
+        run()
+        return count
+    return fn
+
+def bench_console(binary):
+    "Benchmark putc printing each char immediately, on /dev/null."
+    run = bench_run(binary, Machine.run, Console)
+    def fn():
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            return run()
+    return fn
+
+def bench_startup(*command):
+    "Benchmark starting a process with python, the operations are the processes run."
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable] + list(command)
+    def fn():
+        subprocess.run(command, cwd=here, check=True,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        return 1
+    return fn
+
+def suite(null):
+    """The benchmarks, by name: functions returning the number of operations
+    done. The programs print to null (a file open on os.devnull)."""
+    source = generate_source(2000)
+    benchmarks = {
+        'assamble': bench_assamble(source),
+        'link': bench_link(assamble(source)),
+        'disassamble': bench_disassamble(),
+    }
+    def device():
+        return Device(file=null)
+    for name, kernel in kernels.items():
+        binary = link(assamble(kernel))
+        for engine_name, engine in engines.items():
+            benchmarks['run/{0}/{1}'.format(name, engine_name)] = bench_run(binary, engine, device)
+        count = bench_run(binary, Machine.run, device)()
+        benchmarks['run/{0}/optimized'.format(name)] = bench_optimized(
+            link(optimize(assamble(kernel))), count, device)
+    benchmarks['run/putc/console'] = bench_console(link(assamble(kernels['putc'])))
+    benchmarks['startup/python'] = bench_startup('-c', 'pass')
+    benchmarks['startup/import'] = bench_startup('-c', 'import core')
+    benchmarks['startup/emu'] = bench_startup('emu', 'examples/hi.asm')
+    return benchmarks
+
+def speed(fn, rounds=5, seconds=0.1):
+    "Run fn for some rounds of some seconds, return the speeds (operations/second)."
+    speeds = []
+    for _ in range(rounds):
+        operations = 0
+        elapsed = 0
+        while elapsed < seconds:
+            start = time.perf_counter()
+            operations += fn()
+            elapsed += time.perf_counter() - start
+        speeds.append(operations / elapsed)
+    return speeds
+
+def summarize(speeds):
+    return {
+        'mean': statistics.mean(speeds),
+        'stdev': statistics.stdev(speeds) if len(speeds) > 1 else 0.0,
+        'rounds': len(speeds),
+    }
+
+def regressed(result, baseline, tolerance):
+    """A benchmark regressed when it is slower than its baseline by more than
+    tolerance (a fraction), and by more than twice the noise."""
+    loss = baseline['mean'] - result['mean']
+    noise = (result['stdev'] ** 2 + baseline['stdev'] ** 2) ** 0.5
+    return loss > tolerance * baseline['mean'] and loss > 2 * noise
+
+def run_suite(names, rounds, seconds, baseline=None, tolerance=0.1):
+    """Run the benchmarks whose name contains one of names, print them.
+    Return the results and the names of the benchmarks that regressed."""
+    results = {}
+    failed = []
+    with open(os.devnull, 'w') as null:
+        for name, fn in suite(null).items():
+            if names and not any(part in name for part in names):
+                continue
+            result = results[name] = summarize(speed(fn, rounds, seconds))
+            line = '{0:<28} {1:>14,.0f} ops/s {2:>7.1%}'.format(
+                name, result['mean'], result['stdev'] / result['mean'])
+            if baseline is not None and name in baseline:
+                line += ' {0:>+8.1%}'.format(result['mean'] / baseline[name]['mean'] - 1)
+                if regressed(result, baseline[name], tolerance):
+                    line += '  REGRESSION'
+                    failed.append(name)
+            print(line, flush=True)
+    if failed:
+        print("{0} benchmark(s) regressed: {1}".format(len(failed), ', '.join(failed)))
+    return results, failed
+
+def run_examples(paths):
+    "Print how fast each engine runs some programs."
+    print("{0:<24} {1:>12}".format('program', 'instructions') +
+          ''.join(" {0:>16}".format(name + '/s') for name in engines))
+    for path in paths:
+        binary = load(path)
+        speeds = []
+        for engine in engines.values():
+            count, speed = measure(binary, engine)
+            speeds.append(speed)
+        print("{0:<24} {1:>12}".format(path, count) +
+              ''.join(" {0:>16,.0f}".format(speed) for speed in speeds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the assambler, the linker and the machine")
+    parser.add_argument('names', nargs='*', help='only run the benchmarks whose name contains one of these')
+    parser.add_argument('--rounds', type=int, default=5, help='number of measures of each benchmark')
+    parser.add_argument('--seconds', type=float, default=0.1, help='duration of a round')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare to a JSON baseline, fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown allowed by --compare (a fraction)')
+    parser.add_argument('--examples', nargs='*', metavar='PATH', help='measure programs instead (default: examples/*.asm)')
+    args = parser.parse_args()
+    if args.examples is not None:
+        run_examples(args.examples or sorted(glob.glob('examples/*.asm')))
+        sys.exit()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    results, failed = run_suite(args.names, args.rounds, args.seconds, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    sys.exit(1 if failed else 0)
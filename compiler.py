@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+#
+# Run a machine by compiling its basic blocks into python functions
+#
+# A block starts at the address the instruction pointer points to and ends
+# with an instruction that can change the instruction pointer (jumps, call,
+# ret, halt...). It is compiled into a function that keeps the registers in
+# local variables and returns the number of instructions it executed.
+#
+
+import io
+import contextlib
+from core import Machine, operation_table, ram_size, flag_offset, signed
+from core import signed_registers, ip_register, sp_register, accumulator, register_index
+from core import zero_flag, parity_flag, sign_flag, overflow_flag
+from core import arithmetic, logic, immediate, read, write
+from assamble import register_names, codec, decode_arguments, assamble, link
+from alu import div, mod
+from utils import check, clamp, popcount, count_leading_zeros, copy
+
+# The most instructions a block can have
+max_block_length = 64
+
+# How many instructions a block looping on itself executes, at least, before
+# it returns to the engine
+loop_limit = 1 << 16
+
+# What a block returns, with the number of instructions it executed, when
+# it doesn't simply end: "halt", "fallback" (an instruction was executed by
+# the interpreter, it may have written anywhere in ram) or the address of a
+# byte of compiled code it wrote to.
+halt = 'halt'
+fallback = 'fallback'
+
+binary_expressions = {
+    'add': '{x} + {y}',
+    'sub': '{y} - {x}',
+    'mul': '{x} * {y}',
+    'div': 'div({x}, {y})',
+    'mod': 'mod({x}, {y})',
+    'or': '{x} | {y}',
+    'and': '{x} & {y}',
+    'xor': '{x} ^ {y}',
+    'shl': '{x} << {y}',
+    'shr': '{x} >> {y}',
+}
+
+unary_expressions = {
+    'not': '~{x}',
+    'neg': 'clamp(-{x})',
+    'popcount': 'popcount({x})',
+    'clz': 'count_leading_zeros({x})',
+}
+
+conditions = {
+    'jo': 'f[{0}]'.format(overflow_flag),
+    'jno': 'not f[{0}]'.format(overflow_flag),
+    'jpe': 'f[{0}]'.format(parity_flag),
+    'jpo': 'not f[{0}]'.format(parity_flag),
+    'jz': 'f[{0}]'.format(zero_flag),
+    'jnz': 'not f[{0}]'.format(zero_flag),
+    'jl': 'f[{0}]'.format(sign_flag),
+    'jle': 'f[{0}] or f[{1}]'.format(sign_flag, zero_flag),
+    'jge': 'not f[{0}]'.format(sign_flag),
+    'jaz': '{a} == 0',
+}
+
+# The conditions, computed from the pending result of an arithmetic
+# operation (pr) and its clamped value (c)
+arithmetic_conditions = {
+    'jo': 'pr < -255 or pr > 254',
+    'jno': 'not (pr < -255 or pr > 254)',
+    'jpe': "bin(c).count('1') % 2 == 0",
+    'jpo': "bin(c).count('1') % 2 == 1",
+    'jz': 'c == 0',
+    'jnz': 'c != 0',
+    'jl': 'c < 0',
+    'jle': 'c <= 0',
+    'jge': 'c >= 0',
+}
+
+# Compiled code objects, by source (shared by all the engines)
+compiled_sources = {}
+
+# How many code objects to keep at most
+max_compiled_sources = 4096
+
+def compile_source(source, start):
+    "Compile the source of a block, or get it from the cache."
+    code = compiled_sources.get(source)
+    if code is None:
+        if len(compiled_sources) >= max_compiled_sources:
+            compiled_sources.clear()
+        code = compile(source, '<block {0}>'.format(start), 'exec')
+        compiled_sources[source] = code
+    return code
+
+def local(register):
+    "Name of the local variable holding a register."
+    return 'r_' + register_names[register]
+
+class BlockWriter:
+    "Generate the source of the function running one block."
+
+    def __init__(self, ram, start):
+        self.ram = ram
+        self.start = start
+        self.lines = []
+        self.write_backs = []   # where registers are written back, see write_back
+        self.used = set()       # registers loaded in local variables
+        self.written = set()    # registers to write back
+        self.flags = False      # whether the block uses pk and pr
+        self.pending = None     # what pk is known to be, if known
+        self.clamped = False    # whether c is the clamped value of pr
+        self.addresses = set()  # the bytes the block was decoded from
+        self.count = 0          # instructions so far
+        self.loop = False       # whether the block jumps back to its start
+        self.temporaries = 0
+        self.namespace = {}     # what the generated code refers to
+
+    def emit(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    def temporary(self):
+        self.temporaries += 1
+        return 't{0}'.format(self.temporaries)
+
+    def sync_flags(self, indent=1):
+        "Write the pending flags back to the machine."
+        self.flags = True
+        self.emit('m.pending_kind = pk', indent)
+        self.emit('m.pending_result = pr', indent)
+
+    def write_back(self, indent=1):
+        """Write the registers and the flags back to the machine. In a block
+        that loops, the registers written after this point in the previous
+        iteration are written back too: the lines are generated at the end
+        (see expand_write_backs)."""
+        self.emit('<write back {0}>'.format(len(self.write_backs)), indent)
+        self.write_backs.append((set(self.written), self.flags))
+
+    def expand_write_backs(self):
+        lines = []
+        for line in self.lines:
+            if line.endswith('>') and line.lstrip().startswith('<write back '):
+                indent = line[:len(line) - len(line.lstrip())]
+                written, flags = self.write_backs[int(line.split()[-1][:-1])]
+                if self.loop:
+                    written, flags = self.written, self.flags
+                for register in sorted(written):
+                    lines.append('{0}r[{1}] = {2}'.format(indent, register, local(register)))
+                if flags:
+                    lines.append(indent + 'm.pending_kind = pk')
+                    lines.append(indent + 'm.pending_result = pr')
+            else:
+                lines.append(line)
+        return lines
+
+    def exit(self, ip, event='None', indent=1):
+        "Write the registers back and return."
+        self.write_back(indent)
+        self.emit('r[{0}] = {1}'.format(ip_register, ip), indent)
+        self.emit('return n + {0}, {1}'.format(self.count, event), indent)
+
+    def value(self, x, mode):
+        "Expression of the value of an operand."
+        if mode == immediate:
+            return repr(x)
+        if x == ip_register:
+            return repr(self.ip)
+        if x < flag_offset:
+            self.used.add(x)
+            return local(x)
+        # a flag: compute the pending flags first
+        t = self.temporary()
+        self.settle()
+        self.emit('{0} = m.get_flag({1})'.format(t, x - flag_offset))
+        return t
+
+    def settle(self):
+        "Generate the code computing the pending flags."
+        if self.pending == 'settled':
+            return
+        self.emit('if pk is not None:')
+        self.sync_flags(2)
+        self.emit('m.settle_flags()', 2)
+        self.emit('pk = None', 2)
+        self.pending = 'settled'
+
+    def destination(self, register):
+        "Name of the variable to assign to write a register."
+        if register == ip_register:
+            self.jumped = True
+            return 'r_ip'
+        self.used.add(register)
+        self.written.add(register)
+        return local(register)
+
+    def compile(self):
+        "Generate the function's source, return (source, namespace)."
+        ram = self.ram
+        address = self.start
+        while True:
+            opcode = ram[address % ram_size]
+            if opcode >= len(codec) and self.count:
+                # let the interpreter fail on the invalid opcode
+                self.exit(address)
+                break
+            [_, operands, length] = codec[opcode]
+            arguments = [ram[(address + i) % ram_size] for i in range(1, length + 1)]
+            arguments = decode_arguments(arguments, operands)
+            for i in range(length + 1):
+                self.addresses.add((address + i) % ram_size)
+            operation = operation_table[opcode]
+            # the instruction pointer, while the instruction runs
+            self.ip = (address + length) % ram_size if length else address
+            self.next = (address + length + 1) % ram_size
+            self.count += 1
+            self.jumped = False
+            self.ended = False
+
+            if operation is None:
+                self.exit(address, repr(halt))
+                break
+            arguments = arguments + operation.defaults
+            if not self.emit_operation(operation, arguments):
+                self.emit_fallback(operation, arguments)
+                break
+            if self.ended:
+                break
+            if self.jumped:
+                self.emit('if r_ip == {0}:'.format(self.ip))
+                self.emit('r_ip = {0}'.format(self.next), 2)
+                if self.event == 'None':
+                    # loop without leaving the function
+                    self.loop = True
+                    self.emit('if r_ip == {0} and n < loop_limit:'.format(self.start))
+                    self.emit('n += {0}'.format(self.count), 2)
+                    self.emit('continue', 2)
+                self.exit('r_ip', self.event)
+                break
+            if self.count == max_block_length:
+                self.exit(self.next)
+                break
+            address = self.next
+
+        prologue = ['def block(m):', '    n = 0']
+        for register in sorted(self.used):
+            prologue.append('    {0} = r[{1}]'.format(local(register), register))
+        if self.flags:
+            prologue.append('    pk = m.pending_kind')
+            prologue.append('    pr = m.pending_result')
+        lines = self.expand_write_backs()
+        if self.loop:
+            lines = ['    while True:'] + ['    ' + line for line in lines]
+        return '\n'.join(prologue + lines) + '\n', self.namespace
+
+    def emit_operation(self, operation, arguments):
+        """Generate the code of an instruction, return False if it must be
+        executed by the interpreter."""
+        name = operation.name
+        modes = operation.modes
+        if len(arguments) != len(modes):
+            return False
+        for x, mode in zip(arguments, modes):
+            if mode == write and x >= flag_offset:
+                return False
+        if operation.parts:
+            # a superinstruction: generate the code of its parts, unless one
+            # can jump or end the block (writing over code) before the
+            # others run
+            for part, indices in operation.parts[:-1]:
+                if part.name in ['push', 'store', 'call'] or any(
+                        mode == write and arguments[i] == ip_register
+                        for i, mode in zip(indices, part.modes)):
+                    return False
+            for part, indices in operation.parts:
+                self.emit_operation(part, [arguments[i] for i in indices])
+            return True
+        self.event = 'None'
+        values = [self.value(x, mode) if mode != write else None
+                  for x, mode in zip(arguments, modes)]
+
+        if name in binary_expressions:
+            register = arguments[1]
+            y = self.value(register, read)
+            t = self.temporary()
+            self.flags = True
+            self.pending = arithmetic
+            self.emit('{0} = {1}'.format(t, binary_expressions[name].format(x=values[0], y=y)))
+            self.emit('pk = arithmetic')
+            self.emit('pr = {0}'.format(t))
+            self.emit('c = {0} if -128 <= {0} < 128 else clamp({0})'.format(t))
+            self.emit('{0} = c'.format(self.destination(register)))
+            self.clamped = True
+        elif name in unary_expressions:
+            self.emit('{0} = {1}'.format(self.destination(arguments[1]),
+                                         unary_expressions[name].format(x=values[0])))
+        elif name in conditions:
+            if modes[0] != immediate:
+                t = self.temporary()
+                self.emit('{0} = {1}'.format(t, values[0]))
+            if name == 'jaz':
+                condition = conditions[name].format(a=self.value(accumulator, read))
+            elif self.pending is arithmetic:
+                # the flags are still pending, compute only this condition
+                if not self.clamped:
+                    self.emit('c = pr if -128 <= pr < 128 else clamp(pr)')
+                condition = arithmetic_conditions[name]
+            elif self.pending is logic and name not in ['jo', 'jno']:
+                self.emit('c = pr')
+                condition = arithmetic_conditions[name]
+            else:
+                self.settle()
+                condition = conditions[name]
+            if modes[0] == immediate:
+                self.emit_branch(condition, arguments[0])
+            else:
+                self.emit('r_ip = {0} if {1} else {2}'.format(t, condition, self.ip))
+                self.jumped = True
+        elif name == 'getc':
+            self.emit('{0} = m.io.getc()'.format(self.destination(arguments[0])))
+        elif name == 'putc':
+            self.emit('m.io.putc({0})'.format(values[0]))
+        elif name == 'store':
+            t = self.temporary()
+            self.emit('{0} = {1}'.format(t, values[0]))
+            self.emit('ram[{0}] = {1} & 255'.format(t, values[1]))
+            self.emit('if code[{0}]:'.format(t))
+            self.exit(self.next, t, 2)
+        elif name == 'load':
+            self.emit_load(arguments[1], 'ram[{0}]'.format(values[0]))
+        elif name == 'mov':
+            self.emit('{0} = {1}'.format(self.destination(arguments[1]), values[0]))
+        elif name == 'test':
+            self.settle()
+            self.pending = logic
+            self.clamped = False
+            self.emit('pk = logic')
+            self.emit('pr = {0} | {1}'.format(values[0], values[1]))
+        elif name == 'cmp':
+            self.flags = True
+            self.pending = arithmetic
+            self.clamped = False
+            self.emit('pk = arithmetic')
+            self.emit('pr = {1} - {0}'.format(values[0], values[1]))
+        elif name == 'jmp':
+            if modes[0] == immediate:
+                self.emit_branch('True', arguments[0])
+            else:
+                self.emit('r_ip = {0}'.format(values[0]))
+                self.jumped = True
+        elif name == 'push':
+            t = self.temporary()
+            sp = self.destination(sp_register)
+            self.emit('{0} = {1}'.format(t, values[0]))
+            self.emit('{0} = ({0} - 1) % 256'.format(sp))
+            self.emit('ram[{0}] = {1} & 255'.format(sp, t))
+            self.emit('if code[{0}]:'.format(sp))
+            self.exit(self.next, sp, 2)
+        elif name == 'pop':
+            sp = self.destination(sp_register)
+            self.emit('{0} = ({0} + 1) % 256'.format(sp))
+            self.emit_load(arguments[0], 'ram[{0} - 1]'.format(sp))
+        elif name == 'call':
+            t = self.temporary()
+            sp = self.destination(sp_register)
+            self.emit('{0} = {1}'.format(t, values[0]))
+            self.emit('{0} = ({0} - 1) % 256'.format(sp))
+            self.emit('ram[{0}] = {1}'.format(sp, self.ip & 255))
+            self.emit('r_ip = {0}'.format(t))
+            self.event = '{0} if code[{0}] else None'.format(sp)
+            self.jumped = True
+        elif name == 'ret':
+            sp = self.destination(sp_register)
+            self.emit('{0} = ({0} + 1) % 256'.format(sp))
+            self.emit_load(ip_register, 'ram[{0} - 1]'.format(sp))
+        else:
+            return False
+        return True
+
+    def emit_branch(self, condition, target):
+        "Generate a jump to a known target, and end the block."
+        if target == self.ip:
+            # not a jump, see Machine.run
+            target = self.next
+        if target == self.start:
+            self.loop = True
+            self.emit('if {0} and n < loop_limit:'.format(condition))
+            self.emit('n += {0}'.format(self.count), 2)
+            self.emit('continue', 2)
+        if condition != 'True':
+            self.emit('if {0}:'.format(condition))
+            self.exit(target, indent=2)
+        self.exit(self.next if condition != 'True' else target)
+        self.ended = True
+
+    def emit_load(self, register, byte):
+        "Generate the code of load_register."
+        if register in signed_registers:
+            byte = 'signed[{0}]'.format(byte)
+        self.emit('{0} = {1}'.format(self.destination(register), byte))
+
+    def emit_fallback(self, operation, arguments):
+        "Let the interpreter execute an instruction, and end the block."
+        handler = 'handler{0}'.format(self.count)
+        self.namespace[handler] = operation.handler(arguments)
+        self.write_back()
+        self.emit('r[{0}] = {1}'.format(ip_register, self.ip))
+        self.emit('{0}(m, {1})'.format(handler, ', '.join(map(repr, arguments))))
+        self.emit('if r[{0}] == {1}:'.format(ip_register, self.ip))
+        self.emit('r[{0}] = {1}'.format(ip_register, self.next), 2)
+        self.emit('return n + {0}, fallback'.format(self.count))
+
+class BlockEngine:
+    """Run a machine by compiling its basic blocks.
+
+    The compiled blocks are cached by start address, and forgotten when
+    something is stored over the bytes they were decoded from."""
+
+    __slots__ = ('machine', 'namespace', 'blocks', 'extents', 'owners', 'code')
+
+    def __init__(self, machine, loop_limit=loop_limit):
+        self.machine = machine
+        self.namespace = {
+            'ram': machine.ram, 'r': machine.registers,
+            'f': machine.flags, 'signed': signed, 'clamp': clamp,
+            'div': div, 'mod': mod, 'popcount': popcount,
+            'count_leading_zeros': count_leading_zeros,
+            'arithmetic': arithmetic, 'logic': logic, 'fallback': fallback,
+            'loop_limit': loop_limit,
+        }
+        self.blocks = {}    # functions, by start address
+        self.extents = {}   # bytes decoded, by start address
+        # the start addresses of the blocks using each byte
+        self.owners = [set() for _ in range(ram_size)]
+        # 1 for each byte used by a block
+        self.code = bytearray(ram_size)
+        self.namespace['code'] = self.code
+
+    def compile(self, start):
+        "Compile the block starting at start."
+        writer = BlockWriter(self.machine.ram, start)
+        source, namespace = writer.compile()
+        namespace.update(self.namespace)
+        exec(compile_source(source, start), namespace)
+        block = self.blocks[start] = namespace['block']
+        self.extents[start] = writer.addresses
+        for address in writer.addresses:
+            self.owners[address].add(start)
+            self.code[address] = 1
+        return block
+
+    def forget(self, start):
+        "Forget the block starting at start."
+        del self.blocks[start]
+        for address in self.extents.pop(start):
+            owners = self.owners[address]
+            owners.discard(start)
+            if not owners:
+                self.code[address] = 0
+
+    def invalidate(self, address):
+        "Forget the blocks that use the byte at address."
+        for start in list(self.owners[address % ram_size]):
+            self.forget(start)
+
+    def invalidate_all(self):
+        for start in list(self.blocks):
+            self.forget(start)
+
+    def run(self, limit=None):
+        """Run until halt, returning the number of instructions executed.
+        With limit, return once at least limit instructions were executed
+        (at the end of a block) or the machine halted, see halted()."""
+        m = self.machine
+        if m.trace and limit is None:
+            return m.run()
+        self.invalidate_all()
+        blocks = self.blocks
+        registers = m.registers
+        count = 0
+        while limit is None or count < limit:
+            ip = registers[ip_register]
+            block = blocks.get(ip)
+            if block is None:
+                block = self.compile(ip)
+            n, event = block(m)
+            count += n
+            if event is not None:
+                if event is halt:
+                    m.settle_flags()
+                    m.io.flush()
+                    return count
+                if event is fallback:
+                    self.invalidate_all()
+                else:
+                    self.invalidate(event)
+        return count
+
+    def halted(self):
+        "Whether the next instruction is halt."
+        opcode = self.machine.ram[self.machine.registers[ip_register]]
+        return opcode < len(operation_table) and operation_table[opcode] is None
+
+def run(machine):
+    "Run a machine with compiled blocks, returning the number of instructions executed."
+    return BlockEngine(machine).run()
+
+###############################################################
+
+def run_both(source):
+    "Run a program with the interpreter and compiled, check they agree."
+    binary = link(assamble(source))
+    results = []
+    for engine in [Machine.run, run]:
+        m = Machine()
+        copy(binary, m.ram)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            count = engine(m)
+        results.append((count, output.getvalue(), bytes(m.ram),
+                        m.registers, m.flags))
+    check(results[0] == results[1])
+    return results[1]
+
+def test_examples():
+    for name in ['hi', 'call_ret', 'stack', 'count']:
+        with open('examples/{0}.asm'.format(name)) as file:
+            run_both(file.read())
+
+def test_self_modifying():
+    # replace putc by halt
+    (_, output, *_) = run_both("""
+    mov 'a'
+    store patch 0
+    patch:
+    putc
+    putc
+    halt
+    """)
+    check(output == '')
+
+    # replace a block that was already compiled
+    (_, output, *_) = run_both("""
+    mov 3 b
+    loop:
+    putc 'x'
+    sub 1 b
+    jnz loop
+    store loop 0
+    jmp loop
+    """)
+    check(output == 'xxx')
+
+    # a block looping on itself writes the registers of the previous
+    # iteration back when it ends early (writing over its code)
+    (_, _, _, registers, _) = run_both("""
+    mov 3 b
+    mov loop c
+    mov here d
+    add 101 d
+    loop:
+    store d c
+    sub 50 d
+    sub 1 b
+    here:
+    jnz loop
+    halt
+    """)
+    check(registers[register_index['b']] == 0)
+
+def test_flags():
+    run_both("""
+    mov 100
+    mul 100
+    test a
+    jo overflow
+    putc 'n'
+    overflow:
+    mov zf b
+    mov of c
+    cmp 3
+    jle end
+    putc 'y'
+    end:
+    halt
+    """)
+
+def test_superinstructions():
+    (_, output, *_) = run_both("""
+    mov 3 b
+    loop:
+    movputc 'x'
+    pushpop b c
+    mov c a
+    cmpjz 1 last
+    cmpjnz 2 next
+    last:
+    movputc '!' d
+    cmpjge d next
+    putc 'y'
+    next:
+    subjnz 1 b loop
+    pushpop 7 d
+    halt
+    """)
+    check(output == 'xx!yx!y')
+
+    # jumping in the first part, writing over the block in the first part
+    (_, output, *_) = run_both("movputc 5 ip\nhalt\nhalt\nputc 'y'\nhalt")
+    check(output == '\x05y')
+    (_, _, ram, registers, _) = run_both("pop\npushpop\nhalt")
+    check(registers[sp_register] == 1)
+
+if __name__ == '__main__':
+    test_examples()
+    test_self_modifying()
+    test_flags()
+    test_superinstructions()
+    print()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+# Input and output devices, behind the instructions getc and putc
+#
+# A device has the methods getc() (returns a byte), putc(value), flush()
+# (called on halt) and close(). The machines use Console by default.
+#
+
+import os
+import sys
+import io
+import copy
+from utils import getchar, putchar, check
+
+class Console:
+    "The terminal, read one keypress at a time, every char printed at once."
+
+    def getc(self):
+        return getchar()
+
+    def putc(self, value):
+        putchar(value)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def tell(self):
+        "The position in the input, None as it can't be known."
+        return None
+
+    def fork(self):
+        return self
+
+class BytesInput:
+    """Read from bytes (or a string) in memory. data may be the part of a
+    longer input starting at start (see StreamInput)."""
+
+    def __init__(self, data=b''):
+        if isinstance(data, str):
+            data = data.encode()
+        self.data = data
+        self.position = 0   # in data
+        self.start = 0      # of data, in the whole input
+
+    def read(self):
+        if self.position >= len(self.data):
+            raise EOFError("end of input")
+        self.position += 1
+        return self.data[self.position - 1]
+
+    def tell(self):
+        "The position in the whole input."
+        return self.start + self.position
+
+    def seek(self, position):
+        "Go to a position in the whole input, data must still have it."
+        if not self.start <= position <= self.start + len(self.data):
+            raise ValueError("position {0} of the input is not kept anymore".format(position))
+        self.position = position - self.start
+
+    def fork(self):
+        "A copy reading the same input from the same position."
+        return copy.copy(self)
+
+    def close(self):
+        pass
+
+class StreamInput(BytesInput):
+    "Read from a file descriptor (a pipe, a file...), a chunk at a time."
+
+    def __init__(self, fd, size=4096):
+        super().__init__()
+        self.fd = fd
+        self.size = size
+
+    def read(self):
+        if self.position >= len(self.data):
+            self.start += len(self.data)
+            self.data = os.read(self.fd, self.size)
+            self.position = 0
+        return super().read()
+
+    def fork(self):
+        raise ValueError("can't fork the input of a file descriptor, the forks would share it")
+
+class TerminalInput(StreamInput):
+    "Read keypresses, the terminal stays in raw mode until close()."
+
+    def __init__(self, fd):
+        import tty, termios
+        super().__init__(fd, 1)
+        self.mode = termios.tcgetattr(fd)
+        tty.setraw(fd)
+        # keep translating '\n' into '\r\n' when printing, and Ctrl-C into
+        # SIGINT (to stop a program that doesn't read)
+        mode = termios.tcgetattr(fd)
+        mode[1] |= termios.OPOST
+        mode[3] |= termios.ISIG
+        termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+
+    def close(self):
+        import termios
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.mode)
+
+class Device:
+    """Read from an input (BytesInput, StreamInput or TerminalInput), write to
+    a text file. The output is buffered, it is written on flush(), when
+    size chars are waiting and, with line_buffered, after each newline."""
+
+    def __init__(self, input=None, file=None, size=4096, line_buffered=True):
+        self.input = BytesInput() if input is None else input
+        self.file = sys.stdout if file is None else file
+        self.size = size
+        self.line_buffered = line_buffered
+        self.buffer = []
+
+    def getc(self):
+        return self.input.read()
+
+    def putc(self, value):
+        self.buffer.append(chr(value))
+        if len(self.buffer) >= self.size or (self.line_buffered and value == 10):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.input.close()
+
+    def tell(self):
+        "The position in the input."
+        return self.input.tell()
+
+    def seek(self, position):
+        self.input.seek(position)
+
+    def fork(self):
+        """A copy of the device, reading the same input from the same position.
+        A captured output (a StringIO) is copied too, other files are shared.
+        Raise ValueError for a StreamInput."""
+        file = self.file
+        if isinstance(file, io.StringIO):
+            file = io.StringIO(file.getvalue())
+            file.seek(0, io.SEEK_END)
+        child = Device(self.input.fork(), file, self.size, self.line_buffered)
+        child.buffer = list(self.buffer)
+        return child
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+class Terminal(Device):
+    "Interactive: the output is written before waiting for a keypress."
+
+    def __init__(self, fd=None, file=None):
+        fd = sys.stdin.fileno() if fd is None else fd
+        super().__init__(TerminalInput(fd), file)
+
+    def getc(self):
+        self.flush()
+        return super().getc()
+
+def open_console(interactive=None):
+    """The device for stdin and stdout: a Terminal when stdin is a terminal
+    (or interactive is true), otherwise read the input in bulk."""
+    fd = sys.stdin.fileno()
+    if interactive is None:
+        interactive = os.isatty(fd)
+    if interactive:
+        return Terminal(fd)
+    return Device(StreamInput(fd))
+
+def capture(data=b''):
+    "A device reading data, its output is in device.file.getvalue()."
+    return Device(BytesInput(data), io.StringIO())
+
+###############################################################
+
+def test_bytes_input():
+    device = capture('hi')
+    check(device.getc() == ord('h'))
+    check(device.getc() == ord('i'))
+    try:
+        device.getc()
+        check(False)
+    except EOFError:
+        check(True)
+
+def test_stream_input():
+    read, write = os.pipe()
+    os.write(write, b'abc')
+    os.close(write)
+    device = Device(StreamInput(read, 2), io.StringIO())
+    check([device.getc() for _ in range(3)] == [97, 98, 99])
+    try:
+        device.getc()
+        check(False)
+    except EOFError:
+        check(True)
+    os.close(read)
+
+def test_stream_position():
+    # the position counts from the start of the stream, not of the chunk
+    read, write = os.pipe()
+    os.write(write, b'abcde')
+    os.close(write)
+    device = Device(StreamInput(read, 2), io.StringIO())
+    check([device.getc() for _ in range(3)] == [97, 98, 99])
+    check(device.tell() == 3)
+    device.seek(2)
+    check(device.getc() == ord('c'))
+    # the bytes of the previous chunks are gone
+    for position in [1, 5]:
+        try:
+            device.seek(position)
+            check(False)
+        except ValueError:
+            check(device.tell() == 3)
+    # forks would steal each other's bytes
+    try:
+        device.fork()
+        check(False)
+    except ValueError:
+        check(True)
+    os.close(read)
+
+def test_terminal():
+    import pty, termios
+    master, slave = pty.openpty()
+    mode = termios.tcgetattr(slave)
+    terminal = TerminalInput(slave)
+    raw = termios.tcgetattr(slave)
+    # one keypress at a time, not echoed, but Ctrl-C still interrupts
+    check(not raw[3] & (termios.ICANON | termios.ECHO))
+    check(raw[3] & termios.ISIG and raw[1] & termios.OPOST)
+    os.write(master, b'x')
+    check(terminal.read() == ord('x'))
+    terminal.close()
+    check(termios.tcgetattr(slave) == mode)
+    os.close(master)
+    os.close(slave)
+
+def test_buffering():
+    device = Device(file=io.StringIO(), size=3, line_buffered=False)
+    device.putc(ord('a'))
+    device.putc(ord('\n'))
+    check(device.file.getvalue() == '')
+    device.putc(ord('b'))
+    check(device.file.getvalue() == 'a\nb')
+    device.putc(ord('c'))
+    device.flush()
+    check(device.file.getvalue() == 'a\nbc')
+
+    device = capture()
+    device.putc(ord('a'))
+    device.putc(ord('\n'))
+    check(device.file.getvalue() == 'a\n')
+
+def test_fork():
+    device = capture('abc')
+    device.getc()
+    device.putc(ord('x'))
+    child = device.fork()
+    check(child.getc() == ord('b') and device.tell() == 1)
+    child.putc(ord('y'))
+    child.flush()
+    device.flush()
+    check(device.file.getvalue() == 'x')
+    check(child.file.getvalue() == 'xy')
+    device.seek(0)
+    check(device.getc() == ord('a'))
+
+def test_machine():
+    from core import Machine
+    from assamble import assamble, link
+    from utils import copy
+    with open('examples/echo.asm') as file:
+        binary = link(assamble(file.read()))
+    machine = Machine(io=capture('hi\rq'))
+    copy(binary, machine.ram)
+    machine.run()
+    check(machine.io.file.getvalue() == 'hi\r\nq')
+
+if __name__ == '__main__':
+    test_bytes_input()
+    test_stream_input()
+    test_stream_position()
+    test_terminal()
+    test_buffering()
+    test_fork()
+    test_machine()
+    print()
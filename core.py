@@ -4,16 +4,49 @@
 #
 
 import sys
-from assamble import register_names, flag_names, opcodes, codec
-from assamble import assamble, disassamble_insctruction
-from utils import getchar, putchar, check, clamp, overflows
-from utils import popcount, count_leading_zeros, copy
+import struct
+from collections.abc import MutableMapping
+from assamble import register_names, flag_names, register_codec, opcodes, codec
+from assamble import assamble, link, decode_arguments
+from utils import check, clamp, overflows, params, copy
+from console import Console, capture
+import tracing
+from tracing import printing_tracer
+from alu import binary_operations, unary_operations, binary_table, unary_table
+from alu import zero_bit, parity_bit, sign_bit, overflow_bit, error_bit
+from alu import size as table_size, origin as table_origin, unary_origin
 
 ram_size = 256
-ram = None
-registers = None
-flags = None
-trace = False
+
+# The longest instruction, in bytes (opcode included)
+longest_instruction = 1 + max(length for (_, _, length) in codec)
+
+# Position of each register and flag in Machine.registers and Machine.flags
+register_index = {name: i for i, name in enumerate(register_names)}
+flag_index = {name: i for i, name in enumerate(flag_names)}
+
+# The flags come after the registers in register_codec
+flag_offset = len(register_names)
+
+accumulator = register_index['a']
+ip_register = register_index['ip']
+sp_register = register_index['sp']
+
+zero_flag = flag_index['zf']
+parity_flag = flag_index['pf']
+sign_flag = flag_index['sf']
+overflow_flag = flag_index['of']
+
+# What the flags left pending by the last operation are computed from
+arithmetic = 'arithmetic'   # zf, pf, sf and of, from the unclamped result
+logic = 'logic'             # zf, pf and sf (test)
+packed = 'packed'           # zf, pf, sf and of, packed as in the alu tables
+
+# The registers that behave as 2's complement integers
+signed_registers = [register_index[name] for name in ['a', 'b', 'c', 'd']]
+
+# Interpret a byte as a 2's complement integer
+signed = [x - 256 if x > 127 else x for x in range(256)]
 
 def with_trace(fn):
     "decorator to enable some tracing during the tests"
@@ -27,36 +60,713 @@ def with_trace(fn):
             trace = old_trace
     return fn_with_trace
 
-def reset():
+###########################################################
+################### Operations ############################
+###########################################################
+
+# -[x] add
+# -[x] and
+# -[x] div
+# -[x] getc
+# -[x] load
+# -[x] mod
+# -[x] mov
+# -[x] mul
+# -[x] neg
+# -[x] not
+# -[x] or
+# -[x] popcount
+# -[x] putc
+# -[ ] rcl
+# -[ ] rcr
+# -[ ] rol
+# -[ ] ror
+# -[x] shl
+# -[x] shr
+# -[x] store
+# -[x] sub
+# -[x] xor
+
+def unary_op(name):
+    fn = unary_operations[name]
+    def op(self, value='a', register='a'):
+        self.set_register(register, fn(value))
+    return op
+
+def binary_op(name):
+    fn = binary_operations[name]
+    def op(self, value='a', register='a'):
+        result = fn(value, self.registers[register])
+        if self.lazy_flags and not self.trace:
+            self.pending_kind = arithmetic
+            self.pending_result = result
+            self.set_register(register, clamp(result))
+            return
+        overflow_p = overflows(result)
+        result = clamp(result)
+        self.set_flags(result)
+        self.set_flag(overflow_flag, overflow_p)
+        self.set_register(register, result)
+    return op
+
+def unary_table_op(name):
+    """Like unary_op, looking the result up in the table of the operation.
+    The values the tables don't cover (see alu.operands) are computed."""
+    table = unary_table(name)
+    computed = unary_op(name)
+    def op(self, value='a', register='a'):
+        if not -128 <= value <= 255:
+            return computed(self, value, register)
+        self.set_register(register, table[value + unary_origin])
+    return op
+
+def binary_table_op(name):
+    """Like binary_op, looking the result and the flags up in the tables of
+    the operation, bound once here. The operands the tables don't cover, and
+    the ones raising an error (negative shifts), are computed."""
+    results, flags = binary_table(name)
+    width = table_size
+    computed = binary_op(name)
+    raises = error_bit in flags
+    def op(self, value='a', register='a'):
+        y = self.registers[register]
+        if not (-128 <= value <= 255 and -128 <= y <= 255):
+            return computed(self, value, register)
+        i = value * width + y + table_origin
+        bits = flags[i]
+        if raises and bits == error_bit:
+            return computed(self, value, register)
+        if self.lazy_flags and not self.trace:
+            self.pending_kind = packed
+            self.pending_result = bits
+        else:
+            self.set_packed_flags(bits)
+        self.set_register(register, results[i])
+    return op
+
+def jump_if(doc, condition):
+    def conditional_jump(self, value='a'):
+        doc
+        if self.pending_kind is not None:
+            self.settle_flags()
+        if condition(self):
+            if self.trace:
+                self.trace.emit(tracing.branch, 1, value)
+            self.set_register(ip_register, value)
+        elif self.trace:
+            self.trace.emit(tracing.branch, 0, value)
+    return conditional_jump
+
+def compare_and_jump(jump):
+    def compare_and_jump(self, x, target, y='a'):
+        "cmp, then a conditional jump"
+        self.op_cmp(x, y)
+        jump(self, target)
+    return compare_and_jump
+
+class Machine:
+    """The whole state of one virtual machine.
+
+    The registers and the flags are lists, in the same order as
+    register_names and flag_names.
+
+    With lazy_flags, the arithmetic operations only record their result,
+    the flags are computed when something reads them. Call settle_flags()
+    before accessing the list of flags directly.
+
+    With alu_tables, the arithmetic operations look up their results and
+    flags in the precomputed tables of the module alu (see
+    table_operation_table), superinstructions excepted.
+
+    The methods take numbers only: registers and flags are referred to by
+    their index. The op_* methods take the values of their operands, except
+    for "register", which is the index of the register to write to. Their
+    defaults tell which register an instruction uses when an operand is
+    omitted, they're resolved when decoding (see operation_table).
+
+    getc and putc go through io, a device (see the module console).
+
+    ram is a bytearray by default, or any writable buffer of ram_size bytes
+    with int items, like the memoryview of a mapped file (see memory)."""
+
+    __slots__ = ('ram', 'registers', 'flags', 'decoded', 'trace',
+                 'lazy_flags', 'pending_kind', 'pending_result', 'alu_tables',
+                 'operations', 'io')
+
+    def __init__(self, lazy_flags=True, alu_tables=False, io=None, ram=None):
+        if ram is not None and len(ram) != ram_size:
+            raise ValueError("the ram must have {0} bytes".format(ram_size))
+        self.ram = bytearray(ram_size) if ram is None else ram
+        self.registers = [0] * len(register_names)
+        self.flags = [False] * len(flag_names)
+        # decoded instructions, indexed by address
+        self.decoded = [None] * ram_size
+        # a tracing.Tracer, or None
+        self.trace = None
+        self.lazy_flags = lazy_flags
+        # the flags that are not computed yet: None, arithmetic or logic
+        self.pending_kind = None
+        self.pending_result = 0
+        self.alu_tables = alu_tables
+        # how to execute each opcode
+        self.operations = table_operation_table() if alu_tables else operation_table
+        self.io = Console() if io is None else io
+
+    def dump(self):
+        self.settle_flags()
+        print(list(self.ram))
+        print(dict(zip(register_names, self.registers)))
+        print(dict(zip(flag_names, self.flags)))
+
+    def get_register(self, register):
+        "Get a register's content."
+        return self.registers[register]
+
+    def get_flag(self, flag):
+        "Get a flag's value"
+        if self.pending_kind is not None:
+            self.settle_flags()
+        return 1 if self.flags[flag] else 0
+
+    def read(self, index):
+        "Get a register or a flag's value, given its index in register_codec."
+        if index < flag_offset:
+            return self.registers[index]
+        return self.get_flag(index - flag_offset)
+
+    def get_ram(self, address):
+        return self.ram[address]
+
+    def set_register(self, register, value):
+        "Set a register"
+        if self.trace:
+            self.trace.emit(tracing.register, register, value)
+        self.registers[register] = value
+
+    def load_register(self, register, byte):
+        "Set a register to a byte read from ram."
+        if register in signed_registers:
+            byte = signed[byte]
+        self.set_register(register, byte)
+
+    def set_flag(self, flag, value):
+        if self.pending_kind is not None:
+            self.settle_flags()
+        p = not (value == 0)
+        if self.trace and self.flags[flag] != p:
+            self.trace.emit(tracing.flag, flag, int(p))
+        self.flags[flag] = p
+
+    def set_ram(self, address, value):
+        "Write the lowest byte of value in ram."
+        if self.trace:
+            self.trace.emit(tracing.memory, address, value)
+        self.ram[address] = value & 0xFF
+        self.invalidate(address)
+
+    def invalidate(self, address):
+        "Forget the decoded instructions that overlap a given address."
+        decoded = self.decoded
+        for start in range(address - longest_instruction + 1, address + 1):
+            decoded[start % ram_size] = None
+
+    def invalidate_all(self):
+        "Forget every decoded instruction (e.g. after writing to ram directly)."
+        self.decoded[:] = [None] * ram_size
+
+    def inc(self, register, n=1):
+        "Increment a register, returning the new value"
+        new_value = (self.registers[register] + n) % 256
+        self.set_register(register, new_value)
+        return new_value
+
+    def dec(self, register, n=1):
+        "Decrement a register, returning the new value"
+        return self.inc(register, -n)
+
+    def inc_ip(self, n=1):
+        "Increment the instruction pointer, returning the new value"
+        return self.inc(ip_register, n)
+
+    def set_flags(self, x):
+        "set the flags based on a given value"
+        self.set_flag(zero_flag, x == 0)
+        self.set_flag(parity_flag, bin(x)[2:].count('1') % 2 == 0)
+        self.set_flag(sign_flag, x < 0)
+
+    def set_packed_flags(self, bits):
+        "set the flags packed as in the alu tables"
+        self.set_flag(zero_flag, bits & zero_bit)
+        self.set_flag(parity_flag, bits & parity_bit)
+        self.set_flag(sign_flag, bits & sign_bit)
+        self.set_flag(overflow_flag, bits & overflow_bit)
+
+    def settle_flags(self):
+        "Compute the flags left pending by the last operation."
+        kind = self.pending_kind
+        if kind is None:
+            return
+        self.pending_kind = None
+        flags = self.flags
+        x = self.pending_result
+        if kind is packed:
+            flags[zero_flag] = x & zero_bit != 0
+            flags[parity_flag] = x & parity_bit != 0
+            flags[sign_flag] = x & sign_bit != 0
+            flags[overflow_flag] = x & overflow_bit != 0
+            return
+        if kind is arithmetic:
+            flags[overflow_flag] = overflows(x)
+            x = clamp(x)
+        flags[zero_flag] = x == 0
+        flags[parity_flag] = bin(x)[2:].count('1') % 2 == 0
+        flags[sign_flag] = x < 0
+
+    ########################################################
+
+    def op_getc(self, register='a'):
+        if self.trace:
+            self.trace.emit(tracing.getc, register, 0)
+        self.set_register(register, self.io.getc())
+
+    def op_putc(self, value='a'):
+        if self.trace:
+            self.trace.emit(tracing.putc, value)
+        self.io.putc(value)
+
+    op_not = unary_op('not')
+    op_neg = unary_op('neg')
+
+    op_popcount = unary_op('popcount')
+    op_clz = unary_op('clz')
+
+    op_add = binary_op('add')
+    op_sub = binary_op('sub')
+    op_mul = binary_op('mul')
+    op_div = binary_op('div')
+    op_mod = binary_op('mod')
+
+    op_or = binary_op('or')
+    op_and = binary_op('and')
+    op_xor = binary_op('xor')
+
+    op_shl = binary_op('shl')
+    op_shr = binary_op('shr')
+
+    def op_store(self, address, value='a'):
+        self.set_ram(address, value)
+
+    def op_load(self, address='a', register='a'):
+        self.load_register(register, self.ram[address])
+
+    def op_mov(self, value='a', register='a'):
+        self.set_register(register, value)
+
+    def op_test(self, x, y='a'):
+        if self.lazy_flags and not self.trace:
+            if self.pending_kind is not None:
+                # test doesn't change the overflow flag
+                self.settle_flags()
+            self.pending_kind = logic
+            self.pending_result = x | y
+            return
+        self.set_flags(x | y)
+
+    def op_cmp(self, x, y='a'):
+        result = y - x
+        if self.lazy_flags and not self.trace:
+            self.pending_kind = arithmetic
+            self.pending_result = result
+            return
+        overflow_p = overflows(result)
+        result = clamp(result)
+        if self.trace:
+            self.trace.emit(tracing.compare, x, y)
+        self.set_flags(result)
+        self.set_flag(overflow_flag, overflow_p)
+
+    def op_jmp(self, value='a'):
+        "unconditional jump"
+        self.set_register(ip_register, value)
+
+    op_jo = jump_if("jump if overflow", lambda m: m.flags[overflow_flag])
+    op_jno = jump_if("jump if not overflow", lambda m: not m.flags[overflow_flag])
+    op_jpe = jump_if("jump if parity is even", lambda m: m.flags[parity_flag])
+    op_jpo = jump_if("jump if parity is odd", lambda m: not m.flags[parity_flag])
+
+    op_jz = jump_if("jump if zero", lambda m: m.flags[zero_flag])
+    op_jnz = jump_if("jump if not zero", lambda m: not m.flags[zero_flag])
+    op_jl = jump_if("jump if less", lambda m: m.flags[sign_flag])
+    op_jle = jump_if("jump if less or equal",
+            lambda m: m.flags[sign_flag] or m.flags[zero_flag])
+    op_jge = jump_if("jump if greater or equal", lambda m: not m.flags[sign_flag])
+    op_jaz = jump_if("jump if accumulator is zero",
+            lambda m: m.registers[accumulator] == 0)
+
+    def op_push(self, value='a'):
+        stack_pointer = self.dec(sp_register) # it grows downward
+        self.set_ram(stack_pointer, value)
+
+    def op_pop(self, register='a'):
+        stack_pointer = self.inc(sp_register)
+        self.load_register(register, self.ram[stack_pointer - 1])
+
+    def op_call(self, value='a'):
+        self.op_push(self.registers[ip_register])
+        self.op_jmp(value)
+
+    def op_ret(self):
+        self.op_pop(ip_register)
+
+    # Superinstructions: two instructions in one, see superinstructions
+
+    op_cmpjo = compare_and_jump(op_jo)
+    op_cmpjno = compare_and_jump(op_jno)
+    op_cmpjpe = compare_and_jump(op_jpe)
+    op_cmpjpo = compare_and_jump(op_jpo)
+
+    op_cmpjz = compare_and_jump(op_jz)
+    op_cmpjnz = compare_and_jump(op_jnz)
+    op_cmpjl = compare_and_jump(op_jl)
+    op_cmpjle = compare_and_jump(op_jle)
+    op_cmpjge = compare_and_jump(op_jge)
+    op_cmpjaz = compare_and_jump(op_jaz)
+
+    def op_subjnz(self, value, register, target):
+        "sub, then jnz"
+        if self.trace or not self.lazy_flags:
+            self.op_sub(value, register)
+            self.op_jnz(target)
+            return
+        # the flags stay pending, only zf is needed
+        result = self.registers[register] - value
+        self.pending_kind = arithmetic
+        self.pending_result = result
+        result = clamp(result)
+        self.set_register(register, result)
+        if result != 0:
+            self.set_register(ip_register, target)
+
+    def op_pushpop(self, value='a', register='a'):
+        "push, then pop"
+        self.op_push(value)
+        self.op_pop(register)
+
+    def op_movputc(self, value='a', register='a'):
+        "mov, then putc the register"
+        self.op_mov(value, register)
+        self.op_putc(self.registers[register])
+
+    ########################################################
+
+    def decode(self, address):
+        """Decode the instruction starting at address.
+
+        Returns a tuple (fn, arguments, length), where length is the number
+        of bytes following the opcode and fn is None for halt. The result is
+        cached until a write to ram overlaps the instruction."""
+        entry = self.decoded[address]
+        if entry is None:
+            ram = self.ram
+            opcode = ram[address]
+            [_, operands, length] = codec[opcode]
+            arguments = [ram[(address + i) % ram_size] for i in range(1, length + 1)]
+            arguments = decode_arguments(arguments, operands)
+            operation = self.operations[opcode]
+            if operation is None:
+                entry = (None, arguments, length)
+            else:
+                entry = (operation.handler(arguments), arguments + operation.defaults, length)
+            self.decoded[address] = entry
+        return entry
+
+    def run(self):
+        "Run until halt, returning the number of instructions executed."
+        self.invalidate_all()
+        registers = self.registers
+        count = 0
+        while True:
+            count += 1
+            ip = registers[ip_register]
+            fn, arguments, length = self.decode(ip)
+            if self.trace:
+                trace = self.trace
+                trace.start(count)
+                for i in range(length + 1):
+                    address = (ip + i) % ram_size
+                    trace.emit(tracing.fetch, address, self.ram[address])
+                trace.emit(tracing.decode, ip, self.ram[ip])
+
+            if fn is None:
+                self.settle_flags()
+                self.io.flush()
+                return count
+
+            # The instruction pointer is on the last byte of the instruction
+            # while it executes.
+            if length:
+                self.inc_ip(length)
+
+            old_ip = registers[ip_register]
+            fn(self, *arguments)
+
+            if old_ip == registers[ip_register]:
+                self.inc_ip()
+
+    def step(self):
+        """Execute one instruction, without tracing it. Return False, without
+        executing anything, when the instruction is halt."""
+        registers = self.registers
+        fn, arguments, length = self.decode(registers[ip_register])
+        if fn is None:
+            self.settle_flags()
+            return False
+        if length:
+            self.inc_ip(length)
+        old_ip = registers[ip_register]
+        fn(self, *arguments)
+        if old_ip == registers[ip_register]:
+            self.inc_ip()
+        return True
+
+    def snapshot(self):
+        """The whole state of the machine (ram, registers, flags and position
+        in the input) as bytes, see restore()."""
+        self.settle_flags()
+        flags = sum(1 << i for i, flag in enumerate(self.flags) if flag)
+        tell = getattr(self.io, 'tell', None)
+        position = tell() if tell is not None else None
+        return snapshot_format.pack(bytes(self.ram), *self.registers, flags,
+                                    -1 if position is None else position)
+
+    def restore(self, snapshot):
+        "Go back to the state saved by snapshot()."
+        [ram, *registers, flags, position] = snapshot_format.unpack(snapshot)
+        self.ram[:] = ram
+        self.registers[:] = registers
+        self.flags[:] = [bool(flags >> i & 1) for i in range(len(flag_names))]
+        self.pending_kind = None
+        self.invalidate_all()
+        if position >= 0:
+            self.io.seek(position)
+
+    def fork(self):
+        """Make an independent copy of the machine, its device is forked
+        too when it can be. The copy's ram is a bytearray."""
+        fork = getattr(self.io, 'fork', None)
+        child = Machine(self.lazy_flags, self.alu_tables,
+                        self.io if fork is None else fork())
+        child.restore(self.snapshot())
+        child.trace = self.trace
+        return child
+
+# ram, registers, flags (a bit each) and input position (-1 when unknown)
+snapshot_format = struct.Struct('<{0}s{1}qBq'.format(ram_size, len(register_names)))
+
+###########################################################
+################### Dispatch ##############################
+###########################################################
+
+# How the operands of an instruction are passed to an op_* method
+immediate = 'i'   # the operand is the value
+read = 'r'        # the operand is a register (or flag) to read the value from
+write = 'w'       # the operand is the index of the register to write to
+
+def read_registers(fn, modes):
+    """Wrap fn so that the operands in "read" mode are replaced by the
+    registers' content when it's called."""
+    reads = tuple(i for i, mode in enumerate(modes) if mode == read)
+    if not reads:
+        return fn
+    if reads == (0,) and len(modes) == 1:
+        return lambda m, x: fn(m, m.registers[x])
+    if reads == (0,) and len(modes) == 2:
+        return lambda m, x, y: fn(m, m.registers[x], y)
+    if reads == (1,) and len(modes) == 2:
+        return lambda m, x, y: fn(m, x, m.registers[y])
+    if reads == (0, 1):
+        return lambda m, x, y: fn(m, m.registers[x], m.registers[y])
+    if reads == (2,) and len(modes) == 3:
+        return lambda m, x, y, z: fn(m, x, y, m.registers[z])
+    if reads == (0, 2) and len(modes) == 3:
+        return lambda m, x, y, z: fn(m, m.registers[x], y, m.registers[z])
+    raise ValueError("Unsupported operand modes: {0}".format(modes))
+
+def read_registers_or_flags(fn, modes):
+    "Like read_registers, but the operands can also be flags (slower)."
+    def handler(m, *arguments):
+        return fn(m, *[m.read(x) if mode == read else x
+                       for x, mode in zip(arguments, modes)])
+    return handler
+
+# The superinstructions, by name: the operations each one does, with the
+# indices of their arguments among the superinstruction's arguments
+superinstructions = {
+    'subjnz': [('sub', [0, 1]), ('jnz', [2])],
+    'pushpop': [('push', [0]), ('pop', [1])],
+    'movputc': [('mov', [0, 1]), ('putc', [1])],
+}
+for jump in ['jo', 'jno', 'jz', 'jnz', 'jl', 'jle', 'jge', 'jpe', 'jpo', 'jaz']:
+    superinstructions['cmp' + jump] = [('cmp', [0, 2]), (jump, [1])]
+
+class Operation:
+    """How to execute one opcode.
+
+    The handlers take the machine and the decoded arguments, the defaults
+    are appended to the arguments when the instruction omits operands.
+
+    The parts of a superinstruction are the operations it does, with the
+    indices of their arguments, for the engines that don't call fn."""
+
+    __slots__ = ('name', 'fn', 'modes', 'defaults', 'fast', 'slow', 'parts')
+
+    def __init__(self, name, fn, operands):
+        parameters = params(fn)[1:]  # skip self
+        modes = [write if name == 'register' else read
+                 for (name, _) in parameters]
+        for i, operand in enumerate(operands.replace(',', '')):
+            if operand == 'i':
+                modes[i] = immediate
+        self.name = name
+        self.fn = fn
+        self.modes = modes
+        self.defaults = [register_codec.index(default)
+                         for (_, default) in parameters[len(operands):]]
+        self.fast = read_registers(fn, modes)
+        self.slow = read_registers_or_flags(fn, modes)
+        self.parts = []
+        for part, indices in superinstructions.get(name, []):
+            operands = ''.join('i' if modes[i] == immediate else 'r' for i in indices)
+            self.parts.append((Operation(part, get_operation_by_name(part), operands), indices))
+
+    def handler(self, arguments):
+        "Choose the handler for some decoded arguments."
+        for x, mode in zip(arguments, self.modes):
+            if mode == read and x >= flag_offset:
+                return self.slow
+        return self.fast
+
+    def does(self, name):
+        "Whether the operation, or one of its parts, is name."
+        return self.name == name or any(part.does(name) for part, _ in self.parts)
+
+def get_operation_by_name(name):
+    "Get the method implementing an operation."
+    return getattr(Machine, 'op_' + name)
+
+def get_operation_by_opcode(opcode):
+    "Get how to execute an opcode, None for halt."
+    [op, operands, _] = codec[opcode]
+    name = op[:-len(operands)] if operands else op
+    if name == 'halt':
+        return None
+    return Operation(name, get_operation_by_name(name), operands)
+
+# Built once, indexed by opcode
+operation_table = list(map(get_operation_by_opcode, range(len(codec))))
+
+table_operations = None
+
+def table_operation_table():
+    """The operation_table of the machines with alu_tables, built (with the
+    tables, unless alu.load read them) on the first call."""
+    global table_operations
+    if table_operations is None:
+        table_operations = list(operation_table)
+        fns = {}
+        for opcode, operation in enumerate(operation_table):
+            if operation is None:
+                continue
+            name = operation.name
+            if name not in fns:
+                if name in binary_operations:
+                    fns[name] = binary_table_op(name)
+                elif name in unary_operations:
+                    fns[name] = unary_table_op(name)
+                else:
+                    continue
+            table_operations[opcode] = Operation(name, fns[name], codec[opcode][1])
+    return table_operations
+
+###########################################################
+############ Module-level API (compatibility) #############
+###########################################################
+
+# The functions below work on a default machine, created by reset(). The
+# globals ram, registers and flags refer to its state. Unlike the methods of
+# Machine, they take registers and flags by name.
+
+machine = None
+ram = None
+registers = None
+flags = None
+decoded = None
+trace = False
+
+class Names(MutableMapping):
+    "View a list as a dict, given the names of its elements."
+
+    __slots__ = ('index', 'values')
+
+    def __init__(self, names, values):
+        self.index = {name: i for i, name in enumerate(names)}
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[self.index[name]]
+
+    def __setitem__(self, name, value):
+        self.values[self.index[name]] = value
+
+    def __delitem__(self, name):
+        raise TypeError("Cannot delete a register or a flag")
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def reset(memory=None):
+    "Replace the default machine by a new one, memory is its ram (see Machine)."
+    global machine
     global ram
     global registers
     global flags
-    ram = [0] * ram_size
-    registers = {name: 0 for name in register_names}
-    flags = {name: 0 for name in flag_names}
+    global decoded
+    machine = Machine(ram=memory)
+    ram = machine.ram
+    registers = Names(register_names, machine.registers)
+    flags = Names(flag_names, machine.flags)
+    decoded = machine.decoded
+
+def default_machine():
+    "Get the default machine, tracing if the global trace is set."
+    if not trace:
+        machine.trace = None
+    elif not machine.trace:
+        machine.trace = printing_tracer()
+    return machine
 
 def dump():
-    print(ram)
-    print(registers)
-    print(flags)
+    default_machine().dump()
 
 def get_register(register):
     "Get a register's content."
-    assert register in register_names
-    return registers[register]
+    return default_machine().get_register(register_index[register])
 
 def get_flag(flag):
     "Get a flag's value"
-    assert flag in flag_names
-    return 1 if flags[flag] else 0
+    return default_machine().get_flag(flag_index[flag])
 
 def get_register_or_flag(name):
     "Get a flag or a register's value."
-    if name in register_names:
-        return get_register(name)
-    elif name in flag_names:
-        return get_flag(name)
-    raise NameError("Invalid register or flag name: \"{0}\"".format(name))
+    if name not in register_codec:
+        raise NameError("Invalid register or flag name: \"{0}\"".format(name))
+    return default_machine().read(register_codec.index(name))
 
 def coerce_value(x):
     "Return either x of the register specified by x."
@@ -65,42 +775,36 @@ def coerce_value(x):
     return get_register_or_flag(x)
 
 def get_ram(address):
-    return ram[coerce_value(address)]
+    return default_machine().get_ram(coerce_value(address))
 
 def set_register(register, value):
     "Set a register, the value can either be an int or a register name."
-    assert register in register_names
-    x = coerce_value(value)
-    if trace:
-        print("Set register {0} to {1}".format(register, x))
-    registers[register] = x
+    default_machine().set_register(register_index[register], coerce_value(value))
 
 def set_flag(flag, value):
-    assert flag in flag_names
-    p = not (value == 0)
-    if trace and flags[flag] != p:
-        print("Set flag {0} to {1}".format(flag, p))
-    flags[flag] = p
+    default_machine().set_flag(flag_index[flag], value)
 
 def set_register_or_flag(name, value):
     "Name can either be a register or a flag, value must be an int."
-    if name in register_names:
-        set_register(name, value)
-    elif name in flag_names:
+    if name in register_index:
         set_register(name, value)
+    elif name in flag_index:
+        set_flag(name, coerce_value(value))
     else:
         raise NameError("Invalid register or flag name: \"{0}\"".format(name))
 
 def set_ram(address, value):
-    if trace:
-        print("Set memory address {0} to {1}".format(address, value))
-    ram[coerce_value(address)] = coerce_value(value)
+    default_machine().set_ram(coerce_value(address), coerce_value(value))
+
+def invalidate(address):
+    default_machine().invalidate(address)
+
+def invalidate_all():
+    default_machine().invalidate_all()
 
 def inc(register, n=1):
     "Increment a register, returning the new value"
-    new_value = (get_register(register) + n) % 256
-    set_register(register, new_value)
-    return new_value
+    return default_machine().inc(register_index[register], n)
 
 def dec(register, n=1):
     "Decrement a register, returning the new value"
@@ -110,161 +814,47 @@ def inc_ip(n=1):
     "Increment the instruction pointer, returning the new value"
     return inc('ip', n)
 
-###########################################################
-################### Operations ############################
-###########################################################
-
-# -[x] add
-# -[x] and
-# -[x] div
-# -[x] getc
-# -[x] load
-# -[x] mod
-# -[x] mov
-# -[x] mul
-# -[x] neg
-# -[x] not
-# -[x] or
-# -[x] popcount
-# -[x] putc
-# -[ ] rcl
-# -[ ] rcr
-# -[ ] rol
-# -[ ] ror
-# -[x] shl
-# -[x] shr
-# -[x] store
-# -[x] sub
-# -[x] xor
-
 def set_flags(x):
     "set the flags based on a given value"
-    set_flag('zf', x == 0)
-    set_flag('pf', bin(x)[2:].count('1') % 2 == 0)
-    set_flag('sf', x < 0)
-
-def unary_op(fn):
-    def op(value='a', register='a'):
-        x = coerce_value(value)
-        set_register(register, fn(x))
-    return op
+    default_machine().set_flags(x)
 
-def binary_op(fn):
-    def op(value='a', register='a'):
-        x = coerce_value(value)
-        y = get_register(register)
-        result = fn(x, y)
-        overflow_p = overflows(result)
-        result = clamp(result)
-        set_flags(result)
-        set_flag('of', overflow_p)
-        set_register(register, result)
-    return op
-
-########################################################
+def decode(address):
+    return default_machine().decode(address)
 
-def op_getc(register='a'):
-    if trace:
-        print("Waiting for user input")
-    set_register(register, getchar())
-
-def op_putc(value='a'):
-    x = coerce_value(value)
-    if trace:
-        # if chr(x).isprintable():
-        print("About to print the char {0}".format(x))
-    putchar(x)
-
-op_not = unary_op(lambda x: ~x)
-op_neg = unary_op(lambda x: clamp(-x))
-
-op_popcount = unary_op(popcount)
-op_clz = unary_op(count_leading_zeros)
-
-op_add = binary_op(lambda x, y: x + y)
-op_sub = binary_op(lambda x, y: y - x)
-op_mul = binary_op(lambda x, y: x * y)
-op_div = binary_op(lambda x, y: x / y)
-op_mod = binary_op(lambda x, y: x % y)
-
-op_or = binary_op(lambda x, y: x | y)
-op_and = binary_op(lambda x, y: x & y)
-op_xor = binary_op(lambda x, y: x ^ y)
-
-op_shl = binary_op(lambda x, y: x << y)
-op_shr = binary_op(lambda x, y: x >> y)
-
-def op_store(address, value='a'):
-    set_ram(address, value)
-
-def op_load(address='a', register='a'):
-    value = get_ram(address)
-    set_register(register, value)
-
-def op_mov(value='a', register='a'):
-    set_register(register, coerce_value(value))
-
-def op_test(x, y='a'):
-    x = coerce_value(x)
-    y = coerce_value(y)
-    set_flags(x | y)
-
-def op_cmp(x, y='a'):
-    x = coerce_value(x)
-    y = coerce_value(y)
-    result = coerce_value(y) - coerce_value(x)
-    overflow_p = overflows(result)
-    result = clamp(result)
-    if trace:
-        print("The result of comparing {0} to {1} is {2}".format(y, x, result))
-    set_flags(result)
-    set_flag('of', overflow_p)
-
-def op_jmp(value='a'):
-    "unconditional jump"
-    op_mov(value, 'ip')
-
-def jump_if(doc, condition):
-    def conditional_jump(value='a'):
-        doc
-        if condition():
-            if trace:
-                print("Taking the jump")
-            op_mov(value, 'ip')
+def run():
+    "Run until halt, returning the number of instructions executed."
+    return default_machine().run()
+
+def call_with_names(name, *arguments):
+    """Call the method "name" of the default machine, its arguments can
+    be registers or flags names."""
+    fn = getattr(Machine, name)
+    parameters = params(fn)[1:]  # skip self
+    values = []
+    for i, (parameter, default) in enumerate(parameters):
+        x = arguments[i] if i < len(arguments) else default
+        if parameter == 'register':
+            x = register_index[x]
         else:
-            if trace:
-                print("Not taking the jump")
-    return conditional_jump
-
-op_jo = jump_if("jump if overflow", lambda: get_flag('of'))
-op_jno = jump_if("jump if not overflow", lambda: not get_flag('of'))
-op_jpe = jump_if("jump if parity is even", lambda: get_flag('pf'))
-op_jpo = jump_if("jump if parity is odd", lambda: not get_flag('pf'))
-
-op_jz = jump_if("jump if zero", lambda: get_flag('zf'))
-op_jnz = jump_if("jump if not zero", lambda: not get_flag('zf'))
-op_jl = jump_if("jump if less", lambda: get_flag('sf'))
-op_jle = jump_if("jump if less or equal", lambda: get_flag('sf') or get_flag('zf'))
-op_jge = jump_if("jump if greater or equal", lambda: not get_flag('sf'))
-op_jaz = jump_if("jump if accumulator is zero",
-        lambda: get_register('a') == 0)
-
-def op_push(value='a'):
-    x = coerce_value(value)
-    stack_pointer = dec('sp') # it grows downward
-    set_ram(stack_pointer, x)
-
-def op_pop(register='a'):
-    stack_pointer = inc('sp')
-    x = get_ram(stack_pointer - 1)
-    set_register(register, x)
-
-def op_call(value='a'):
-    op_push('ip')
-    op_jmp(coerce_value(value))
+            x = coerce_value(x)
+        values.append(x)
+    m = default_machine()
+    result = fn(m, *values)
+    # keep the global flags up to date
+    m.settle_flags()
+    return result
+
+def op_with_names(name):
+    "Make a module-level function for the operation name."
+    def op(*arguments):
+        return call_with_names(name, *arguments)
+    op.__name__ = name
+    op.__doc__ = getattr(Machine, name).__doc__
+    return op
 
-def op_ret():
-    op_pop('ip')
+for name in dir(Machine):
+    if name.startswith('op_'):
+        globals()[name] = op_with_names(name)
 
 ########################################################
 
@@ -597,6 +1187,26 @@ def test_ret():
     check(registers['sp'] == 0)
     check(registers['ip'] == 10)
 
+def test_superinstructions():
+    # subjnz skips computing the flags when they're lazy
+    b = register_index['b']
+    for lazy_flags in [True, False]:
+        m = Machine(lazy_flags)
+        m.registers[b] = 2
+        m.op_subjnz(1, b, 42)
+        check(m.registers[ip_register] == 42 and m.registers[b] == 1)
+        m.registers[ip_register] = 0
+        m.op_subjnz(1, b, 42)
+        check(m.registers[ip_register] == 0 and m.get_flag(zero_flag))
+
+    m = Machine(io=capture())
+    m.op_movputc(ord('x'), b)
+    m.op_pushpop(3, b)
+    m.op_cmpjl(4, 10, b)
+    m.io.flush()
+    check(m.io.file.getvalue() == 'x' and m.registers[b] == 3)
+    check(m.registers[ip_register] == 10 and m.ram[255] == 3)
+
 def test_operations():
     test_op_not()
     test_op_neg()
@@ -628,51 +1238,17 @@ def test_operations():
 
     test_call()
     test_ret()
+    test_superinstructions()
 
     print()
 
 ########################################################
 
-def get_operation_by_name(name):
-    module = sys.modules[__name__]
-    return getattr(module, 'op_' + name)
-
-def run():
-    opcode = -1
-    instruction = []
-    while True:
-        opcode = get_ram(get_register('ip'))
-        if trace:
-            print()
-            print("Read opcode {0}".format(opcode))
-        instruction.append(opcode)
-        code = disassamble_insctruction(instruction)
-
-        # Not done reading the instruction
-        if code is None:
-            inc_ip()
-            continue
-
-        if trace:
-            print("Running instruction: ", code)
-
-        [op, *arguments] = code
-        if op == 'halt':
-            return
-        fn = get_operation_by_name(op)
-
-        old_ip = get_register('ip')
-        fn(*arguments)
-
-        instruction = []
-
-        if old_ip == get_register('ip'):
-            inc_ip()
-
 def test_run():
     # global trace
     # trace = True
     reset();
+    machine.io = capture()
 
     obj = assamble("""
     mov 'h'
@@ -683,9 +1259,180 @@ def test_run():
     """)
     copy(obj, ram)
 
+    check(run() == 5)
+    check(machine.io.file.getvalue() == 'hi')
+
+def test_decode_cache():
+    reset()
+    copy(assamble("mov 'h'\nputc"), ram)
+    check(decode(0)[1] == [104, 0])
+    check(decoded[0] is not None)
+
+    # writing over the operand invalidates the instruction
+    set_ram(1, 105)
+    check(decoded[0] is None)
+    check(decode(0)[1] == [105, 0])
+
+    # writing elsewhere doesn't
+    set_ram(10, 1)
+    check(decoded[0] is not None)
+    print()
+
+def test_machine():
+    # machines don't share their state
+    m1 = Machine()
+    m2 = Machine()
+    b = register_index['b']
+    m1.op_mov(3, b)
+    m1.op_store(1, 2)
+    check(m1.get_register(b) == 3)
+    check(m2.get_register(b) == 0)
+    check(m1.ram[1] == 2)
+    check(m2.ram[1] == 0)
+
+    # negative values are stored as bytes, a b c and d are signed
+    m1.op_push(-10)
+    check(m1.ram[255] == 246)
+    m1.op_pop(register_index['c'])
+    check(m1.get_register(register_index['c']) == -10)
+    m1.op_push(200)
+    m1.op_pop(register_index['sb'])
+    check(m1.get_register(register_index['sb']) == 200)
+    print()
+
+def test_lazy_flags():
+    eager = Machine(lazy_flags=False)
+    lazy = Machine()
+    a = accumulator
+    b = register_index['b']
+    pairs = [
+        [('op_mov', 100, a), ('op_add', 100, a)],
+        [('op_mul', 100, a), ('op_test', 0, 1)],   # test keeps of
+        [('op_cmp', 3, -128), ('op_mov', 0, b)],
+        [('op_sub', 1, a), ('op_mul', 0, a)],
+        [('op_test', 1, 2), ('op_or', 0, b)],
+        [('op_xor', 7, b), ('op_test', 0, 0)],
+    ]
+    for pair in pairs:
+        for (name, *arguments) in pair:
+            getattr(eager, name)(*arguments)
+            getattr(lazy, name)(*arguments)
+        check(list(map(eager.get_flag, range(len(flag_names)))) ==
+              list(map(lazy.get_flag, range(len(flag_names)))))
+        check(eager.registers == lazy.registers)
+
+    # conditional jumps compute the flags they need
+    lazy.op_cmp(5, 5)
+    lazy.op_jz(42)
+    check(lazy.registers[ip_register] == 42)
+    print()
+
+def test_alu_tables():
+    # same results and flags with and without the tables, the operations
+    # called as the machine calls them (through its operation table)
+    a = accumulator
+    b = register_index['b']
+    ip = ip_register
+    for name in ['add', 'sub', 'mul', 'div', 'mod', 'or', 'and', 'xor',
+                 'shl', 'shr', 'not', 'neg', 'popcount', 'clz']:
+        for (x, y) in [(0, 0), (5, 3), (-7, 2), (127, 127), (-128, -128),
+                       (3, 0), (-1, 1), (2, 200), (200, 5), (255, -128), (5, -1),
+                       (-256, 5), (3, 256), (-300, -300)]:
+            results = []
+            for m in [Machine(), Machine(alu_tables=True)]:
+                [operation] = set(operation.fn for operation in m.operations
+                                  if operation is not None and operation.name == name)
+                m.registers[b] = y
+                try:
+                    operation(m, x, b)
+                except ValueError:
+                    results.append('error')  # negative shifts
+                    continue
+                results.append((m.registers[b], list(map(m.get_flag, range(len(flag_names))))))
+            check(results[0] == results[1])
+
+    # a program
+    with open('examples/count.asm') as file:
+        binary = link(assamble(file.read()))
+    machines = [Machine(io=capture()), Machine(alu_tables=True, io=capture())]
+    for m in machines:
+        copy(binary, m.ram)
+        m.run()
+    check(machines[0].snapshot() == machines[1].snapshot())
+
+    # not leaves a outside of the tables (-256)
+    machines = [Machine(), Machine(alu_tables=True)]
+    for m in machines:
+        copy(link(assamble("not sp\nmod 24\nhalt")), m.ram)
+        m.run()
+    check(machines[0].registers == machines[1].registers)
+
+    # dividing by zero
+    m = Machine(alu_tables=True)
+    m.op_div(7, a)
+    check(m.registers[a] == 0)
+    m.op_mod(7, a)
+    check(m.registers[a] == 7)
+    print()
+
+def test_operands():
+    # registers stay numbers once assambled
+    reset()
+    copy(assamble("mov 3 b\nadd b c\nxor a a\nmov zf d\nhalt"), ram)
+    fn, arguments, length = decode(0)
+    check(arguments == [3, register_index['b']])
+    fn, arguments, length = decode(3)
+    check(arguments == [register_index['b'], register_index['c']])
+    check(length == 1)
     run()
+    check(registers['c'] == 3)
+
+    # reading a flag
+    check(decode(7)[1] == [register_codec.index('zf'), register_index['d']])
+    check(registers['d'] == 1)
+    print()
+
+def test_snapshot():
+    m = Machine(io=capture('xyz'))
+    copy(link(assamble("""
+    getc
+    mov 3 b
+    loop:
+    push b
+    sub 1 b
+    jnz loop
+    getc c
+    halt
+    """)), m.ram)
+    m.invalidate_all()
+    for _ in range(4):
+        m.step()
+    snapshot = m.snapshot()
+    check(len(snapshot) == 256 + 7 * 8 + 1 + 8)
+
+    child = m.fork()
+    child.registers[register_index['b']] = 1
+    check(child.run() < m.run())
+    check(m.registers[register_index['c']] == ord('y'))
+    check(child.registers[register_index['c']] == ord('y'))
+    check(m.ram[253] == 1 and child.ram[253] == 0)
+
+    # back to the checkpoint
+    end = (bytes(m.ram), list(m.registers), list(m.flags))
+    m.restore(snapshot)
+    check(m.registers[register_index['b']] == 2)
+    check(m.ram[253] == 0)
+    m.run()
+    check((bytes(m.ram), m.registers, m.flags) == end)
+    print()
 
 if __name__ == '__main__':
     test_operations()
+    test_machine()
+    test_operands()
+    test_lazy_flags()
+    test_alu_tables()
+    test_decode_cache()
+    test_snapshot()
     test_run()
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# Which instructions of a program were executed, and which way its
+# conditional jumps went
+#
+# The coverage of a program is a bitmap: a byte per address of ram, with a
+# bit for the instructions starting there that were executed and one for
+# each direction of the conditional jumps (taken or not). Coverage.run is
+# a copy of Machine.run setting these bits, it costs one lookup and one or per
+# instruction (the trace is not involved), so it can be left on while
+# running a program on many inputs. The bitmaps of many runs are merged by
+# or-ing them, saved as files of ram_size bytes.
+#
+
+import os
+import sys
+from core import Machine, ip_register, ram_size
+from assamble import assamble, link, symbols, where, source_map
+from profiler import conditional_jumps
+from utils import check, copy
+from console import capture
+
+# The bits of the bitmap
+executed = 1
+taken = 2
+not_taken = 4
+
+# The bits set by each opcode, when it goes on to the next instruction and
+# when it jumps (only the conditional jumps count the direction)
+next_bits = [executed | not_taken if conditional else executed
+             for conditional in conditional_jumps]
+jump_bits = [executed | taken if conditional else executed
+             for conditional in conditional_jumps]
+
+class Coverage:
+    """The coverage of a program, merged over the runs. A conditional jump
+    counts as taken when it changes the instruction pointer."""
+
+    def __init__(self, bitmap=None):
+        self.bitmap = bytearray(ram_size) if bitmap is None else bytearray(bitmap)
+
+    def run(self, machine):
+        "Run a machine until halt, returning the number of instructions executed."
+        m = machine
+        m.invalidate_all()
+        registers = m.registers
+        ram = m.ram
+        bitmap = self.bitmap
+        count = 0
+        ip = registers[ip_register]
+        try:
+            while True:
+                count += 1
+                ip = registers[ip_register]
+                fn, arguments, length = m.decode(ip)
+
+                if fn is None:
+                    bitmap[ip] |= executed
+                    m.settle_flags()
+                    m.io.flush()
+                    return count
+
+                opcode = ram[ip]
+                if length:
+                    m.inc_ip(length)
+
+                old_ip = registers[ip_register]
+                fn(m, *arguments)
+
+                if old_ip == registers[ip_register]:
+                    m.inc_ip()
+                    bitmap[ip] |= next_bits[opcode]
+                else:
+                    bitmap[ip] |= jump_bits[opcode]
+        except BaseException:
+            bitmap[ip] |= executed
+            raise
+
+    def merge(self, other):
+        "Add the runs of another coverage (or bitmap) to this one."
+        bitmap = getattr(other, 'bitmap', other)
+        merged = int.from_bytes(self.bitmap, 'big') | int.from_bytes(bitmap, 'big')
+        self.bitmap[:] = merged.to_bytes(ram_size, 'big')
+
+    def save(self, path):
+        "Write the bitmap to a file, atomically."
+        temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as file:
+            file.write(self.bitmap)
+        os.replace(temporary, path)
+
+    def add_to(self, path):
+        """Merge into the coverage saved in a file (created if needed), many
+        processes can do it at once."""
+        import fcntl
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            coverage = load(path)
+            coverage.merge(self)
+            coverage.save(path)
+
+    def summary(self, source):
+        """What was covered in a program (its source, assambled without
+        optimizing it): the instructions and the directions of the
+        conditional jumps, in total and by label, as [covered, total], and
+        the lines never executed."""
+        obj = assamble(source)
+        binary = link(obj)
+        labels = symbols(obj)
+        lines = source_map(source)
+        result = {'instructions': [0, 0], 'branches': [0, 0], 'labels': {}, 'uncovered': []}
+        for address, line in sorted(lines.items()):
+            bits = self.bitmap[address]
+            name = where(labels, address).split('+')[0]
+            if name.isdigit():
+                name = '0'      # before the first label
+            label = result['labels'].setdefault(name, [0, 0])
+            for counts in [result['instructions'], label]:
+                counts[0] += bool(bits & executed)
+                counts[1] += 1
+            if not bits & executed:
+                result['uncovered'].append(line)
+            if conditional_jumps[binary[address]]:
+                result['branches'][0] += bool(bits & taken) + bool(bits & not_taken)
+                result['branches'][1] += 2
+        return result
+
+    def report(self, source):
+        """The source, each line marked: '#####' never executed, '+'
+        executed, and for the conditional jumps the directions taken: T
+        (taken) and N (not taken)."""
+        lines = source_map(source)
+        binary = link(assamble(source))
+        addresses = {line: address for address, line in lines.items()}
+        text = []
+        for number, line in enumerate(source.split('\n'), 1):
+            mark = '-'
+            if number in addresses:
+                address = addresses[number]
+                bits = self.bitmap[address]
+                mark = '+' if bits & executed else '#####'
+                if conditional_jumps[binary[address]] and bits & executed:
+                    mark = '+ {0}{1}'.format('T' if bits & taken else '-',
+                                             'N' if bits & not_taken else '-')
+            text.append('{0:>7} {1:4}: {2}'.format(mark, number, line))
+        summary = self.summary(source)
+        text.append('')
+        for name in ['instructions', 'branches']:
+            covered, total = summary[name]
+            text.append('{0:<16} {1:>4} of {2:<4} {3:>7.1%}'.format(
+                name, covered, total, covered / total if total else 1))
+        for name, (covered, total) in summary['labels'].items():
+            text.append('{0:<16} {1:>4} of {2:<4} {3:>7.1%}'.format(name, covered, total, covered / total))
+        return '\n'.join(text)
+
+def load(path):
+    "The coverage saved in a file, empty if there's no such file."
+    try:
+        with open(path, 'rb') as file:
+            bitmap = file.read()
+    except FileNotFoundError:
+        return Coverage()
+    if len(bitmap) != ram_size:
+        raise ValueError('{0} is not a coverage bitmap'.format(path))
+    return Coverage(bitmap)
+
+###############################################################
+
+program = """
+    getc
+    cmp 'y'
+    jz yes
+    putc 'n'
+    jmp end
+yes:
+    putc 'y'
+end:
+    halt
+"""
+
+def run_source(coverage, source, text):
+    machine = Machine(io=capture(text))
+    copy(link(assamble(source)), machine.ram)
+    return coverage.run(machine), machine
+
+def test_coverage():
+    coverage = Coverage()
+    count, machine = run_source(coverage, program, 'n')
+    check(count == 6 and machine.io.file.getvalue() == 'n')
+    summary = coverage.summary(program)
+    check(summary['instructions'] == [6, 7])
+    check(summary['branches'] == [1, 2])
+    check(summary['uncovered'] == [8])
+    check(summary['labels'] == {'0': [5, 5], 'yes': [0, 1], 'end': [1, 1]})
+    report = coverage.report(program)
+    check('+ -N    4:     jz yes' in report)
+    check("#####    8:     putc 'y'" in report)
+
+    # merged with a run going the other way
+    other = Coverage()
+    run_source(other, program, 'y')
+    coverage.merge(other)
+    summary = coverage.summary(program)
+    check(summary['instructions'] == [7, 7] and summary['branches'] == [2, 2])
+    check('+ TN    4:     jz yes' in coverage.report(program))
+
+    # an instruction failing (getc, without input) was executed
+    coverage = Coverage()
+    try:
+        run_source(coverage, program, '')
+        check(False)
+    except EOFError:
+        check(coverage.bitmap[0] == executed)
+
+def test_same_state():
+    with open('examples/call_ret.asm') as file:
+        binary = link(assamble(file.read()))
+    machines = []
+    for engine in [Machine.run, Coverage().run]:
+        machine = Machine(io=capture())
+        copy(binary, machine.ram)
+        machines.append((engine(machine), machine.ram, machine.registers,
+                         machine.flags, machine.io.file.getvalue()))
+    check(machines[0] == machines[1])
+
+def test_files():
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'program.cov')
+        check(load(path).bitmap == bytearray(ram_size))
+        coverage = Coverage()
+        run_source(coverage, program, 'n')
+        coverage.save(path)
+        check(load(path).bitmap == coverage.bitmap)
+        other = Coverage()
+        run_source(other, program, 'y')
+        other.add_to(path)
+        coverage.merge(other)
+        check(load(path).bitmap == coverage.bitmap)
+        with open(path, 'wb') as file:
+            file.write(b'oops')
+        try:
+            load(path)
+            check(False)
+        except ValueError:
+            check(True)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['report']:
+        # ./cover.py report FILE.cov program.asm
+        with open(sys.argv[3]) as file:
+            print(load(sys.argv[2]).report(file.read()))
+        sys.exit()
+    if sys.argv[1:2] == ['merge']:
+        # ./cover.py merge OUT.cov A.cov B.cov...
+        coverage = load(sys.argv[2])
+        for path in sys.argv[3:]:
+            coverage.merge(load(path))
+        coverage.save(sys.argv[2])
+        sys.exit()
+    test_coverage()
+    test_same_state()
+    test_files()
+    print()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+#
+# Stop the machines at breakpoints, watchpoints and conditions
+#
+# Debugger.run is a copy of Machine.run that checks, before each
+# instruction, the breakpoints (addresses), the watchpoints (the bytes of
+# ram the instruction is about to read or write) and the conditions on the
+# registers. Machine.run is left untouched, so the debugger costs nothing
+# when it is off. prompt() is the interactive debugger of emu --break.
+#
+
+import sys
+import operator
+from core import Machine, operation_table, register_index, ip_register, sp_register
+from core import ram_size, read
+from assamble import codec, register_codec, assamble, link, symbols, where
+from assamble import disassamble_insctruction
+from utils import check, copy
+from console import capture
+
+comparisons = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+}
+
+class Stop:
+    """Why a machine stopped, before the instruction at address: reason is
+    'break', 'read', 'write', 'condition', 'step' or 'halt'."""
+
+    def __init__(self, reason, address, detail=None):
+        self.reason = reason
+        self.address = address
+        self.detail = detail
+
+    def __str__(self):
+        if self.reason == 'break':
+            return 'breakpoint'
+        if self.reason in ['read', 'write']:
+            return 'watchpoint: {0} of the byte at {1}'.format(self.reason, self.detail)
+        if self.reason == 'condition':
+            return 'condition: {0}'.format(self.detail)
+        return self.reason
+
+def accesses(machine, operation, arguments):
+    "The addresses of ram an instruction reads and writes: (reads, writes)."
+    reads = []
+    writes = []
+    sp = machine.registers[sp_register]
+    for part, indices in operation.parts or [(operation, range(len(arguments)))]:
+        values = [machine.read(arguments[i]) if mode == read else arguments[i]
+                  for i, mode in zip(indices, part.modes)]
+        if part.name == 'load':
+            reads.append(values[0] % ram_size)
+        elif part.name == 'store':
+            writes.append(values[0] % ram_size)
+        elif part.name in ['push', 'call']:
+            sp = (sp - 1) % ram_size
+            writes.append(sp)
+        elif part.name in ['pop', 'ret']:
+            reads.append(sp)
+            sp = (sp + 1) % ram_size
+    return reads, writes
+
+class Debugger:
+    """Run a machine until something it does is worth a look.
+
+    The addresses can be given as numbers or labels (from labels, the
+    symbol table). A condition stops the machine when it becomes true."""
+
+    def __init__(self, machine, labels={}):
+        self.machine = machine
+        self.labels = labels
+        self.breakpoints = set()
+        self.reads = set()          # the watched addresses
+        self.writes = set()
+        self.conditions = {}        # whether each one was true, by text
+        self.count = 0              # instructions executed
+        self.resuming = False       # don't stop twice on the same instruction
+        machine.invalidate_all()
+
+    def address(self, where):
+        "The address of a label or a number (an int or a string)."
+        if isinstance(where, str) and not where.lstrip('-').isdigit():
+            if where not in self.labels:
+                raise ValueError('unknown label: {0}'.format(where))
+            return self.labels[where]
+        return int(where) % ram_size
+
+    def add_breakpoint(self, where):
+        self.breakpoints.add(self.address(where))
+
+    def remove_breakpoint(self, where):
+        self.breakpoints.discard(self.address(where))
+
+    def watch(self, where, reads=False, writes=True):
+        "Stop before the instructions reading and/or writing a byte."
+        address = self.address(where)
+        if reads:
+            self.reads.add(address)
+        if writes:
+            self.writes.add(address)
+
+    def parse(self, condition):
+        "Parse a condition: register (or flag), comparison, number or 'c'."
+        [name, comparison, value] = condition.split()
+        if name not in register_codec or comparison not in comparisons:
+            raise ValueError('invalid condition: {0}'.format(condition))
+        value = ord(value[1]) if value.startswith("'") else int(value)
+        return register_codec.index(name), comparisons[comparison], value
+
+    def break_if(self, condition):
+        register, compare, value = self.parse(condition)
+        self.conditions[condition] = bool(compare(self.machine.read(register), value))
+
+    def check(self, ip, fn, arguments):
+        "Why to stop before the instruction at ip, None to go on."
+        m = self.machine
+        stop = None
+        for condition, was in self.conditions.items():
+            register, compare, value = self.parse(condition)
+            now = self.conditions[condition] = bool(compare(m.read(register), value))
+            if now and not was and stop is None:
+                stop = Stop('condition', ip, condition)
+        if stop is not None:
+            return stop
+        if ip in self.breakpoints:
+            return Stop('break', ip)
+        if fn is not None and (self.reads or self.writes):
+            reads, writes = accesses(m, operation_table[m.ram[ip]], arguments)
+            for address in writes:
+                if address in self.writes:
+                    return Stop('write', ip, address)
+            for address in reads:
+                if address in self.reads:
+                    return Stop('read', ip, address)
+        return None
+
+    def run(self, limit=None):
+        """Run the machine until it stops, return the Stop. With limit, stop
+        after that many instructions at most (reason 'step')."""
+        m = self.machine
+        registers = m.registers
+        checking = self.breakpoints or self.reads or self.writes or self.conditions
+        executed = 0
+        while True:
+            ip = registers[ip_register]
+            fn, arguments, length = m.decode(ip)
+            if checking and not self.resuming:
+                stop = self.check(ip, fn, arguments)
+                if stop is not None:
+                    self.resuming = True
+                    return stop
+            self.resuming = False
+            if executed == limit:
+                return Stop('step', ip)
+
+            if fn is None:
+                m.settle_flags()
+                m.io.flush()
+                return Stop('halt', ip)
+
+            if length:
+                m.inc_ip(length)
+            old_ip = registers[ip_register]
+            fn(m, *arguments)
+            if old_ip == registers[ip_register]:
+                m.inc_ip()
+            executed += 1
+            self.count += 1
+
+    def step(self, n=1):
+        "Execute n instructions, unless something stops the machine before."
+        return self.run(n)
+
+    def listing(self, address=None, n=8):
+        "Disassemble n instructions from an address (default: ip)."
+        m = self.machine
+        address = m.registers[ip_register] if address is None else address
+        lines = []
+        for _ in range(n):
+            opcode = m.ram[address]
+            if opcode >= len(codec):
+                lines.append('{0:>12} {1:>3}  ?? {2}'.format(where(self.labels, address), address, opcode))
+                break
+            length = codec[opcode][2]
+            instruction = [m.ram[(address + i) % ram_size] for i in range(length + 1)]
+            marker = '>' if address == m.registers[ip_register] else ' '
+            lines.append('{0:>12} {1:>3} {2} {3}'.format(
+                where(self.labels, address), address, marker,
+                ' '.join(map(str, disassamble_insctruction(instruction)))))
+            address = (address + length + 1) % ram_size
+        return '\n'.join(lines)
+
+    def state(self):
+        "The registers and the flags, on one line."
+        m = self.machine
+        m.settle_flags()
+        return ' '.join('{0}={1}'.format(name, m.read(i)) for i, name in enumerate(register_codec))
+
+###############################################################
+
+usage = """\
+c, continue             run until the next stop
+s, step [N]             execute N instructions (1)
+r, registers            print the registers and the flags
+x ADDRESS [N]           print N bytes of ram (16)
+l, list [WHERE] [N]     disassemble N instructions (8) from WHERE (ip)
+b, break WHERE          stop before the instruction at an address or label
+d, delete WHERE         remove a breakpoint
+w, watch WHERE [r|w|rw] stop before the instructions reading/writing a byte
+if CONDITION            stop when a condition becomes true, e.g. if b == 3
+q, quit                 stop the program"""
+
+def prompt(debugger, commands=None, file=None):
+    """Run the machine of a debugger, asking what to do at each stop. The
+    commands are read from commands (default: stdin), the answers are
+    printed to file (default: stderr). Return the last Stop."""
+    commands = sys.stdin if commands is None else commands
+    file = sys.stderr if file is None else file
+    stop = debugger.run()
+    while True:
+        debugger.machine.io.flush()
+        if stop.reason == 'halt':
+            print('halted after {0} instructions'.format(debugger.count), file=file)
+            return stop
+        print('stopped at {0} ({1}): {2}'.format(
+            where(debugger.labels, stop.address), stop.address, stop), file=file)
+        print(debugger.listing(n=1), file=file)
+        while True:
+            print('(debug) ', end='', file=file, flush=True)
+            line = commands.readline()
+            if not line:
+                return stop
+            [command, *arguments] = line.split() or ['']
+            try:
+                if command in ['c', 'continue']:
+                    stop = debugger.run()
+                    break
+                elif command in ['s', 'step']:
+                    stop = debugger.step(int(arguments[0]) if arguments else 1)
+                    break
+                elif command in ['q', 'quit']:
+                    return stop
+                elif command in ['r', 'registers']:
+                    print(debugger.state(), file=file)
+                elif command == 'x':
+                    address = debugger.address(arguments[0])
+                    n = int(arguments[1]) if len(arguments) > 1 else 16
+                    ram = debugger.machine.ram
+                    print(' '.join(str(ram[(address + i) % ram_size]) for i in range(n)), file=file)
+                elif command in ['l', 'list']:
+                    address = debugger.address(arguments[0]) if arguments else None
+                    n = int(arguments[1]) if len(arguments) > 1 else 8
+                    print(debugger.listing(address, n), file=file)
+                elif command in ['b', 'break']:
+                    debugger.add_breakpoint(arguments[0])
+                elif command in ['d', 'delete']:
+                    debugger.remove_breakpoint(arguments[0])
+                elif command in ['w', 'watch']:
+                    mode = arguments[1] if len(arguments) > 1 else 'w'
+                    debugger.watch(arguments[0], 'r' in mode, 'w' in mode)
+                elif command == 'if':
+                    debugger.break_if(' '.join(arguments))
+                else:
+                    print(usage, file=file)
+            except (ValueError, IndexError) as e:
+                print('error: {0}'.format(e or 'missing argument'), file=file)
+
+###############################################################
+
+def load(source, text=''):
+    obj = assamble(source)
+    machine = Machine(io=capture(text))
+    copy(link(obj), machine.ram)
+    return Debugger(machine, symbols(obj))
+
+program = """
+    mov 3 b
+loop:
+    push b
+    sub 1 b
+    jnz loop
+    pop c
+    store 100 c
+    load 100 d
+    halt
+"""
+
+def test_breakpoints():
+    debugger = load(program)
+    debugger.add_breakpoint('loop')
+    stops = []
+    while True:
+        stop = debugger.run()
+        stops.append((stop.reason, stop.address))
+        if stop.reason == 'halt':
+            break
+    check(stops == [('break', 3)] * 3 + [('halt', 18)])
+    check(debugger.count == 13)
+
+    # by address, removed
+    debugger = load(program)
+    debugger.add_breakpoint(5)
+    check(debugger.run().address == 5)
+    debugger.remove_breakpoint(5)
+    check(debugger.run().reason == 'halt')
+
+def test_watchpoints():
+    debugger = load(program)
+    debugger.watch(100)
+    stop = debugger.run()
+    check((stop.reason, stop.address, stop.detail) == ('write', 12, 100))
+    check(debugger.machine.ram[100] == 0)
+    debugger.watch(100, reads=True, writes=False)
+    stop = debugger.run()
+    check((stop.reason, stop.address) == ('read', 15))
+    check(debugger.machine.ram[100] == 1)
+
+    # the stack
+    debugger = load(program)
+    debugger.watch(253)
+    stop = debugger.run()
+    check(stop.reason == 'write' and debugger.machine.registers[sp_register] == 254)
+
+def test_conditions():
+    debugger = load(program)
+    debugger.break_if('b == 1')
+    stop = debugger.run()
+    check(stop.reason == 'condition' and stop.address == 8)
+    check(debugger.machine.registers[register_index['b']] == 1)
+    # it stops again only once it was false
+    check(debugger.run().reason == 'halt')
+
+    debugger = load(program)
+    debugger.break_if('zf != 0')
+    check(debugger.run().detail == 'zf != 0')
+
+def test_prompt():
+    import io
+    debugger = load(program)
+    debugger.add_breakpoint('loop')
+    output = io.StringIO()
+    commands = io.StringIO('r\nl loop 2\nd loop\nw 100\nc\nx 98 4\ns 2\nhelp\nc\n')
+    stop = prompt(debugger, commands, output)
+    text = output.getvalue()
+    check(stop.reason == 'halt')
+    check('stopped at loop (3): breakpoint' in text)
+    check('b=3' in text)
+    check('loop   3 > push b' in text and 'loop+2   5   sub 1 b' in text)
+    check('watchpoint: write of the byte at 100' in text)
+    check('0 0 0 0' in text)
+    check('stopped at loop+15 (18): step' in text)
+    check(usage in text)
+
+if __name__ == '__main__':
+    test_breakpoints()
+    test_watchpoints()
+    test_conditions()
+    test_prompt()
+    print()
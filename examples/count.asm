@@ -0,0 +1,16 @@
+#!./emu
+# Count down from 100, 100 times, then print "ok"
+# (a cpu-bound loop, to measure the speed of the machine)
+
+  mov 100 c
+outer:
+  mov 100 b
+inner:
+  sub 1 b
+  jnz inner
+  sub 1 c
+  jnz outer
+
+  putc 'o'
+  putc 'k'
+  halt
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Check that the engines agree with the interpreter, on random programs
+#
+# A case is a random stream of valid instructions (any opcode of the codec,
+# with register operands naming registers or flags) and some input. It is
+# run on the interpreter (Machine.step, the reference) and on another
+# engine, a slice of instructions at a time: after each slice, the ram, the
+# registers, the flags and the output must be the same, and both machines
+# must have stopped the same way. The engines stop where they can (the
+# compiler at the end of a block), the interpreter catches up.
+#
+# A failing case is minimized (instructions are removed as long as it still
+# fails) before being reported. ./fuzz.py --cases 1000 --jobs 4 runs a
+# campaign, sharded over processes.
+#
+
+import sys
+import random
+import argparse
+from core import Machine, operation_table, ip_register
+from assamble import codec, register_codec, disassamble_insctruction
+from compiler import BlockEngine, max_block_length
+from console import capture
+from utils import check, copy
+
+# The opcodes of the instructions to generate ("cmp i, r" can't be decoded)
+valid_opcodes = [opcode for opcode, (_, operands, _) in enumerate(codec) if ',' not in operands]
+
+def generate(rng, size=12):
+    "A random program: a list of instructions (lists of bytes)."
+    program = []
+    for _ in range(size):
+        opcode = rng.choice(valid_opcodes)
+        [_, operands, _] = codec[opcode]
+        arguments = []
+        for kind in operands:
+            if kind == 'r':
+                arguments.append(rng.randrange(len(register_codec)))
+            elif rng.random() < 0.5:
+                # near the code: jumps, loads and stores
+                arguments.append(rng.randrange(3 * size))
+            else:
+                arguments.append(rng.randrange(256))
+        if operands == 'rr':
+            arguments = [arguments[0] << 4 | arguments[1]]
+        program.append([opcode] + arguments)
+    return program
+
+def binary(program):
+    return [byte for instruction in program for byte in instruction]
+
+def listing(program):
+    "The program, disassambled, with the address of each instruction."
+    lines = []
+    address = 0
+    for instruction in program:
+        lines.append('{0:3}: {1}'.format(address, ' '.join(map(str, disassamble_insctruction(instruction)))))
+        address += len(instruction)
+    return '\n'.join(lines)
+
+def stop_reason(error):
+    "How an engine stopped, given the exception it raised."
+    return 'input' if isinstance(error, EOFError) else 'error'
+
+###############################################################
+
+class Interpreter:
+    "The reference: a Machine executing one instruction at a time."
+
+    def __init__(self, program, input, alu_tables=False):
+        self.machine = Machine(alu_tables=alu_tables, io=capture(input))
+        copy(binary(program), self.machine.ram)
+        self.count = 0
+        self.stopped = None     # 'halt', 'input' or 'error'
+
+    def advance(self, count):
+        "Execute instructions until count of them were, or the machine stops."
+        m = self.machine
+        try:
+            while self.count < count and self.stopped is None:
+                if not m.step():
+                    self.stopped = 'halt'
+                    break
+                self.count += 1
+        except Exception as e:
+            self.stopped = stop_reason(e)
+        return self.count
+
+    def state(self):
+        m = self.machine
+        m.settle_flags()
+        m.io.flush()
+        return bytes(m.ram), list(m.registers), list(m.flags), m.io.file.getvalue()
+
+class Tables(Interpreter):
+    "The interpreter looking the results up in the alu tables."
+
+    def __init__(self, program, input, every):
+        super().__init__(program, input, alu_tables=True)
+
+class Compiled(Interpreter):
+    "The compiler (compiler.BlockEngine), a few blocks at a time."
+
+    def __init__(self, program, input, every):
+        super().__init__(program, input)
+        self.engine = BlockEngine(self.machine, loop_limit=every)
+
+    def advance(self, count):
+        try:
+            self.count += self.engine.run(count - self.count)
+            if self.engine.halted():
+                self.stopped = 'halt'
+        except Exception as e:
+            self.stopped = stop_reason(e)
+        return self.count
+
+class Batched:
+    "The lockstep engine (batch.Batch, needs numpy), with a single lane."
+
+    def __init__(self, program, input, every):
+        from batch import Batch, running, halted, waiting
+        self.batch = Batch(1, binary(program))
+        self.batch.inputs[0] = input
+        self.statuses = {running: None, halted: 'halt', waiting: 'input'}
+        self.count = 0
+        self.stopped = None
+
+    def advance(self, count):
+        b = self.batch
+        self.count += b.run(count - self.count)
+        self.stopped = self.statuses.get(int(b.status[0]), 'error')
+        return self.count
+
+    def state(self):
+        b = self.batch
+        m = b.machine(0)
+        return bytes(m.ram), list(m.registers), list(m.flags), b.output(0)
+
+engines = {'tables': Tables, 'compiler': Compiled, 'batch': Batched}
+
+def diverges(engine, program, input=b'', steps=1000, every=50):
+    """Run a case on the interpreter and on an engine (a class of engines),
+    return how they differ (a string), None if they agree."""
+    reference = Interpreter(program, input)
+    other = engine(program, input, every)
+    count = 0
+    while count < steps:
+        count = other.advance(count + every)
+        if other.stopped is None:
+            reference.advance(count)
+        elif other.stopped == 'halt':
+            reference.advance(count + 1)
+        else:
+            # the engine failed during the slice, maybe in the middle of a
+            # block: the reference must fail the same way soon
+            reference.advance(count + 2 * every + max_block_length)
+        if reference.stopped != other.stopped:
+            return 'after {0} instructions, stopped: {1} instead of {2}'.format(
+                count, other.stopped, reference.stopped)
+        if other.stopped not in [None, 'halt']:
+            # the state after a failed instruction is unspecified
+            return None
+        if other.stopped is None and reference.count != other.count:
+            return 'executed {0} instructions instead of {1}'.format(other.count, reference.count)
+        for name, mine, theirs in zip(['ram', 'registers', 'flags', 'output'],
+                                      other.state(), reference.state()):
+            if mine != theirs:
+                return 'after {0} instructions, the {1} differ: {2!r} instead of {3!r}'.format(
+                    count, name, mine, theirs)
+        if other.stopped == 'halt':
+            return None
+    return None
+
+def minimize(fails, program):
+    """Remove instructions from a failing program as long as it fails (fails
+    tells whether a program fails), return the shortest program found."""
+    chunk = len(program) // 2
+    while chunk >= 1:
+        i = 0
+        while i < len(program):
+            smaller = program[:i] + program[i + chunk:]
+            if smaller and fails(smaller):
+                program = smaller
+            else:
+                i += chunk
+        chunk //= 2
+    return program
+
+class Failure:
+    "A case on which an engine and the interpreter differ, minimized."
+
+    def __init__(self, engine, seed, program, input, difference):
+        self.engine = engine
+        self.seed = seed
+        self.program = program
+        self.input = input
+        self.difference = difference
+
+    def __str__(self):
+        return '{0} (seed {1}, input {2!r}): {3}\n{4}'.format(
+            self.engine, self.seed, self.input, self.difference, listing(self.program))
+
+def fuzz(engine, seed, cases, steps=1000, every=50, size=12):
+    "Run some cases on an engine (by name), return the failures."
+    failures = []
+    for case in range(seed, seed + cases):
+        rng = random.Random(case)
+        program = generate(rng, size)
+        input = bytes(rng.randrange(256) for _ in range(rng.randrange(8)))
+        run = lambda program: diverges(engines[engine], program, input, steps, every)
+        if run(program) is not None:
+            program = minimize(lambda program: run(program) is not None, program)
+            failures.append(Failure(engine, case, program, input, run(program)))
+    return failures
+
+def shard(arguments):
+    return fuzz(*arguments)
+
+def campaign(names, cases, seed=0, jobs=1, shards=None, **options):
+    """Fuzz engines (by name) with cases each, the cases are split in shards
+    run on jobs processes. Return the failures."""
+    shards = shards or max(1, jobs * 4)
+    size = -(-cases // shards)
+    work = [(name, start, min(size, seed + cases - start), options.get('steps', 1000),
+             options.get('every', 50), options.get('size', 12))
+            for name in names for start in range(seed, seed + cases, size)]
+    if jobs > 1:
+        import multiprocessing
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(jobs) as pool:
+            results = pool.map(shard, work)
+    else:
+        results = map(shard, work)
+    return [failure for failures in results for failure in failures]
+
+###############################################################
+
+class Broken(Interpreter):
+    "An engine that gets putc wrong, to test the fuzzer."
+
+    def __init__(self, program, input, every):
+        super().__init__(program, input)
+
+    def state(self):
+        ram, registers, flags, output = super().state()
+        return ram, registers, flags, output.upper()
+
+def test_generate():
+    rng = random.Random(1)
+    for _ in range(10):
+        for instruction in generate(rng):
+            check(disassamble_insctruction(instruction) is not None)
+
+def test_engines():
+    for name in engines:
+        check(campaign([name], 200, seed=0, steps=500) == [])
+
+def test_minimize():
+    engines['broken'] = Broken
+    try:
+        failures = fuzz('broken', 0, 100, steps=200)
+    finally:
+        del engines['broken']
+    check(failures)
+    for failure in failures:
+        [instruction] = failure.program
+        check(operation_table[instruction[0]].does('putc'))
+        check('output' in failure.difference)
+
+def test_campaign():
+    check(campaign(['compiler'], 40, seed=1000, jobs=2) == [])
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        parser = argparse.ArgumentParser(description="Compare the engines with the interpreter on random programs")
+        parser.add_argument('--engine', action='append', choices=sorted(engines), help='engine to check (default: all)')
+        parser.add_argument('--cases', type=int, default=1000, help='number of programs per engine')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the first case')
+        parser.add_argument('--jobs', '-j', type=int, default=1, help='number of processes')
+        parser.add_argument('--steps', type=int, default=1000, help='most instructions executed per case')
+        parser.add_argument('--every', type=int, default=50, help='compare the machines every N instructions')
+        parser.add_argument('--size', type=int, default=12, help='number of instructions per program')
+        args = parser.parse_args()
+        failures = campaign(args.engine or sorted(engines), args.cases, args.seed, args.jobs,
+                            steps=args.steps, every=args.every, size=args.size)
+        for failure in failures:
+            print(failure, end='\n\n')
+        print('{0} failure(s)'.format(len(failures)))
+        sys.exit(1 if failures else 0)
+    test_generate()
+    test_minimize()
+    test_engines()
+    test_campaign()
+    print()
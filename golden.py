@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#
+# Check the programs against their expected output and registers
+#
+# A program (NAME.asm) is tested when it has sidecar fixtures next to it:
+#
+#   NAME.in     the input it reads (bytes), none by default
+#   NAME.out    the output it must print
+#   NAME.regs   the registers and flags it must end with, e.g. "b=3 zf=1"
+#
+# The programs run on processes of their own, on a machine detecting the
+# infinite loops (see loops). The results are cached by hash of the source,
+# of the fixtures and of the engine (the modules running the programs), so
+# only what changed runs again. A failure shows what differs: where the
+# output starts to differ, and the registers that differ.
+#
+
+import os
+import sys
+import json
+import glob
+import hashlib
+import argparse
+import functools
+import image
+import loops
+from assamble import register_codec
+from console import capture
+from utils import check, copy
+
+fixtures = ['.in', '.out', '.regs']
+
+def engine_version():
+    """A hash of the modules assambling and running the programs: the
+    toolchain making the images, and the ones running them."""
+    import alu, console
+    digest = hashlib.sha256(image.toolchain())
+    for module in [alu, console, loops, sys.modules[__name__]]:
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+cache_directory = os.path.join(image.cache_directory, 'golden')
+
+def discover(paths):
+    "The programs with fixtures in some files and directories (recursively)."
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = sorted(glob.glob(os.path.join(path, '**', '*.asm'), recursive=True))
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            stem = os.path.splitext(candidate)[0]
+            if os.path.exists(stem + '.out') or os.path.exists(stem + '.regs'):
+                programs.append(candidate)
+    return programs
+
+def read_fixtures(path):
+    "The fixtures of a program, by extension, None when missing."
+    stem = os.path.splitext(path)[0]
+    result = {}
+    for extension in fixtures:
+        try:
+            with open(stem + extension, 'rb') as file:
+                result[extension] = file.read()
+        except FileNotFoundError:
+            result[extension] = None
+    return result
+
+def parse_registers(text):
+    "Parse expected registers and flags: name=value, separated by spaces."
+    expected = {}
+    for item in text.split():
+        [name, value] = item.split('=')
+        if name not in register_codec:
+            raise ValueError('unknown register: {0}'.format(name))
+        expected[name] = int(value)
+    return expected
+
+def output_diff(expected, actual, context=10):
+    "Where two outputs start to differ, with some context."
+    i = 0
+    while i < min(len(expected), len(actual)) and expected[i] == actual[i]:
+        i += 1
+    start = max(0, i - context)
+    return 'output differs at char {0}: expected {1!r}, got {2!r}'.format(
+        i, expected[start:i + context], actual[start:i + context])
+
+def check_program(path, level=1):
+    """Run a program with its fixtures, return the result: its status ('pass',
+    'fail' or 'error'), the differences and the instruction count."""
+    with open(path, 'rb') as file:
+        source = file.read()
+    given = read_fixtures(path)
+    result = {'path': path, 'status': 'pass', 'diff': [], 'instructions': 0}
+    machine = loops.HashedMachine(io=capture(given['.in'] or b''))
+    try:
+        binary, _ = image.build(source.decode(), level)
+        copy(binary, machine.ram)
+        result['instructions'] = loops.run(machine)
+    except Exception as e:
+        result['status'] = 'error'
+        result['diff'].append('{0}: {1}'.format(type(e).__name__, e))
+    machine.io.flush()
+    output = machine.io.file.getvalue()
+    result['output_differs'] = given['.out'] is not None and output != given['.out'].decode()
+    if result['output_differs']:
+        result['diff'].append(output_diff(given['.out'].decode(), output))
+    if given['.regs'] is not None:
+        machine.settle_flags()
+        for name, value in parse_registers(given['.regs'].decode()).items():
+            actual = machine.read(register_codec.index(name))
+            if actual != value:
+                result['diff'].append('{0}: expected {1}, got {2}'.format(name, value, actual))
+    if result['diff'] and result['status'] == 'pass':
+        result['status'] = 'fail'
+    result['output'] = output
+    return result
+
+def cache_key(path, level, version):
+    digest = hashlib.sha256(version.encode() + bytes([level]))
+    with open(path, 'rb') as file:
+        digest.update(hashlib.sha256(file.read()).digest())
+    for extension, content in sorted(read_fixtures(path).items()):
+        digest.update(extension.encode())
+        digest.update(b'-' if content is None else hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+def cached_check(path, level=1, cache=cache_directory, version=None):
+    "check_program, or its result when it ran before with the same inputs."
+    if cache is None:
+        return dict(check_program(path, level), cached=False)
+    entry = os.path.join(cache, cache_key(path, level, version or engine_version()) + '.json')
+    try:
+        with open(entry) as file:
+            return dict(json.load(file), path=path, cached=True)
+    except (OSError, ValueError):
+        pass
+    result = check_program(path, level)
+    try:
+        os.makedirs(cache, exist_ok=True)
+        temporary = '{0}.{1}.tmp'.format(entry, os.getpid())
+        with open(temporary, 'w') as file:
+            json.dump(result, file)
+        os.replace(temporary, entry)
+    except OSError:
+        pass
+    return dict(result, cached=False)
+
+def run_all(paths, jobs=1, level=1, cache=cache_directory):
+    "Check programs on jobs processes, return the results in order."
+    check_one = functools.partial(cached_check, level=level, cache=cache, version=engine_version())
+    if jobs > 1 and len(paths) > 1:
+        import multiprocessing
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(jobs) as pool:
+            return pool.map(check_one, paths)
+    return list(map(check_one, paths))
+
+def update(result):
+    """Make the output of a failing program its expected output, return
+    whether it did. The programs that didn't run to the end (errors) and
+    the ones with the expected output are left alone."""
+    if result['status'] != 'fail' or not result['output_differs']:
+        return False
+    with open(os.path.splitext(result['path'])[0] + '.out', 'w', newline='') as file:
+        file.write(result['output'])
+    return True
+
+###############################################################
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+def test_programs():
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, 'cache')
+        hi = os.path.join(directory, 'hi.asm')
+        write(hi, "putc 'h'\nmov 3 b\nputc 'i'\nhalt")
+        write(os.path.join(directory, 'hi.out'), 'hi')
+        write(os.path.join(directory, 'hi.regs'), 'b=3 a=0\nzf=0')
+        echo = os.path.join(directory, 'sub', 'echo.asm')
+        os.mkdir(os.path.dirname(echo))
+        with open('examples/echo.asm') as file:
+            write(echo, file.read())
+        write(os.path.join(directory, 'sub', 'echo.in'), 'ab\rq')
+        write(os.path.join(directory, 'sub', 'echo.out'), 'ab\r\nq')
+        write(os.path.join(directory, 'loop.asm'), 'loop: jmp loop')
+        write(os.path.join(directory, 'loop.regs'), '')
+        write(os.path.join(directory, 'untested.asm'), 'halt')
+
+        paths = discover([directory])
+        check([os.path.basename(path) for path in paths] == ['hi.asm', 'loop.asm', 'echo.asm'])
+        results = run_all(paths, jobs=2, cache=cache)
+        check([result['status'] for result in results] == ['pass', 'error', 'pass'])
+        check('InfiniteLoop' in results[1]['diff'][0])
+        check(not any(result['cached'] for result in results))
+        check(all(result['cached'] for result in run_all(paths, cache=cache)))
+
+        # only what changed runs again, and the differences are minimal
+        write(os.path.join(directory, 'hi.out'), 'ho')
+        write(os.path.join(directory, 'hi.regs'), 'b=2 c=0')
+        results = run_all(paths, cache=cache)
+        check([result['cached'] for result in results] == [False, True, True])
+        check(results[0]['status'] == 'fail')
+        check(results[0]['diff'] == ["output differs at char 1: expected 'ho', got 'hi'",
+                                     'b: expected 2, got 3'])
+        check(check_program(paths[0], 0)['diff'] == results[0]['diff'])
+
+        # only the output of the failures is updated
+        loop_out = os.path.join(directory, 'loop.out')
+        write(loop_out, 'never')
+        write(os.path.join(directory, 'sub', 'echo.regs'), 'd=1')
+        results = run_all(paths, cache=None)
+        check([result['status'] for result in results] == ['fail', 'error', 'fail'])
+        check([update(result) for result in results] == [True, False, False])
+        with open(loop_out) as file:
+            check(file.read() == 'never')
+        results = run_all(paths, cache=None)
+        check(results[0]['diff'] == ['b: expected 2, got 3'])
+        check(not update(results[0]))
+        write(os.path.join(directory, 'hi.regs'), 'b=3')
+        check(run_all(paths[:1], cache=None)[0]['status'] == 'pass')
+
+def test_output_diff():
+    check(output_diff('abc', 'abd') == "output differs at char 2: expected 'abc', got 'abd'")
+    check(output_diff('ab', 'abc') == "output differs at char 2: expected 'ab', got 'abc'")
+    check(output_diff('x' * 30 + 'y', 'x' * 31).endswith(
+        "at char 30: expected 'xxxxxxxxxxy', got 'xxxxxxxxxxx'"))
+
+def test_examples():
+    results = run_all(discover(['examples']), cache=None)
+    check(len(results) == 5)
+    check(all(result['status'] == 'pass' for result in results))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        parser = argparse.ArgumentParser(description="Check the programs against their expected output and registers")
+        parser.add_argument('paths', nargs='+', help='programs, or directories to search for programs with fixtures')
+        parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='number of processes')
+        parser.add_argument('-O', type=int, default=1, choices=[0, 1], dest='level', help='optimization level')
+        parser.add_argument('--no-cache', action='store_true', help='run every program, and cache nothing')
+        parser.add_argument('--update', action='store_true', help='make the output of the programs failing on it their expected output')
+        args = parser.parse_args()
+        results = run_all(discover(args.paths), args.jobs, args.level,
+                          None if args.no_cache else cache_directory)
+        failed = 0
+        updated = 0
+        for result in results:
+            print('{0:<6} {1}{2}'.format(result['status'], result['path'],
+                                         ' (cached)' if result['cached'] else ''))
+            for line in result['diff']:
+                print('         ' + line)
+            if result['status'] != 'pass':
+                failed += 1
+                # fixed when the output was all that differed
+                if args.update and update(result) and len(result['diff']) == 1:
+                    updated += 1
+        print('{0} passed, {1} failed'.format(len(results) - failed, failed - updated) +
+              (', {0} updated'.format(updated) if args.update else ''))
+        sys.exit(1 if failed > updated else 0)
+    test_output_diff()
+    test_programs()
+    test_examples()
+    print()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# Save linked programs as binary images, and cache them
+#
+# An image is a header, the code (the bytes to copy to the ram) and the
+# symbol table, so the debugger and the profiler still know the labels:
+#
+#   magic (4 bytes), format (1), isa (8), code length (2), labels count (2)
+#   code
+#   each label: name length (1), name (utf-8), address (1)
+#
+# isa is a hash of the instruction set (meta.operations and the registers),
+# an image made for another instruction set is refused. load() runs .bin
+# files as they are, and caches the images of the sources by hash of their
+# content and of the toolchain (the modules making the images), so an
+# unchanged source is not assambled again.
+#
+
+import os
+import sys
+import struct
+import hashlib
+import functools
+from meta import operations, register_names, flag_names
+from assamble import assamble, link, symbols
+from optimizer import optimize
+from utils import check
+
+magic = b'VMBI'
+format_version = 1
+header = struct.Struct('>4sB8sHH')
+
+isa = hashlib.sha256(repr((operations, register_names, flag_names)).encode()).digest()[:8]
+
+# The modules making the images, a change to one of them invalidates the cache
+here = os.path.dirname(os.path.abspath(__file__))
+toolchain_files = [os.path.join(here, name + '.py') for name in
+                   ['meta', 'tables', 'utils', 'assamble', 'optimizer', 'core', 'image']]
+
+@functools.lru_cache()
+def toolchain():
+    "A hash of the instruction set and of the source of the toolchain."
+    digest = hashlib.sha256(isa)
+    for path in toolchain_files:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.digest()
+
+cache_directory = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'emu')
+
+class ImageError(Exception):
+    "A file is not an image this machine can run."
+
+def dumps(binary, labels):
+    """The image of a linked program, as bytes. Raise ValueError when a label
+    doesn't fit (a name of more than 255 bytes, an address out of the ram)."""
+    parts = [header.pack(magic, format_version, isa, len(binary), len(labels)), bytes(binary)]
+    for name, address in labels.items():
+        encoded = name.encode()
+        if len(encoded) > 255:
+            raise ValueError('label {0} is too long for an image, 255 bytes at most'.format(name))
+        if not 0 <= address < 256:
+            raise ValueError('label {0} is at {1}, out of the ram'.format(name, address))
+        parts.append(bytes([len(encoded)]) + encoded + bytes([address]))
+    return b''.join(parts)
+
+def loads(data):
+    "The linked program and the labels of an image: (binary, labels)."
+    if len(data) < header.size:
+        raise ImageError('truncated image')
+    [kind, version, image_isa, length, count] = header.unpack_from(data)
+    if kind != magic or version != format_version:
+        raise ImageError('not an image')
+    if image_isa != isa:
+        raise ImageError('made for another instruction set')
+    position = header.size + length
+    binary = list(data[header.size:position])
+    labels = {}
+    try:
+        for _ in range(count):
+            size = data[position]
+            labels[data[position + 1:position + 1 + size].decode()] = data[position + 1 + size]
+            position += size + 2
+    except IndexError:
+        raise ImageError('truncated image')
+    if len(binary) != length:
+        raise ImageError('truncated image')
+    return binary, labels
+
+def build(source, level=1):
+    "Assamble, optimize and link a source: (binary, labels)."
+    obj = optimize(assamble(source), level)
+    return link(obj), symbols(obj)
+
+def save(path, binary, labels):
+    "Write an image, atomically (a concurrent reader sees all of it or nothing)."
+    data = dumps(binary, labels)
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+def load(path, level=1, cache=cache_directory):
+    """The linked program and the labels of a file: an image (.bin) or a
+    source, compiled or taken from the cache (a directory, None for no
+    cache)."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if path.endswith('.bin'):
+        return loads(data)
+    if cache is None:
+        return build(data.decode(), level)
+    key = hashlib.sha256(data + bytes([level]) + toolchain()).hexdigest()
+    cached = os.path.join(cache, key + '.bin')
+    try:
+        with open(cached, 'rb') as file:
+            return loads(file.read())
+    except (OSError, ImageError):
+        pass
+    binary, labels = build(data.decode(), level)
+    try:
+        os.makedirs(cache, exist_ok=True)
+        save(cached, binary, labels)
+    except (OSError, ValueError):
+        pass    # a cache that can't be written (or a program with no image) is no cache
+    return binary, labels
+
+###############################################################
+
+def test_images():
+    with open('examples/count.asm') as file:
+        binary, labels = build(file.read())
+    check(loads(dumps(binary, labels)) == (binary, labels))
+    check(loads(dumps([], {})) == ([], {}))
+
+    for bad in [{'x' * 256: 0}, {'far': 256}, {'before': -1}]:
+        try:
+            dumps([0], bad)
+            check(False)
+        except ValueError:
+            check(True)
+    check(loads(dumps([0], {'x' * 255: 255})) == ([0], {'x' * 255: 255}))
+
+    data = dumps(binary, labels)
+    for bad in [data[:5], data[:-1], b'nope' + data[4:],
+                data[:5] + bytes(8) + data[13:]]:
+        try:
+            loads(bad)
+            check(False)
+        except ImageError:
+            check(True)
+
+def test_load():
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, 'cache')
+        source = os.path.join(directory, 'count.asm')
+        with open('examples/count.asm') as file, open(source, 'w') as copy:
+            copy.write(file.read())
+        expected = load(source, cache=None)
+
+        # compiled once, then read from the cache
+        check(load(source, cache=cache) == expected)
+        [entry] = os.listdir(cache)
+        check(load(source, cache=cache) == expected)
+        with open(os.path.join(cache, entry), 'wb') as file:
+            file.write(dumps([0], {}))
+        check(load(source, cache=cache) == ([0], {}))
+
+        # a broken entry is replaced
+        with open(os.path.join(cache, entry), 'wb') as file:
+            file.write(b'broken')
+        check(load(source, cache=cache) == expected)
+        with open(os.path.join(cache, entry), 'rb') as file:
+            check(loads(file.read()) == expected)
+
+        # another level or another source is another entry
+        load(source, 0, cache=cache)
+        check(len(os.listdir(cache)) == 2)
+        with open(source, 'a') as file:
+            file.write('\n')
+        check(load(source, cache=cache) == expected)
+        check(len(os.listdir(cache)) == 3)
+
+        # a program whose labels don't fit in an image still runs
+        long = os.path.join(directory, 'long.asm')
+        with open(long, 'w') as file:
+            file.write('halt\n{0}:\nhalt'.format('x' * 300))
+        check(load(long, cache=cache)[0] == [0, 0])
+        check(len(os.listdir(cache)) == 3)
+
+        # so is another version of the toolchain
+        tool = os.path.join(directory, 'tool.py')
+        with open(tool, 'w') as file:
+            file.write('version = 1')
+        toolchain_files.append(tool)
+        try:
+            toolchain.cache_clear()
+            check(load(source, cache=cache) == expected)
+            check(len(os.listdir(cache)) == 4)
+            with open(tool, 'w') as file:
+                file.write('version = 2')
+            toolchain.cache_clear()
+            check(load(source, cache=cache) == expected)
+            check(len(os.listdir(cache)) == 5)
+        finally:
+            toolchain_files.remove(tool)
+            toolchain.cache_clear()
+
+        path = os.path.join(directory, 'count.bin')
+        save(path, *expected)
+        check(load(path) == expected)
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        # ./image.py FILE.bin: print the labels and the code of an image
+        binary, labels = load(sys.argv[1], cache=None)
+        print(labels)
+        print(binary)
+        sys.exit()
+    test_images()
+    test_load()
+    print()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Detect the programs that loop forever
+#
+# The state of a machine is small: when it comes back to a state it was in
+# before, without reading input in between, it will loop forever. run()
+# hashes the state each time the instruction pointer goes backward and
+# stops when a state repeats. The hash of the ram and the registers is
+# updated on each write by HashedMachine, so it is cheap to check.
+#
+
+from core import Machine, ip_register, ram_size
+from assamble import codec, assamble, link
+from utils import check, copy
+from console import capture
+
+class InfiniteLoop(Exception):
+    "The machine came back to a state it was in, period instructions ago."
+
+    def __init__(self, address, period, count):
+        super().__init__("infinite loop at address {0}, the state repeats every "
+                         "{1} instructions".format(address, period))
+        self.address = address
+        self.period = period
+        self.count = count
+
+def mix(position, value):
+    "The hash of one byte of ram (or one register) holding a value."
+    return hash((position, value))
+
+class HashedMachine(Machine):
+    "A machine that keeps the hash of its ram and registers (digest) up to date."
+
+    __slots__ = ('digest',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rehash()
+
+    def rehash(self):
+        "Compute the hash from scratch (after writing to ram or registers directly)."
+        digest = 0
+        for address, value in enumerate(self.ram):
+            digest ^= mix(address, value)
+        for register, value in enumerate(self.registers):
+            digest ^= mix(ram_size + register, value)
+        self.digest = digest
+
+    def set_register(self, register, value):
+        position = ram_size + register
+        self.digest ^= mix(position, self.registers[register]) ^ mix(position, value)
+        Machine.set_register(self, register, value)
+
+    def set_ram(self, address, value):
+        old = self.ram[address]
+        Machine.set_ram(self, address, value)
+        address %= ram_size
+        self.digest ^= mix(address, old) ^ mix(address, self.ram[address])
+
+    def state_hash(self):
+        self.settle_flags()
+        return hash((self.digest, tuple(self.flags)))
+
+def hashed(machine):
+    """A HashedMachine in the same state as a machine, with the same device
+    and the same ram (a mapped file, for emu --ram)."""
+    other = HashedMachine(machine.lazy_flags, machine.alu_tables, machine.io, machine.ram)
+    other.restore(machine.snapshot())
+    other.trace = machine.trace
+    other.rehash()
+    return other
+
+# The opcodes reading input, after them the previous states don't count
+reads_input = [name.startswith('getc') for (name, _, _) in codec]
+
+def run(machine, limit=100000):
+    """Run a HashedMachine until halt, returning the number of instructions
+    executed. Raise InfiniteLoop when the machine repeats a state.
+
+    The hashes of the states seen are kept (at most limit of them). When a
+    hash comes back the state is saved, it is a loop when the same state
+    comes back again."""
+    m = machine
+    m.invalidate_all()
+    m.rehash()
+    registers = m.registers
+    ram = m.ram
+    seen = {}        # instruction count, by state hash
+    candidates = {}  # snapshot, by state hash
+    count = 0
+    while True:
+        count += 1
+        ip = registers[ip_register]
+        fn, arguments, length = m.decode(ip)
+        if fn is None:
+            m.settle_flags()
+            m.io.flush()
+            return count
+        if reads_input[ram[ip]]:
+            seen.clear()
+            candidates.clear()
+
+        if length:
+            m.inc_ip(length)
+        old_ip = registers[ip_register]
+        fn(m, *arguments)
+        if old_ip == registers[ip_register]:
+            m.inc_ip()
+
+        if registers[ip_register] <= ip:
+            key = m.state_hash()
+            previous = seen.get(key)
+            if previous is not None:
+                snapshot = m.snapshot()
+                if candidates.get(key) == snapshot:
+                    raise InfiniteLoop(registers[ip_register], count - previous, count)
+                candidates[key] = snapshot
+            elif len(seen) >= limit:
+                seen.clear()
+                candidates.clear()
+            seen[key] = count
+
+###############################################################
+
+def run_source(source, text=''):
+    machine = HashedMachine(io=capture(text))
+    copy(link(assamble(source)), machine.ram)
+    return machine, run(machine)
+
+def test_loops():
+    try:
+        run_source("mov 1\nloop: jmp loop")
+        check(False)
+    except InfiniteLoop as e:
+        check((e.address, e.period) == (2, 1))
+
+    # b counts from 0 to 127, then wraps around to -128
+    try:
+        run_source("mov 1 c\nloop:\nadd 1 b\njmp loop")
+        check(False)
+    except InfiniteLoop as e:
+        check((e.address, e.period) == (3, 2 * 256))
+
+def test_halts():
+    with open('examples/count.asm') as file:
+        source = file.read()
+    machine, count = run_source(source)
+    other = Machine(io=capture())
+    copy(link(assamble(source)), other.ram)
+    check(count == other.run())
+    check(machine.snapshot() == other.snapshot())
+
+    # waiting for input is not looping
+    with open('examples/echo.asm') as file:
+        source = file.read()
+    machine, count = run_source(source, 'aaaaaaaaaaq')
+    check(machine.io.file.getvalue() == 'aaaaaaaaaaq')
+
+def test_digest():
+    machine = HashedMachine()
+    machine.op_push(3)
+    machine.op_mov(5, 1)
+    digest = machine.digest
+    machine.rehash()
+    check(machine.digest == digest)
+    # back to the initial state
+    machine.op_pop(1)
+    machine.op_mov(0, 1)
+    machine.op_mov(0, 6)
+    machine.set_ram(-1, 0)
+    check(machine.digest == HashedMachine().digest)
+
+def test_hashed():
+    # the program writes to the ram of the machine given to hashed()
+    import tempfile, os
+    from memory import MappedRam
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ram')
+        mapped = MappedRam(path)
+        machine = Machine(io=capture(), ram=mapped.view)
+        copy(link(assamble("mov 100 c\nmov 7 a\nstore c a\nhalt")), machine.ram)
+        run(hashed(machine))
+        mapped.close()
+        with open(path, 'rb') as file:
+            check(file.read()[100] == 7)
+
+if __name__ == '__main__':
+    test_loops()
+    test_halts()
+    test_digest()
+    test_hashed()
+    print()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# Back the ram of a machine with a file mapped in memory
+#
+# The bytes of the file are the ram: other processes can read it while the
+# machine runs (./memory.py dump FILE --follow), and it is still there once
+# the machine halted, for a later run to start from.
+#
+
+import os
+import sys
+import time
+import mmap
+from core import Machine, ram_size
+from assamble import assamble, link
+from utils import check, copy
+from console import capture
+
+class MappedRam:
+    """A file of ram_size bytes mapped in memory, created (zeroed) when it
+    doesn't exist. Use view as the ram of a machine. Raise ValueError when
+    the file exists with another size (it's not a ram, don't overwrite it)."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            os.ftruncate(fd, ram_size)
+        except FileExistsError:
+            fd = os.open(path, os.O_RDWR)
+        size = os.fstat(fd).st_size
+        if size != ram_size:
+            os.close(fd)
+            raise ValueError("{0} has {1} bytes, not {2}: it's not a ram".format(path, size, ram_size))
+        self.file = os.fdopen(fd, 'r+b')
+        self.map = mmap.mmap(fd, ram_size)
+        # indexing a memoryview gives ints, like a bytearray (not an mmap)
+        self.view = memoryview(self.map)
+
+    def flush(self):
+        "Write the changes to the file now (the system does it eventually)."
+        self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def read(path):
+    "The ram saved in a file, without mapping it."
+    with open(path, 'rb') as file:
+        return file.read(ram_size)
+
+def dump(data, width=16):
+    "Format bytes as lines of hexadecimal, with their address."
+    return '\n'.join('{0:3}: {1}'.format(address, ' '.join(
+        '{0:02x}'.format(byte) for byte in data[address:address + width]))
+        for address in range(0, len(data), width))
+
+###############################################################
+
+def test_mapped():
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ram')
+        with open('examples/count.asm') as file:
+            binary = link(assamble(file.read()))
+        with MappedRam(path) as ram:
+            machine = Machine(io=capture(), ram=ram.view)
+            copy(binary, machine.ram)
+            # the file sees the writes, and the ram the writes to the file
+            check(read(path)[:len(binary)] == bytes(binary))
+            machine.op_push(42)
+            check(read(path)[255] == 42)
+            with open(path, 'r+b') as file:
+                file.seek(254)
+                file.write(b'\x07')
+            check(machine.ram[254] == 7)
+            machine.run()
+            check(machine.io.file.getvalue() == 'ok')
+            snapshot = machine.snapshot()
+
+        # a later run starts from the same memory
+        with MappedRam(path) as ram:
+            machine = Machine(ram=ram.view)
+            check(bytes(machine.ram) == snapshot[:ram_size])
+            check(machine.ram[255] == 42)
+
+        # a file that's not a ram is left alone
+        notes = os.path.join(directory, 'notes.txt')
+        with open(notes, 'w') as file:
+            file.write('important')
+        try:
+            MappedRam(notes)
+            check(False)
+        except ValueError:
+            with open(notes) as file:
+                check(file.read() == 'important')
+
+        # the ram of a machine must have the right size
+        try:
+            Machine(ram=bytearray(10))
+            check(False)
+        except ValueError:
+            check(True)
+
+def test_copy():
+    ram = bytearray(8)
+    copy([1, 2], ram, 3)
+    check(ram == bytearray([0, 0, 0, 1, 2, 0, 0, 0]))
+    try:
+        copy([1, 2], ram, 7)
+        check(False)
+    except IndexError:
+        check(True)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['dump']:
+        # ./memory.py dump FILE [--follow]: print the ram saved in a file
+        while True:
+            print(dump(read(sys.argv[2])), flush=True)
+            if '--follow' not in sys.argv:
+                break
+            time.sleep(0.5)
+            print()
+        sys.exit()
+    test_mapped()
+    test_copy()
+    print()
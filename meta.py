@@ -60,7 +60,18 @@ operations = [
         'pop r',
         'call i',
         'call r',
-        'ret'
+        'ret',
+        # superinstructions, doing the work of two instructions (see optimizer.py)
+        ['cmpjo cmpjno cmpjz cmpjnz cmpjl cmpjle cmpjge cmpjpe cmpjpo cmpjaz', 'i i'],
+        ['cmpjo cmpjno cmpjz cmpjnz cmpjl cmpjle cmpjge cmpjpe cmpjpo cmpjaz', 'r i'],
+        'subjnz i r i',
+        'pushpop',
+        'pushpop i r',
+        'pushpop r r',
+        'movputc i',
+        'movputc r',
+        'movputc i r',
+        'movputc r r',
     ]
 
 def expand(spec):
@@ -76,8 +87,35 @@ def expand(spec):
     else:
         yield spec
 
-operations = list(chain(*map(expand, operations)))
+# The tables derived from operations are generated into tables.py (see
+# freeze), they are used as long as operations doesn't change.
+specification = operations
+try:
+    import tables as frozen
+    if frozen.specification != specification:
+        frozen = None
+except ImportError:
+    frozen = None
+
+if frozen:
+    operations = frozen.operations
+else:
+    operations = list(chain(*map(expand, specification)))
+
+def freeze(path='tables.py'):
+    "Generate the module holding operations, codec and opcodes."
+    from pprint import pformat
+    from assamble import compute_codec
+    codec, opcodes = compute_codec()
+    with open(path, 'w') as file:
+        file.write("# Generated by ./meta.py --freeze, do not edit\n\n")
+        for name, value in [('specification', specification), ('operations', operations),
+                            ('codec', codec), ('opcodes', opcodes)]:
+            file.write('{0} = {1}\n\n'.format(name, pformat(value, sort_dicts=False)))
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--freeze']:
+        freeze()
+        sys.exit()
     print_dotted_list(operations)
     print("There are {0} different operations.".format(len(operations)))
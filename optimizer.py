@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# Optimize the object code, between assamble and link
+#
+# optimize() removes the instructions that do nothing (see assamble.nops),
+# rewrites each instruction in its shortest encoding (e.g. "add 3 a" is
+# "add 3") and fuses some pairs of instructions into superinstructions,
+# which the machine executes with a single dispatch (see
+# core.superinstructions). The labels stay in the object code, link()
+# computes their new addresses.
+#
+# A program whose addresses can be seen is left as it is: one that calls
+# (ret comes back on the operand of call, the address of the function is
+# executed as an opcode), jumps to a register or to a number, reads the
+# instruction pointer, uses a label as data or loads and stores at a
+# constant address in its code. The programs are not expected to read or
+# write their own code at computed addresses.
+#
+
+import sys
+from core import operation_table, superinstructions, flag_offset, ip_register
+from assamble import codec, register_codec, decode_arguments
+from assamble import assamble, link, symbols, islabel, isreference
+from utils import check, copy
+
+accumulator = register_codec.index('a')
+
+jumps = ['jmp', 'jo', 'jno', 'jz', 'jnz', 'jl', 'jle', 'jge', 'jpe', 'jpo', 'jaz', 'call']
+
+def operation_name(opcode):
+    [op, operands, _] = codec[opcode]
+    return op[:-len(operands)] if operands else op
+
+# The encodings of each operation, by name: (opcode, operands), shortest first
+encodings = {}
+for opcode, (_, operands, length) in sorted(enumerate(codec), key=lambda c: c[1][2]):
+    if ',' not in operands:     # "cmp i, r" can't be assambled
+        encodings.setdefault(operation_name(opcode), []).append((opcode, operands))
+
+# The superinstruction doing each pair of operations
+fusions = {tuple(part for part, _ in parts): name
+           for name, parts in superinstructions.items()}
+
+def decode(instruction):
+    """Decode an instruction into (name, arguments), the arguments are
+    ('i', value) or ('r', register) and the omitted operands are filled in.
+    Return None for the instructions that can't be encoded again."""
+    [opcode, *arguments] = instruction
+    [_, operands, _] = codec[opcode]
+    operation = operation_table[opcode]
+    if ',' in operands:
+        return None
+    arguments = list(zip(operands, decode_arguments(arguments, operands)))
+    if operation is not None:
+        arguments += [('r', register) for register in operation.defaults]
+    return operation_name(opcode), arguments
+
+def encode(name, arguments):
+    "The shortest instruction doing an operation, None if there is none."
+    for opcode, operands in encodings.get(name, []):
+        defaults = operation_table[opcode].defaults if operation_table[opcode] else []
+        given = arguments[:len(operands)]
+        if (len(operands) + len(defaults) == len(arguments) and
+                ''.join(kind for kind, _ in given) == operands and
+                arguments[len(operands):] == [('r', register) for register in defaults]):
+            values = [value for _, value in given]
+            if operands == 'rr':
+                values = [values[0] << 4 | values[1]]
+            return [opcode] + values
+    return None
+
+def split(object_code):
+    "Split object code into labels and instructions (lists of bytes and references)."
+    items = []
+    i = 0
+    while i < len(object_code):
+        if islabel(object_code[i]):
+            items.append(object_code[i])
+            i += 1
+        else:
+            length = codec[object_code[i]][2]
+            items.append(object_code[i:i + length + 1])
+            i += length + 1
+    return items
+
+def addresses_seen(items):
+    "Whether the program can see the addresses of its code (see above)."
+    size = sum(len(item) for item in items if not islabel(item))
+    for item in items:
+        if islabel(item):
+            continue
+        decoded = decode(item)
+        if decoded is None:
+            continue
+        name, arguments = decoded
+        if name in ['call', 'ret']:
+            return True
+        for i, (kind, value) in enumerate(arguments):
+            if kind == 'r' and value == ip_register:
+                return True
+            if name in jumps and kind == 'r':
+                return True
+            if name in jumps and i == 0 and not isreference(value):
+                return True
+            if name not in jumps and isreference(value):
+                return True
+            if (name in ['load', 'store'] and i == 0 and kind == 'i' and
+                    0 <= value < size):
+                return True
+    return False
+
+def useless(name, arguments):
+    "Whether an instruction does nothing, like mov b b."
+    return (name == 'mov' and arguments[0] == arguments[1] and
+            arguments[0][1] < flag_offset)
+
+def fuse(first, second):
+    "The superinstruction doing two instructions, None if there is none."
+    name = fusions.get((first[0], second[0]))
+    if name is None:
+        return None
+    arguments = {}
+    for (part, indices), (_, part_arguments) in zip(superinstructions[name], [first, second]):
+        for i, argument in zip(indices, part_arguments):
+            if arguments.setdefault(i, argument) != argument:
+                return None
+    arguments = [arguments.get(i, ('r', accumulator)) for i in range(len(arguments))]
+    return encode(name, arguments)
+
+def optimize(object_code, level=1):
+    """Optimize object code, the result is linked as usual. At level 0 it is
+    returned as it is."""
+    items = split(object_code)
+    if level < 1 or addresses_seen(items):
+        return list(object_code)
+    # rewrite or remove each instruction
+    rewritten = []
+    for item in items:
+        decoded = None if islabel(item) else decode(item)
+        if decoded is None:
+            rewritten.append((item, None))
+        elif not useless(*decoded):
+            rewritten.append((encode(*decoded), decoded))
+    # fuse the pairs of instructions, unless there's a label between them
+    result = []
+    i = 0
+    while i < len(rewritten):
+        item, decoded = rewritten[i]
+        if decoded is not None and i + 1 < len(rewritten) and rewritten[i + 1][1] is not None:
+            fused = fuse(decoded, rewritten[i + 1][1])
+            if fused is not None:
+                result.extend(fused)
+                i += 2
+                continue
+        result.extend([item] if islabel(item) else item)
+        i += 1
+    return result
+
+###############################################################
+
+def run_source(source, level, text=''):
+    from core import Machine
+    from console import capture
+    obj = optimize(assamble(source), level)
+    machine = Machine(io=capture(text))
+    copy(link(obj), machine.ram)
+    count = machine.run()
+    return machine, count, obj
+
+def test_rewrites():
+    check(optimize(assamble("add 3 a\nmov b b\nnot a\npush a\nhalt")) ==
+          assamble("add 3\nnot\npush\nhalt"))
+    # the same layout at level 0
+    source = "add 3 a\nmov b b\nhalt"
+    check(optimize(assamble(source), 0) == assamble(source))
+    # writing to a flag is left to fail
+    check(optimize(assamble("mov zf zf")) == assamble("mov zf zf"))
+
+def test_fusions():
+    obj = optimize(assamble("""
+    mov 'h'
+    putc
+    loop:
+    sub 1 b
+    jnz loop
+    push 3
+    pop c
+    cmp 10
+    jz loop
+    halt"""))
+    names = [codec[item[0]][0] for item in split(obj) if not islabel(item)]
+    check(names == ['movputci', 'subjnziri', 'pushpopir', 'cmpjzii', 'halt'])
+    check(symbols(obj) == {'loop': 2})
+
+    # not across a label
+    obj = optimize(assamble("mov 'h'\nhere: putc\nhalt"))
+    check(len(link(obj)) == 4)
+
+def test_addresses_seen():
+    for source in ["mov 3 a\ncall f\nhalt\nf: ret",
+                   "mov 3 a\njmp 5",
+                   "mov 3 a\nmov here b\nhere: halt",
+                   "mov 3 a\nload 1",
+                   "mov 3 a\nmov ip b"]:
+        check(optimize(assamble(source)) == assamble(source))
+
+def test_same_results():
+    sources = []
+    for name in ['hi', 'count', 'echo', 'stack']:
+        with open('examples/{0}.asm'.format(name)) as file:
+            sources.append(file.read())
+    for source in sources:
+        reference, count, _ = run_source(source, 0, 'hi\rq')
+        optimized, optimized_count, obj = run_source(source, 1, 'hi\rq')
+        check(reference.io.file.getvalue() == optimized.io.file.getvalue())
+        check(reference.registers[:ip_register] == optimized.registers[:ip_register])
+        check(reference.flags == optimized.flags)
+        check(optimized_count <= count)
+    # the loops run with half the instructions
+    _, count, _ = run_source(sources[1], 0)
+    _, optimized_count, _ = run_source(sources[1], 1)
+    check(optimized_count < 0.6 * count)
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        # print the optimized object code of a file
+        with open(sys.argv[1]) as file:
+            print(optimize(assamble(file.read())))
+        sys.exit()
+    test_rewrites()
+    test_fusions()
+    test_addresses_seen()
+    test_same_results()
+    print()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# Find where the programs spend their time
+#
+# Profile.run is a copy of Machine.run that counts the instructions executed
+# by opcode, address and label, measures the time spent in each handler, and
+# counts the jumps taken at each conditional jump. Machine.run itself is
+# left untouched, so profiling costs nothing when it is off.
+#
+
+import json
+import time
+from core import Machine, ip_register, ram_size, operation_table
+from assamble import codec, assamble, link, symbols, where, disassamble_insctruction
+from utils import check, copy
+from console import capture
+
+def is_conditional_jump(opcode):
+    "Whether an opcode is a conditional jump, or a superinstruction ending with one."
+    operation = operation_table[opcode]
+    return operation is not None and any(
+        part.name.startswith('j') and part.name != 'jmp'
+        for part in [operation] + [part for part, _ in operation.parts])
+
+conditional_jumps = [is_conditional_jump(opcode) for opcode in range(len(codec))]
+
+class Profile:
+    """Counts and times of the instructions executed by some machines.
+
+    A conditional jump counts as taken when it changes the instruction
+    pointer."""
+
+    def __init__(self, labels={}):
+        self.labels = labels    # the symbol table, from assamble.symbols
+        self.opcodes = [0] * len(codec)
+        self.times = [0.0] * len(codec)
+        self.addresses = [0] * ram_size
+        self.instructions = {}  # the bytes of the instruction at each address
+        self.branches = {}      # [taken, not taken] by address
+
+    def run(self, machine):
+        "Run a machine until halt, returning the number of instructions executed."
+        m = machine
+        m.invalidate_all()
+        registers = m.registers
+        ram = m.ram
+        opcodes = self.opcodes
+        times = self.times
+        addresses = self.addresses
+        clock = time.perf_counter
+        count = 0
+        while True:
+            count += 1
+            ip = registers[ip_register]
+            fn, arguments, length = m.decode(ip)
+            opcode = ram[ip]
+            opcodes[opcode] += 1
+            addresses[ip] += 1
+            if ip not in self.instructions:
+                self.instructions[ip] = [ram[(ip + i) % ram_size] for i in range(length + 1)]
+
+            if fn is None:
+                m.settle_flags()
+                m.io.flush()
+                return count
+
+            if length:
+                m.inc_ip(length)
+
+            old_ip = registers[ip_register]
+            start = clock()
+            fn(m, *arguments)
+            times[opcode] += clock() - start
+
+            if conditional_jumps[opcode]:
+                branch = self.branches.get(ip)
+                if branch is None:
+                    branch = self.branches[ip] = [0, 0]
+                branch[old_ip == registers[ip_register]] += 1
+
+            if old_ip == registers[ip_register]:
+                m.inc_ip()
+
+    def total(self):
+        return sum(self.opcodes)
+
+    def where(self, address):
+        "Name an address after the closest label before it (label+offset)."
+        return where(self.labels, address)
+
+    def by_label(self):
+        """The number of instructions executed after each label, until the
+        next one. The ones before the first label count for '0'."""
+        counts = {}
+        for address, count in enumerate(self.addresses):
+            if count:
+                name = self.where(address).split('+')[0]
+                if name.isdigit():
+                    name = '0'      # before the first label
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    def to_json(self):
+        return {
+            'instructions': self.total(),
+            'opcodes': {codec[opcode][0]: {'count': count, 'seconds': self.times[opcode]}
+                        for opcode, count in enumerate(self.opcodes) if count},
+            'addresses': {address: count
+                          for address, count in enumerate(self.addresses) if count},
+            'labels': self.by_label(),
+            'branches': {address: {'taken': taken, 'not_taken': not_taken}
+                         for address, (taken, not_taken) in sorted(self.branches.items())},
+        }
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_json(), file, indent=2)
+
+    def report(self, top=20):
+        "A text report, the biggest counts first."
+        total = self.total() or 1
+        lines = ['{0} instructions'.format(self.total()), '']
+        lines.append('{0:<16} {1:>10} {2:>7} {3:>12}'.format('opcode', 'count', '%', 'ns/call'))
+        for opcode in sorted(range(len(codec)), key=lambda opcode: -self.opcodes[opcode]):
+            count = self.opcodes[opcode]
+            if count:
+                lines.append('{0:<16} {1:>10} {2:>7.2%} {3:>12.0f}'.format(
+                    codec[opcode][0], count, count / total, 1e9 * self.times[opcode] / count))
+        lines.append('')
+        lines.append('{0:<16} {1:>10} {2:>7}  {3}'.format('address', 'count', '%', 'instruction'))
+        addresses = sorted(range(ram_size), key=lambda address: -self.addresses[address])
+        for address in addresses[:top]:
+            count = self.addresses[address]
+            if count:
+                lines.append('{0:<16} {1:>10} {2:>7.2%}  {3}'.format(
+                    self.where(address), count, count / total,
+                    ' '.join(map(str, disassamble_insctruction(self.instructions[address])))))
+        lines.append('')
+        lines.append('{0:<16} {1:>10} {2:>7}'.format('label', 'count', '%'))
+        for name, count in sorted(self.by_label().items(), key=lambda item: -item[1]):
+            lines.append('{0:<16} {1:>10} {2:>7.2%}'.format(name, count, count / total))
+        if self.branches:
+            lines.append('')
+            lines.append('{0:<16} {1:>10} {2:>10} {3:>7}'.format('branch', 'taken', 'not taken', 'taken%'))
+            for address, (taken, not_taken) in sorted(self.branches.items()):
+                lines.append('{0:<16} {1:>10} {2:>10} {3:>7.2%}'.format(
+                    self.where(address), taken, not_taken, taken / (taken + not_taken)))
+        return '\n'.join(lines)
+
+###############################################################
+
+def test_profile():
+    obj = assamble("""
+    mov 3 b
+    mov 1 c
+    loop:
+    sub 1 b
+    jnz loop
+    halt
+    """)
+    profile = Profile(symbols(obj))
+    machine = Machine(io=capture())
+    copy(link(obj), machine.ram)
+    check(profile.run(machine) == 9)
+    check(profile.total() == 9)
+    check(profile.opcodes[codec.index(('subir', 'ir', 2))] == 3)
+    check(profile.by_label() == {'0': 2, 'loop': 7})
+    check(profile.branches == {9: [2, 1]})
+    check(profile.where(9) == 'loop+3')
+    check(machine.registers[1] == 0)
+    data = json.loads(json.dumps(profile.to_json()))
+    check(data['branches'] == {'9': {'taken': 2, 'not_taken': 1}})
+    check('loop+3' in profile.report())
+
+def test_same_state():
+    with open('examples/call_ret.asm') as file:
+        binary = link(assamble(file.read()))
+    machines = []
+    for engine in [Machine.run, Profile().run]:
+        machine = Machine(io=capture())
+        copy(binary, machine.ram)
+        machines.append((engine(machine), machine.ram, machine.registers,
+                         machine.flags, machine.io.file.getvalue()))
+    check(machines[0] == machines[1])
+
+if __name__ == '__main__':
+    test_profile()
+    test_same_state()
+    print()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Run many machines on one asyncio event loop
+#
+# run() executes a slice of instructions, then lets the other tasks run.
+# Before getc, it waits for the device to have some input (AsyncDevice), so
+# a machine waiting for input doesn't block the others. Each run can be
+# limited in instructions, in chars printed and in time.
+#
+
+import io
+import time
+import asyncio
+from core import Machine, ip_register, operation_table
+from assamble import assamble, link
+from console import Device, BytesInput
+from utils import check, copy
+
+class BudgetExceeded(Exception):
+    """A machine used all its budget of instructions, output (chars) or
+    seconds. It stops before the instruction that would exceed it."""
+
+    def __init__(self, budget, limit, count):
+        super().__init__("exceeded the budget of {0} {1}".format(limit, budget))
+        self.budget = budget
+        self.limit = limit
+        self.count = count  # instructions executed
+
+class AsyncDevice(Device):
+    """A device whose input is fed while the machine runs, see feed() and
+    end(). Its output is captured by default."""
+
+    def __init__(self, file=None, **options):
+        super().__init__(BytesInput(), io.StringIO() if file is None else file, **options)
+        self.ended = False
+        self.event = asyncio.Event()
+
+    def feed(self, data):
+        "Add some input."
+        if isinstance(data, str):
+            data = data.encode()
+        input = self.input
+        input.start += input.position
+        input.data = input.data[input.position:] + data
+        input.position = 0
+        self.event.set()
+
+    def end(self):
+        "There will be no more input, getc raises EOFError once it's all read."
+        self.ended = True
+        self.event.set()
+
+    async def wait(self):
+        """Wait until getc can return (or raise EOFError) without blocking.
+        The output is written before waiting."""
+        input = self.input
+        while input.position >= len(input.data) and not self.ended:
+            self.flush()
+            self.event.clear()
+            await self.event.wait()
+
+# The opcodes reading input and printing (superinstructions included)
+reads_input = [operation is not None and operation.does('getc') for operation in operation_table]
+prints = [operation is not None and operation.does('putc') for operation in operation_table]
+
+async def run(machine, slice=1000, instructions=None, output=None, seconds=None):
+    """Run a machine until halt, returning the number of instructions
+    executed. Let the other tasks run every slice instructions, and while
+    waiting for input (when the device has a wait method) or for its output
+    to be written (when it has a drain method, called every slice). Raise
+    BudgetExceeded after more than instructions instructions, output chars
+    printed or seconds. The output is flushed however the run ends."""
+    m = machine
+    m.invalidate_all()
+    registers = m.registers
+    ram = m.ram
+    wait = getattr(m.io, 'wait', None)
+    drain = getattr(m.io, 'drain', None)
+    deadline = None if seconds is None else time.monotonic() + seconds
+    count = 0
+    printed = 0
+    try:
+        while True:
+            for _ in range(slice):
+                ip = registers[ip_register]
+                fn, arguments, length = m.decode(ip)
+                if fn is None:
+                    m.settle_flags()
+                    return count + 1
+                if count == instructions:
+                    raise BudgetExceeded('instructions', instructions, count)
+                opcode = ram[ip]
+                if reads_input[opcode] and wait is not None:
+                    if deadline is None:
+                        await wait()
+                    else:
+                        try:
+                            await asyncio.wait_for(wait(), deadline - time.monotonic())
+                        except asyncio.TimeoutError:
+                            raise BudgetExceeded('seconds', seconds, count)
+                elif prints[opcode]:
+                    if printed == output:
+                        raise BudgetExceeded('output', output, count)
+                    printed += 1
+                count += 1
+
+                if length:
+                    m.inc_ip(length)
+                old_ip = registers[ip_register]
+                fn(m, *arguments)
+                if old_ip == registers[ip_register]:
+                    m.inc_ip()
+
+            if deadline is not None and time.monotonic() > deadline:
+                raise BudgetExceeded('seconds', seconds, count)
+            if drain is not None:
+                await drain()
+            await asyncio.sleep(0)
+    finally:
+        m.io.flush()
+
+###############################################################
+
+def load(path, device=None):
+    machine = Machine(io=AsyncDevice() if device is None else device)
+    with open(path) as file:
+        copy(link(assamble(file.read())), machine.ram)
+    return machine
+
+def test_many():
+    async def main():
+        machines = [load('examples/count.asm') for _ in range(50)]
+        counts = await asyncio.gather(*[run(m, slice=100) for m in machines])
+        check(counts == [20304] * 50)
+        check(all(m.io.file.getvalue() == 'ok' for m in machines))
+    asyncio.run(main())
+
+def test_input():
+    async def main():
+        echo = load('examples/echo.asm')
+        other = load('examples/count.asm')
+        task = asyncio.ensure_future(run(echo, slice=10))
+        await asyncio.sleep(0)
+        # echo waits for input, the other machine runs meanwhile
+        check(await run(other, slice=10) == 20304)
+        check(not task.done())
+        echo.io.feed('hi')
+        await asyncio.sleep(0)
+        echo.io.feed('q')
+        await task
+        check(echo.io.file.getvalue() == 'hiq')
+        check(echo.io.tell() == 3)
+
+        # no more input
+        echo = load('examples/echo.asm')
+        echo.io.feed('x')
+        echo.io.end()
+        try:
+            await run(echo)
+            check(False)
+        except EOFError:
+            check(echo.io.tell() == 1)
+    asyncio.run(main())
+
+def test_budgets():
+    async def expect(budget, **limits):
+        machine = load('examples/count.asm')
+        try:
+            await run(machine, slice=100, **limits)
+            check(False)
+        except BudgetExceeded as e:
+            check(e.budget == budget)
+            return machine, e
+
+    async def main():
+        machine, e = await expect('instructions', instructions=1000)
+        check(e.count == 1000)
+        machine, e = await expect('output', output=1)
+        check(machine.io.file.getvalue() == 'o')
+        await expect('seconds', seconds=0)
+
+        # waiting for input counts too
+        machine = load('examples/echo.asm')
+        try:
+            await run(machine, seconds=0.01)
+            check(False)
+        except BudgetExceeded as e:
+            check(e.budget == 'seconds')
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    test_many()
+    test_input()
+    test_budgets()
+    print()
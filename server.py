@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+#
+# Serve many sessions from one process, over a Unix or TCP socket
+#
+# A client sends a program, the server runs it on a machine of its own and
+# streams getc and putc over the connection. The messages are frames: a
+# kind (one byte), a length (4 bytes) and the payload:
+#
+#   client -> server: SOURCE (the program), INPUT (bytes), END (no more input)
+#   server -> client: OUTPUT (text), EXIT (a JSON summary, then it closes)
+#
+
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from core import Machine
+from assamble import assamble, link
+from scheduler import AsyncDevice, BudgetExceeded, run
+from utils import check, copy
+
+SOURCE = b'S'
+INPUT = b'I'
+END = b'E'
+OUTPUT = b'O'
+EXIT = b'X'
+
+header = struct.Struct('>cI')
+
+def frame(kind, payload=b''):
+    return header.pack(kind, len(payload)) + payload
+
+async def read_frame(reader):
+    "Read a frame, return (kind, payload), kind is None at the end of the stream."
+    try:
+        kind, length = header.unpack(await reader.readexactly(header.size))
+        return kind, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None, b''
+
+class Connection:
+    "A text file writing OUTPUT frames to a connection."
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, text):
+        self.writer.write(frame(OUTPUT, text.encode()))
+
+    def flush(self):
+        pass
+
+class SessionDevice(AsyncDevice):
+    """An AsyncDevice telling its session when it waits for the client: for
+    some input, or for reading the output (drain, called by scheduler.run
+    every slice)."""
+
+    def __init__(self, session):
+        super().__init__(Connection(session.writer))
+        self.session = session
+
+    async def wait(self):
+        self.session.waiting = True
+        try:
+            await super().wait()
+        finally:
+            self.session.waiting = False
+
+    async def drain(self):
+        "Write the output, and wait while the client is slow to read it."
+        self.flush()
+        session = self.session
+        session.waiting = True
+        session.last_activity = time.monotonic()
+        try:
+            await session.writer.drain()
+        finally:
+            session.waiting = False
+
+class Session:
+    "One connection, with its own machine."
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.waiting = True         # for the client (its source, or some input)
+        self.last_activity = time.monotonic()
+        self.task = None
+
+    async def receive(self, device):
+        "Feed the machine with the input frames from the client."
+        while True:
+            kind, payload = await read_frame(self.reader)
+            self.last_activity = time.monotonic()
+            if kind == INPUT:
+                device.feed(payload)
+            else:
+                device.end()
+                return
+
+    async def serve(self):
+        summary = {'status': 1, 'error': None, 'instructions': 0}
+        receiver = None
+        try:
+            kind, payload = await read_frame(self.reader)
+            self.last_activity = time.monotonic()
+            if kind != SOURCE:
+                return
+            self.waiting = False
+            binary = self.server.image(payload.decode())
+            device = SessionDevice(self)
+            machine = Machine(io=device)
+            copy(binary, machine.ram)
+            receiver = asyncio.ensure_future(self.receive(device))
+            summary['instructions'] = await run(machine, **self.server.budgets)
+            summary['status'] = 0
+        except asyncio.CancelledError:
+            summary['error'] = 'idle'
+        except Exception as e:
+            summary['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        finally:
+            if receiver is not None:
+                receiver.cancel()
+            self.writer.write(frame(EXIT, json.dumps(summary).encode()))
+            self.writer.close()
+
+class Server:
+    """Run the programs sent by the clients. The images are cached by hash
+    of their source, the sessions waiting for their client for more than
+    idle seconds are closed. budgets are passed to scheduler.run."""
+
+    def __init__(self, idle=60, cache_size=256, **budgets):
+        self.idle = idle
+        self.cache_size = cache_size
+        self.budgets = budgets
+        self.images = OrderedDict()     # binaries, by hash of their source
+        self.sessions = set()
+
+    def image(self, source):
+        "Assamble and link a source, or get it from the cache."
+        key = hashlib.sha256(source.encode()).hexdigest()
+        binary = self.images.get(key)
+        if binary is None:
+            binary = self.images[key] = link(assamble(source))
+            if len(self.images) > self.cache_size:
+                self.images.popitem(last=False)
+        else:
+            self.images.move_to_end(key)
+        return binary
+
+    async def handle(self, reader, writer):
+        session = Session(self, reader, writer)
+        session.task = asyncio.current_task()
+        self.sessions.add(session)
+        try:
+            await session.serve()
+        finally:
+            self.sessions.discard(session)
+
+    def evict(self):
+        "Close the idle sessions."
+        now = time.monotonic()
+        for session in list(self.sessions):
+            if session.waiting and now - session.last_activity > self.idle:
+                session.task.cancel()
+
+    async def evict_forever(self):
+        while True:
+            await asyncio.sleep(self.idle / 2)
+            self.evict()
+
+    async def start(self, path=None, host='127.0.0.1', port=None):
+        "Listen on a Unix socket (path) or a TCP port, return the asyncio server."
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        self.evictor = asyncio.ensure_future(self.evict_forever())
+        return server
+
+###############################################################
+
+async def connect(path=None, host='127.0.0.1', port=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+def read_chunks(loop, fd, queue):
+    """Put the chunks read from a file descriptor in an asyncio queue, b''
+    at the end. Run on a daemon thread: it doesn't keep the process (or
+    asyncio.run) waiting for more input once the program halted."""
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            data = b''
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, data)
+        except RuntimeError:
+            return  # the loop is closed
+        if not data:
+            return
+
+async def client(source, input=None, output=None, path=None, host='127.0.0.1', port=None):
+    """Run a program on a server. input is bytes (sent at once) or a file
+    descriptor (read as it comes), output a text file (default: stdout).
+    Return the summary sent by the server."""
+    output = sys.stdout if output is None else output
+    reader, writer = await connect(path, host, port)
+    writer.write(frame(SOURCE, source.encode()))
+
+    async def send():
+        if isinstance(input, bytes):
+            writer.write(frame(INPUT, input))
+        elif input is not None:
+            chunks = asyncio.Queue()
+            threading.Thread(target=read_chunks, daemon=True,
+                             args=(asyncio.get_running_loop(), input, chunks)).start()
+            while True:
+                data = await chunks.get()
+                if not data:
+                    break
+                writer.write(frame(INPUT, data))
+                await writer.drain()
+        writer.write(frame(END))
+        await writer.drain()
+    sender = asyncio.ensure_future(send())
+
+    try:
+        while True:
+            kind, payload = await read_frame(reader)
+            if kind == OUTPUT:
+                output.write(payload.decode())
+                output.flush()
+            elif kind == EXIT:
+                return json.loads(payload)
+            elif kind is None:
+                return {'status': 1, 'error': 'connection lost', 'instructions': 0}
+    finally:
+        sender.cancel()
+        writer.close()
+
+###############################################################
+
+def test_sessions():
+    import io
+    import tempfile
+
+    async def run_client(path, name, text=b''):
+        with open('examples/{0}.asm'.format(name)) as file:
+            source = file.read()
+        output = io.StringIO()
+        summary = await client(source, text, output, path)
+        return summary, output.getvalue()
+
+    async def main(directory):
+        path = os.path.join(directory, 'socket')
+        server = Server(idle=0.05, instructions=100000)
+        listener = await server.start(path)
+        results = await asyncio.gather(
+            run_client(path, 'echo', b'hi\rq'),
+            run_client(path, 'hi'),
+            run_client(path, 'hi'),
+            run_client(path, 'count'))
+        check([output for (_, output) in results] == ['hi\r\nq', 'hi', 'hi', 'ok'])
+        check(all(summary['status'] == 0 for (summary, _) in results))
+        check(results[3][0]['instructions'] == 20304)
+        check(len(server.images) == 3)
+
+        # a client that never types gets evicted
+        reader, writer = await connect(path)
+        with open('examples/echo.asm') as file:
+            writer.write(frame(SOURCE, file.read().encode()))
+        kind, payload = await read_frame(reader)
+        check(kind == EXIT and json.loads(payload)['error'] == 'idle')
+        writer.close()
+
+        # so does a program that runs out of budget
+        summary, _ = await run_client(path, 'echo', b'x' * 100000)
+        check('BudgetExceeded' in summary['error'])
+
+        # and a client that doesn't read the output: the program waits for
+        # it (instead of the output piling up in the server), even without
+        # budgets
+        unbounded = Server(idle=0.05)
+        other = await unbounded.start(os.path.join(directory, 'other'))
+        reader, writer = await connect(os.path.join(directory, 'other'))
+        writer.write(frame(SOURCE, b"loop: putc 'x'\njmp loop"))
+        while not unbounded.sessions:
+            await asyncio.sleep(0.01)
+        for _ in range(100):
+            if not unbounded.sessions:
+                break   # evicted
+            await asyncio.sleep(0.05)
+        printed = 0
+        kind = OUTPUT
+        while kind == OUTPUT and printed < 1 << 20:
+            kind, payload = await asyncio.wait_for(read_frame(reader), 5)
+            printed += len(payload)
+        check(kind == EXIT and json.loads(payload)['error'] == 'idle')
+        check(printed < 1 << 20)
+        writer.close()
+        unbounded.evictor.cancel()
+        other.close()
+        await other.wait_closed()
+
+        server.evictor.cancel()
+        listener.close()
+        await listener.wait_closed()
+        check(not server.sessions)
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(main(directory))
+
+def test_input_fd():
+    import io
+    import tempfile
+
+    async def main(directory, fd):
+        path = os.path.join(directory, 'socket')
+        server = Server()
+        listener = await server.start(path)
+        with open('examples/hi.asm') as file:
+            source = file.read()
+        output = io.StringIO()
+        summary = await client(source, fd, output, path)
+        server.evictor.cancel()
+        listener.close()
+        await listener.wait_closed()
+        return summary, output.getvalue()
+
+    # the client returns when the program halts, though its input is open
+    # (for 5 seconds, in case it waits for the end of the input)
+    read, write = os.pipe()
+    closer = threading.Timer(5, os.close, [write])
+    closer.start()
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory() as directory:
+        summary, output = asyncio.run(main(directory, read))
+    closer.cancel()
+    closer.join()
+    check(time.monotonic() - start < 2)
+    check(summary['status'] == 0 and output == 'hi')
+    if time.monotonic() - start < 5:
+        os.close(write)
+    os.close(read)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run programs for many clients, or be a client")
+    parser.add_argument('--unix', metavar='PATH', help='Unix socket to listen or connect to')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='TCP port to listen or connect to')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='run the server')
+    serve.add_argument('--idle', type=float, default=60, help='seconds before closing a session waiting for its client')
+    serve.add_argument('--instructions', type=int, default=10 ** 8, help='budget of instructions per session (default: %(default)s)')
+    serve.add_argument('--output', type=int, default=10 ** 6, help='budget of chars printed per session (default: %(default)s)')
+    serve.add_argument('--seconds', type=float, help='budget of seconds per session')
+    client_parser = commands.add_parser('run', help='run a program on a server')
+    client_parser.add_argument('file', help='source file to execute')
+    commands.add_parser('test', help='run the tests')
+    args = parser.parse_args()
+    if args.command in ['serve', 'run'] and args.unix is None and args.port is None:
+        parser.error("{0} needs --unix or --port".format(args.command))
+
+    if args.command == 'serve':
+        async def serve_forever():
+            server = Server(args.idle, instructions=args.instructions, output=args.output,
+                            seconds=args.seconds)
+            listener = await server.start(args.unix, args.host, args.port)
+            await listener.serve_forever()
+        asyncio.run(serve_forever())
+    elif args.command == 'run':
+        with open(args.file) as file:
+            source = file.read()
+        summary = asyncio.run(client(source, sys.stdin.fileno(), None, args.unix, args.host, args.port))
+        print()
+        if summary['error']:
+            print('{0}: {1}'.format(args.file, summary['error']), file=sys.stderr)
+        sys.exit(summary['status'])
+    else:
+        test_sessions()
+        test_input_fd()
+        print()
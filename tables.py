@@ -0,0 +1,455 @@
+# Generated by ./meta.py --freeze, do not edit
+
+specification = ['halt',
+ ['getc putc'],
+ ['getc putc', 'r'],
+ 'putc i',
+ ['not neg popcount clz'],
+ ['not neg popcount clz', 'r'],
+ ['add sub mul div mod'],
+ ['add sub mul div mod', 'i'],
+ ['add sub mul div mod', 'r'],
+ ['add sub mul div mod', 'r r'],
+ ['add sub mul div mod', 'i r'],
+ ['or and xor shl shr'],
+ ['or and xor shl shr', 'i'],
+ ['or and xor shl shr', 'r'],
+ ['or and xor shl shr', 'r r'],
+ ['or and xor shl shr', 'i r'],
+ 'store i',
+ 'store r',
+ 'store i i',
+ 'store r i',
+ 'store r r',
+ 'store i r',
+ 'load i',
+ 'load r',
+ 'load i r',
+ 'load r r',
+ 'mov i',
+ 'mov r',
+ 'mov r r',
+ 'mov i r',
+ 'test r',
+ 'cmp i',
+ 'cmp r',
+ 'cmp i, r',
+ 'cmp r, r',
+ 'jmp i',
+ 'jmp r',
+ ['jo jno jz jnz jl jle jge jpe jpo jaz', 'i'],
+ 'push',
+ 'push i',
+ 'push r',
+ 'pop',
+ 'pop r',
+ 'call i',
+ 'call r',
+ 'ret',
+ ['cmpjo cmpjno cmpjz cmpjnz cmpjl cmpjle cmpjge cmpjpe cmpjpo cmpjaz', 'i i'],
+ ['cmpjo cmpjno cmpjz cmpjnz cmpjl cmpjle cmpjge cmpjpe cmpjpo cmpjaz', 'r i'],
+ 'subjnz i r i',
+ 'pushpop',
+ 'pushpop i r',
+ 'pushpop r r',
+ 'movputc i',
+ 'movputc r',
+ 'movputc i r',
+ 'movputc r r']
+
+operations = ['halt',
+ 'getc',
+ 'putc',
+ 'getc r',
+ 'putc r',
+ 'putc i',
+ 'not',
+ 'neg',
+ 'popcount',
+ 'clz',
+ 'not r',
+ 'neg r',
+ 'popcount r',
+ 'clz r',
+ 'add',
+ 'sub',
+ 'mul',
+ 'div',
+ 'mod',
+ 'add i',
+ 'sub i',
+ 'mul i',
+ 'div i',
+ 'mod i',
+ 'add r',
+ 'sub r',
+ 'mul r',
+ 'div r',
+ 'mod r',
+ 'add r r',
+ 'sub r r',
+ 'mul r r',
+ 'div r r',
+ 'mod r r',
+ 'add i r',
+ 'sub i r',
+ 'mul i r',
+ 'div i r',
+ 'mod i r',
+ 'or',
+ 'and',
+ 'xor',
+ 'shl',
+ 'shr',
+ 'or i',
+ 'and i',
+ 'xor i',
+ 'shl i',
+ 'shr i',
+ 'or r',
+ 'and r',
+ 'xor r',
+ 'shl r',
+ 'shr r',
+ 'or r r',
+ 'and r r',
+ 'xor r r',
+ 'shl r r',
+ 'shr r r',
+ 'or i r',
+ 'and i r',
+ 'xor i r',
+ 'shl i r',
+ 'shr i r',
+ 'store i',
+ 'store r',
+ 'store i i',
+ 'store r i',
+ 'store r r',
+ 'store i r',
+ 'load i',
+ 'load r',
+ 'load i r',
+ 'load r r',
+ 'mov i',
+ 'mov r',
+ 'mov r r',
+ 'mov i r',
+ 'test r',
+ 'cmp i',
+ 'cmp r',
+ 'cmp i, r',
+ 'cmp r, r',
+ 'jmp i',
+ 'jmp r',
+ 'jo i',
+ 'jno i',
+ 'jz i',
+ 'jnz i',
+ 'jl i',
+ 'jle i',
+ 'jge i',
+ 'jpe i',
+ 'jpo i',
+ 'jaz i',
+ 'push',
+ 'push i',
+ 'push r',
+ 'pop',
+ 'pop r',
+ 'call i',
+ 'call r',
+ 'ret',
+ 'cmpjo i i',
+ 'cmpjno i i',
+ 'cmpjz i i',
+ 'cmpjnz i i',
+ 'cmpjl i i',
+ 'cmpjle i i',
+ 'cmpjge i i',
+ 'cmpjpe i i',
+ 'cmpjpo i i',
+ 'cmpjaz i i',
+ 'cmpjo r i',
+ 'cmpjno r i',
+ 'cmpjz r i',
+ 'cmpjnz r i',
+ 'cmpjl r i',
+ 'cmpjle r i',
+ 'cmpjge r i',
+ 'cmpjpe r i',
+ 'cmpjpo r i',
+ 'cmpjaz r i',
+ 'subjnz i r i',
+ 'pushpop',
+ 'pushpop i r',
+ 'pushpop r r',
+ 'movputc i',
+ 'movputc r',
+ 'movputc i r',
+ 'movputc r r']
+
+codec = [('halt', '', 0),
+ ('getc', '', 0),
+ ('putc', '', 0),
+ ('getcr', 'r', 1),
+ ('putcr', 'r', 1),
+ ('putci', 'i', 1),
+ ('not', '', 0),
+ ('neg', '', 0),
+ ('popcount', '', 0),
+ ('clz', '', 0),
+ ('notr', 'r', 1),
+ ('negr', 'r', 1),
+ ('popcountr', 'r', 1),
+ ('clzr', 'r', 1),
+ ('add', '', 0),
+ ('sub', '', 0),
+ ('mul', '', 0),
+ ('div', '', 0),
+ ('mod', '', 0),
+ ('addi', 'i', 1),
+ ('subi', 'i', 1),
+ ('muli', 'i', 1),
+ ('divi', 'i', 1),
+ ('modi', 'i', 1),
+ ('addr', 'r', 1),
+ ('subr', 'r', 1),
+ ('mulr', 'r', 1),
+ ('divr', 'r', 1),
+ ('modr', 'r', 1),
+ ('addrr', 'rr', 1),
+ ('subrr', 'rr', 1),
+ ('mulrr', 'rr', 1),
+ ('divrr', 'rr', 1),
+ ('modrr', 'rr', 1),
+ ('addir', 'ir', 2),
+ ('subir', 'ir', 2),
+ ('mulir', 'ir', 2),
+ ('divir', 'ir', 2),
+ ('modir', 'ir', 2),
+ ('or', '', 0),
+ ('and', '', 0),
+ ('xor', '', 0),
+ ('shl', '', 0),
+ ('shr', '', 0),
+ ('ori', 'i', 1),
+ ('andi', 'i', 1),
+ ('xori', 'i', 1),
+ ('shli', 'i', 1),
+ ('shri', 'i', 1),
+ ('orr', 'r', 1),
+ ('andr', 'r', 1),
+ ('xorr', 'r', 1),
+ ('shlr', 'r', 1),
+ ('shrr', 'r', 1),
+ ('orrr', 'rr', 1),
+ ('andrr', 'rr', 1),
+ ('xorrr', 'rr', 1),
+ ('shlrr', 'rr', 1),
+ ('shrrr', 'rr', 1),
+ ('orir', 'ir', 2),
+ ('andir', 'ir', 2),
+ ('xorir', 'ir', 2),
+ ('shlir', 'ir', 2),
+ ('shrir', 'ir', 2),
+ ('storei', 'i', 1),
+ ('storer', 'r', 1),
+ ('storeii', 'ii', 2),
+ ('storeri', 'ri', 2),
+ ('storerr', 'rr', 1),
+ ('storeir', 'ir', 2),
+ ('loadi', 'i', 1),
+ ('loadr', 'r', 1),
+ ('loadir', 'ir', 2),
+ ('loadrr', 'rr', 1),
+ ('movi', 'i', 1),
+ ('movr', 'r', 1),
+ ('movrr', 'rr', 1),
+ ('movir', 'ir', 2),
+ ('testr', 'r', 1),
+ ('cmpi', 'i', 1),
+ ('cmpr', 'r', 1),
+ ('cmpi,r', 'i,r', 3),
+ ('cmpr,r', 'r,r', 3),
+ ('jmpi', 'i', 1),
+ ('jmpr', 'r', 1),
+ ('joi', 'i', 1),
+ ('jnoi', 'i', 1),
+ ('jzi', 'i', 1),
+ ('jnzi', 'i', 1),
+ ('jli', 'i', 1),
+ ('jlei', 'i', 1),
+ ('jgei', 'i', 1),
+ ('jpei', 'i', 1),
+ ('jpoi', 'i', 1),
+ ('jazi', 'i', 1),
+ ('push', '', 0),
+ ('pushi', 'i', 1),
+ ('pushr', 'r', 1),
+ ('pop', '', 0),
+ ('popr', 'r', 1),
+ ('calli', 'i', 1),
+ ('callr', 'r', 1),
+ ('ret', '', 0),
+ ('cmpjoii', 'ii', 2),
+ ('cmpjnoii', 'ii', 2),
+ ('cmpjzii', 'ii', 2),
+ ('cmpjnzii', 'ii', 2),
+ ('cmpjlii', 'ii', 2),
+ ('cmpjleii', 'ii', 2),
+ ('cmpjgeii', 'ii', 2),
+ ('cmpjpeii', 'ii', 2),
+ ('cmpjpoii', 'ii', 2),
+ ('cmpjazii', 'ii', 2),
+ ('cmpjori', 'ri', 2),
+ ('cmpjnori', 'ri', 2),
+ ('cmpjzri', 'ri', 2),
+ ('cmpjnzri', 'ri', 2),
+ ('cmpjlri', 'ri', 2),
+ ('cmpjleri', 'ri', 2),
+ ('cmpjgeri', 'ri', 2),
+ ('cmpjperi', 'ri', 2),
+ ('cmpjpori', 'ri', 2),
+ ('cmpjazri', 'ri', 2),
+ ('subjnziri', 'iri', 3),
+ ('pushpop', '', 0),
+ ('pushpopir', 'ir', 2),
+ ('pushpoprr', 'rr', 1),
+ ('movputci', 'i', 1),
+ ('movputcr', 'r', 1),
+ ('movputcir', 'ir', 2),
+ ('movputcrr', 'rr', 1)]
+
+opcodes = {'halt': 0,
+ 'getc': 1,
+ 'putc': 2,
+ 'getcr': 3,
+ 'putcr': 4,
+ 'putci': 5,
+ 'not': 6,
+ 'neg': 7,
+ 'popcount': 8,
+ 'clz': 9,
+ 'notr': 10,
+ 'negr': 11,
+ 'popcountr': 12,
+ 'clzr': 13,
+ 'add': 14,
+ 'sub': 15,
+ 'mul': 16,
+ 'div': 17,
+ 'mod': 18,
+ 'addi': 19,
+ 'subi': 20,
+ 'muli': 21,
+ 'divi': 22,
+ 'modi': 23,
+ 'addr': 24,
+ 'subr': 25,
+ 'mulr': 26,
+ 'divr': 27,
+ 'modr': 28,
+ 'addrr': 29,
+ 'subrr': 30,
+ 'mulrr': 31,
+ 'divrr': 32,
+ 'modrr': 33,
+ 'addir': 34,
+ 'subir': 35,
+ 'mulir': 36,
+ 'divir': 37,
+ 'modir': 38,
+ 'or': 39,
+ 'and': 40,
+ 'xor': 41,
+ 'shl': 42,
+ 'shr': 43,
+ 'ori': 44,
+ 'andi': 45,
+ 'xori': 46,
+ 'shli': 47,
+ 'shri': 48,
+ 'orr': 49,
+ 'andr': 50,
+ 'xorr': 51,
+ 'shlr': 52,
+ 'shrr': 53,
+ 'orrr': 54,
+ 'andrr': 55,
+ 'xorrr': 56,
+ 'shlrr': 57,
+ 'shrrr': 58,
+ 'orir': 59,
+ 'andir': 60,
+ 'xorir': 61,
+ 'shlir': 62,
+ 'shrir': 63,
+ 'storei': 64,
+ 'storer': 65,
+ 'storeii': 66,
+ 'storeri': 67,
+ 'storerr': 68,
+ 'storeir': 69,
+ 'loadi': 70,
+ 'loadr': 71,
+ 'loadir': 72,
+ 'loadrr': 73,
+ 'movi': 74,
+ 'movr': 75,
+ 'movrr': 76,
+ 'movir': 77,
+ 'testr': 78,
+ 'cmpi': 79,
+ 'cmpr': 80,
+ 'cmpi,r': 81,
+ 'cmpr,r': 82,
+ 'jmpi': 83,
+ 'jmpr': 84,
+ 'joi': 85,
+ 'jnoi': 86,
+ 'jzi': 87,
+ 'jnzi': 88,
+ 'jli': 89,
+ 'jlei': 90,
+ 'jgei': 91,
+ 'jpei': 92,
+ 'jpoi': 93,
+ 'jazi': 94,
+ 'push': 95,
+ 'pushi': 96,
+ 'pushr': 97,
+ 'pop': 98,
+ 'popr': 99,
+ 'calli': 100,
+ 'callr': 101,
+ 'ret': 102,
+ 'cmpjoii': 103,
+ 'cmpjnoii': 104,
+ 'cmpjzii': 105,
+ 'cmpjnzii': 106,
+ 'cmpjlii': 107,
+ 'cmpjleii': 108,
+ 'cmpjgeii': 109,
+ 'cmpjpeii': 110,
+ 'cmpjpoii': 111,
+ 'cmpjazii': 112,
+ 'cmpjori': 113,
+ 'cmpjnori': 114,
+ 'cmpjzri': 115,
+ 'cmpjnzri': 116,
+ 'cmpjlri': 117,
+ 'cmpjleri': 118,
+ 'cmpjgeri': 119,
+ 'cmpjperi': 120,
+ 'cmpjpori': 121,
+ 'cmpjazri': 122,
+ 'subjnziri': 123,
+ 'pushpop': 124,
+ 'pushpopir': 125,
+ 'pushpoprr': 126,
+ 'movputci': 127,
+ 'movputcr': 128,
+ 'movputcir': 129,
+ 'movputcrr': 130}
+
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# Structured traces of the execution of a machine
+#
+# A machine with a tracer (machine.trace) emits an event for everything it
+# does. The events are kept in a ring buffer and passed to the subscribers,
+# the renderers below print them.
+#
+
+import sys
+from array import array
+from assamble import codec, register_names, flag_names, disassamble_insctruction
+from utils import check, clamp
+
+# The kinds of events, and what their x and y are
+fetch = 0       # an instruction byte was read: address, byte
+decode = 1      # an instruction is about to run: address, opcode
+register = 2    # a register was written: register, value
+flag = 3        # a flag changed: flag, value (0 or 1)
+memory = 4      # a byte was written: address, value
+branch = 5      # a conditional jump: taken (0 or 1), target
+getc = 6        # about to wait for a char: register, 0 (then register has it)
+putc = 7        # a char is printed: value, 0
+compare = 8     # cmp: x, y (the result is y - x)
+kind_names = ['fetch', 'decode', 'register', 'flag', 'memory', 'branch',
+              'getc', 'putc', 'compare']
+
+# An event is stored as (kind, step, x, y), step counts the instructions
+width = 4
+
+class Tracer:
+    """Record events into a ring buffer of capacity events and pass them to
+    the subscribers. With sample, only the events of one instruction out of
+    sample are recorded."""
+
+    def __init__(self, capacity=4096, sample=1):
+        self.buffer = array('q', bytes(8 * width * capacity))
+        self.capacity = capacity
+        self.sample = sample
+        self.position = 0   # number of events recorded
+        self.step = 0
+        self.recording = True
+        self.subscribers = []
+
+    def start(self, step):
+        "Tell the tracer an instruction starts."
+        self.step = step
+        self.recording = step % self.sample == 0
+
+    def emit(self, kind, x, y=0):
+        if not self.recording:
+            return
+        i = (self.position % self.capacity) * width
+        buffer = self.buffer
+        buffer[i] = kind
+        buffer[i + 1] = self.step
+        buffer[i + 2] = x
+        buffer[i + 3] = y
+        self.position += 1
+        for kinds, fn in self.subscribers:
+            if kinds is None or kind in kinds:
+                fn(kind, self.step, x, y)
+
+    def subscribe(self, fn, kinds=None):
+        """Call fn(kind, step, x, y) for each event, or only for the events
+        of some kinds."""
+        self.subscribers.append((None if kinds is None else frozenset(kinds), fn))
+        return fn
+
+    def unsubscribe(self, fn):
+        self.subscribers = [(kinds, other) for (kinds, other) in self.subscribers
+                            if other is not fn]
+
+    def events(self):
+        "The events still in the buffer, oldest first, as (kind, step, x, y)."
+        count = min(self.position, self.capacity)
+        buffer = self.buffer
+        for n in range(self.position - count, self.position):
+            i = (n % self.capacity) * width
+            yield tuple(buffer[i:i + width])
+
+class Printer:
+    """Render the events as sentences, as the machine used to print them.
+    The instructions are disassambled from the fetch events, without them
+    (when subscribed to some kinds) only their name is known."""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.instruction = []
+
+    def __call__(self, kind, step, x, y):
+        file = self.file or sys.stdout
+        if kind == fetch:
+            self.instruction.append(y)
+            print(file=file)
+            print("Read opcode {0}".format(y), file=file)
+        elif kind == decode:
+            if self.instruction:
+                instruction = disassamble_insctruction(self.instruction)
+            else:
+                name, operands, _ = codec[y]
+                instruction = [name[:-len(operands)] if operands else name]
+                instruction += ['?'] * len(operands.replace(',', ''))
+            print("Running instruction: ", instruction, file=file)
+            self.instruction = []
+        elif kind == register:
+            print("Set register {0} to {1}".format(register_names[x], y), file=file)
+        elif kind == flag:
+            print("Set flag {0} to {1}".format(flag_names[x], bool(y)), file=file)
+        elif kind == memory:
+            print("Set memory address {0} to {1}".format(x, y), file=file)
+        elif kind == branch:
+            print("Taking the jump" if x else "Not taking the jump", file=file)
+        elif kind == getc:
+            print("Waiting for user input", file=file)
+        elif kind == putc:
+            print("About to print the char {0}".format(x), file=file)
+        elif kind == compare:
+            print("The result of comparing {0} to {1} is {2}".format(y, x, clamp(y - x)), file=file)
+
+class JsonWriter:
+    "Render the events as JSON lines."
+
+    def __init__(self, file=None):
+        import json
+        self.file = file
+        self.dumps = json.dumps
+
+    def __call__(self, kind, step, x, y):
+        event = {'kind': kind_names[kind], 'step': step, 'x': x, 'y': y}
+        print(self.dumps(event), file=self.file or sys.stdout)
+
+def printing_tracer(**options):
+    "A tracer printing the events as sentences."
+    tracer = Tracer(**options)
+    tracer.subscribe(Printer())
+    return tracer
+
+###############################################################
+
+def test_ring():
+    tracer = Tracer(capacity=3)
+    for i in range(5):
+        tracer.start(i)
+        tracer.emit(register, 0, i)
+    check(tracer.position == 5)
+    check(list(tracer.events()) == [(register, i, 0, i) for i in [2, 3, 4]])
+
+def test_subscribe():
+    tracer = Tracer(sample=2)
+    seen = []
+    fn = tracer.subscribe(lambda *event: seen.append(event), [memory])
+    for i in range(4):
+        tracer.start(i)
+        tracer.emit(memory, i, 1)
+        tracer.emit(register, i, 1)
+    check(seen == [(memory, 0, 0, 1), (memory, 2, 2, 1)])
+    tracer.unsubscribe(fn)
+    tracer.emit(memory, 0, 0)
+    check(len(seen) == 2)
+
+def test_machine():
+    import io
+    from core import Machine
+    from assamble import assamble, link
+    from console import capture
+    from utils import copy
+    machine = Machine(io=capture())
+    copy(link(assamble("mov 'h'\nstore 9\nputc\nhalt")), machine.ram)
+    machine.trace = Tracer()
+    kinds = []
+    machine.trace.subscribe(lambda kind, *_: kinds.append(kind), [decode, memory, putc])
+    text = io.StringIO()
+    machine.trace.subscribe(Printer(text))
+    machine.run()
+    check(kinds == [decode, decode, memory, decode, putc, decode])
+    check("Set memory address 9 to 104" in text.getvalue())
+    check("Running instruction:  ['putc']" in text.getvalue())
+
+    # without the fetch events, the instructions are known by name
+    machine = Machine(io=capture())
+    copy(link(assamble("mov 'h'\nputc\nhalt")), machine.ram)
+    machine.trace = Tracer()
+    text = io.StringIO()
+    machine.trace.subscribe(Printer(text), [decode])
+    machine.run()
+    check(text.getvalue() == "Running instruction:  ['mov', '?']\n"
+                             "Running instruction:  ['putc']\n"
+                             "Running instruction:  ['halt']\n")
+
+def test_getc():
+    import io
+    from core import Machine
+    from assamble import assamble, link
+    from console import capture
+    from utils import copy
+    # the event comes before waiting for the char, even if there's none
+    machine = Machine(io=capture())
+    copy(link(assamble("getc b\nhalt")), machine.ram)
+    machine.trace = Tracer()
+    text = io.StringIO()
+    machine.trace.subscribe(Printer(text), [getc])
+    try:
+        machine.run()
+        check(False)
+    except EOFError:
+        check(text.getvalue() == "Waiting for user input\n")
+    check(list(machine.trace.events())[-1] == (getc, 1, register_names.index('b'), 0))
+
+# What emu --trace prints for printed_program: the bytes of an instruction
+# are read before ip moves, and the superinstructions (subjnz) show as such
+printed_program = "mov 1 b\nloop:\nsub 1 b\njnz loop\nputc 'x'\nhalt"
+printed_trace = """
+Read opcode 77
+
+Read opcode 1
+
+Read opcode 1
+Running instruction:  ['mov', 1, 'b']
+Set register ip to 2
+Set register b to 1
+Set register ip to 3
+
+Read opcode 123
+
+Read opcode 1
+
+Read opcode 1
+
+Read opcode 3
+Running instruction:  ['subjnz', 1, 'b', 3]
+Set register ip to 6
+Set flag zf to True
+Set flag pf to True
+Set register b to 0
+Not taking the jump
+Set register ip to 7
+
+Read opcode 5
+
+Read opcode 120
+Running instruction:  ['putc', 120]
+Set register ip to 8
+About to print the char 120
+Set register ip to 9
+
+Read opcode 0
+Running instruction:  ['halt']
+"""
+
+def test_printer():
+    import io
+    from core import Machine
+    from assamble import assamble, link
+    from optimizer import optimize
+    from console import capture
+    from utils import copy
+    machine = Machine(io=capture())
+    copy(link(optimize(assamble(printed_program))), machine.ram)
+    machine.trace = Tracer()
+    text = io.StringIO()
+    machine.trace.subscribe(Printer(text))
+    machine.run()
+    check(text.getvalue() == printed_trace)
+
+if __name__ == '__main__':
+    test_ring()
+    test_subscribe()
+    test_machine()
+    test_getc()
+    test_printer()
+    print()
@@ -1,6 +1,4 @@
 import sys
-import tty, termios
-import traceback
 
 def print_dotted_list(lis):
     for i in lis:
@@ -9,6 +7,7 @@ def print_dotted_list(lis):
 # Not sure this works on windows
 def getchar():
     "Read one keypress from the terminal"
+    import tty, termios
     stdin = sys.stdin.fileno()
     old = termios.tcgetattr(stdin)
     new = termios.tcgetattr(stdin)
@@ -28,6 +27,7 @@ def putchar(value):
 def check(passed):
     "Print the traceback if passed is false, print a dot (without newline) otherwise."
     if not passed:
+        import traceback
         print("Check failed")
         traceback.print_stack()
     else:
@@ -38,22 +38,11 @@ def fix_overflow(x):
         return x
     return (x % 128) - 128
 
-assert fix_overflow(128) == -128
-assert fix_overflow(127) == 127
-assert fix_overflow(-128) == -128
-assert fix_overflow(0) == 0
-assert fix_overflow(150) == -106
-
 def fix_underflow(x):
     if x >= -128:
         return x
     return x % 128
 
-assert fix_underflow(127) == 127
-assert fix_underflow(-128) == -128
-assert fix_underflow(0) == 0
-assert fix_underflow(-200) == 56
-
 def overflows(x):
     return x < -255 or x > 254
 
@@ -64,9 +53,9 @@ def params(fn):
     "Get a list of tuples representing the arguments of a function."
     varnames = list(fn.__code__.co_varnames)
     arguments = varnames[:fn.__code__.co_argcount]
-    defaults = list(fn.__defaults__)
-    defaults.extend([None] * (len(arguments) - len(defaults)))
-    return list(zip(arguments[::-1], defaults))[::-1]
+    defaults = list(fn.__defaults__ or [])
+    defaults = [None] * (len(arguments) - len(defaults)) + defaults
+    return list(zip(arguments, defaults))
 
 def popcount(n):
     "count the number of 1s in binary representation"
@@ -84,13 +73,31 @@ def remove_comment(line):
     return line
 
 def copy(source, destination, destination_start = 0):
-    "copy a sequence over a list, from a certain place."
-    i = 0
-    for s in source:
-        destination[destination_start + i] = s
-        i = i + 1
+    """copy a sequence over a list or a buffer (bytearray, memoryview...),
+    from a certain place, with a single slice assignment."""
+    end = destination_start + len(source)
+    if end > len(destination):
+        raise IndexError("copying past the end")
+    if not isinstance(destination, list):
+        source = bytes(source)
+    destination[destination_start:end] = source
 
 def complement(fn):
     def comp(x):
         return not fn(x)
     return comp
+
+def test_fix():
+    check(fix_overflow(128) == -128)
+    check(fix_overflow(127) == 127)
+    check(fix_overflow(-128) == -128)
+    check(fix_overflow(0) == 0)
+    check(fix_overflow(150) == -106)
+    check(fix_underflow(127) == 127)
+    check(fix_underflow(-128) == -128)
+    check(fix_underflow(0) == 0)
+    check(fix_underflow(-200) == 56)
+
+if __name__ == '__main__':
+    test_fix()
+    print()